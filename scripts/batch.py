@@ -0,0 +1,197 @@
+"""
+Run the pipeline for many countries.
+
+The global inputs are read once for the whole batch: the tower csv is
+split into every country's site table in a single pass, and the country
+rows of each GADM level are indexed before the worker processes are
+forked, so each country reads only its own features. Countries are then
+run across a pool of workers sized to the available memory.
+
+Usage:
+
+    python scripts/batch.py MEX COL PER
+    python scripts/batch.py --file countries.txt --jobs 4
+
+October 2026
+
+"""
+import os
+import time
+import argparse
+import configparser
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+import psutil
+
+import preprocess
+import pipeline
+
+CONFIG = configparser.ConfigParser()
+CONFIG.read(os.path.join(os.path.dirname(__file__), 'script_config.ini'))
+
+DATA_RAW = preprocess.DATA_RAW
+
+MEMORY_PER_COUNTRY = CONFIG.getfloat('batch', 'memory_per_country_mb',
+    fallback=4000) * 1e6
+
+
+def get_countries(codes, gid_region=None):
+    """
+    Build the country dicts for a list of ISO3 codes using the
+    countries.csv information file.
+
+    The regional level is taken from the `lowest` GADM level available
+    (up to 2), unless given.
+
+    """
+    path = os.path.join(DATA_RAW, 'countries.csv')
+    info = pd.read_csv(path, encoding = "ISO-8859-1", keep_default_na=False)
+    info = info.set_index('iso3').to_dict('index')
+
+    countries = []
+
+    for iso3 in codes:
+
+        if not iso3 in info:
+            print('Skipping unknown country: {}'.format(iso3))
+            continue
+
+        level = gid_region
+        if level is None:
+            level = 2
+            if str(info[iso3].get('lowest', '')).isdigit():
+                level = min(int(info[iso3]['lowest']), 2)
+
+        countries.append({
+            'iso3': iso3,
+            'iso2': info[iso3]['iso2'],
+            'gid_region': level,
+            'regional_level': level,
+        })
+
+    return countries
+
+
+def read_codes(path):
+    """
+    Read ISO3 codes from a text file (one per line) or a csv file with
+    an iso3 column.
+
+    """
+    if path.endswith('.csv'):
+        return pd.read_csv(path)['iso3'].tolist()
+
+    with open(path, 'r') as source:
+        return [line.strip() for line in source if line.strip()]
+
+
+def get_workers(countries, jobs=None):
+    """
+    Size the worker pool to the memory available once the shared inputs
+    are loaded, capped at the number of cpus and countries.
+
+    """
+    if jobs is not None:
+        return max(1, min(jobs, len(countries)))
+
+    available = psutil.virtual_memory().available
+    workers = int(available // MEMORY_PER_COUNTRY)
+
+    return max(1, min(workers, os.cpu_count() or 1, len(countries)))
+
+
+def run_country(country, stage_jobs):
+    """
+    Run the pipeline for a single country. Called within a worker.
+
+    """
+    start = time.time()
+
+    try:
+        pipeline.mark_complete(country, ['create_national_sites_csv'])
+        pipeline.run_pipeline(country, jobs=stage_jobs)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+
+    return country['iso3'], time.time() - start, error
+
+
+def run_batch(countries, jobs=None, stage_jobs=1):
+    """
+    Run the pipeline for a list of countries.
+
+    Parameters
+    ----------
+    countries : list
+        Country dicts, as returned by get_countries.
+    jobs : int
+        Number of countries to run concurrently (sized to the available
+        memory if not given).
+    stage_jobs : int
+        Number of stages to run concurrently within each country.
+
+    """
+    print('Splitting the tower data for {} countries'.format(len(countries)))
+    preprocess.extract_national_sites(countries)
+
+    levels = max([int(country['gid_region']) for country in countries] + [0])
+    folder = os.path.join(DATA_RAW, 'gadm36_levels_shp')
+    paths = [os.path.join(folder, 'gadm36_{}.shp'.format(level))
+        for level in range(0, levels + 1)]
+
+    print('Indexing the shared GADM layers')
+    for path in paths:
+        if os.path.exists(path):
+            preprocess.get_gadm_rows(path)
+
+    workers = get_workers(countries, jobs)
+    print('Running {} countries on {} workers'.format(len(countries), workers))
+
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing.get_context()
+
+    failed = []
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+
+        futures = [executor.submit(run_country, country, stage_jobs)
+            for country in countries]
+
+        for future in as_completed(futures):
+            iso3, seconds, error = future.result()
+            if error is None:
+                print('Completed {} in {}s'.format(iso3, round(seconds, 1)))
+            else:
+                print('Failed {}:\n{}'.format(iso3, error))
+                failed.append(iso3)
+
+    if len(failed) > 0:
+        print('Failed countries: {}'.format(', '.join(failed)))
+
+    return failed
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('iso3', nargs='*', default=[])
+    parser.add_argument('--file', default=None,
+        help='text file of ISO3 codes, or csv with an iso3 column')
+    parser.add_argument('--gid-region', type=int, default=None)
+    parser.add_argument('--jobs', type=int, default=None)
+    parser.add_argument('--stage-jobs', type=int, default=1)
+    args = parser.parse_args()
+
+    codes = list(args.iso3)
+    if args.file:
+        codes = codes + read_codes(args.file)
+
+    countries = get_countries(codes, args.gid_region)
+
+    run_batch(countries, jobs=args.jobs, stage_jobs=args.stage_jobs)
@@ -0,0 +1,642 @@
+"""
+Benchmark the pipeline stages on synthetic countries.
+
+A synthetic country is generated at a chosen scale, with GADM style
+boundaries, cell towers, a settlement raster, coverage rasters and a road
+network, laid out as the raw data folder expected by the scripts. Each
+stage is then timed at several scales, and a scaling exponent is fitted
+for each stage.
+
+Outputs can be checked against stored golden results, so that speedups
+can be verified as behaviour preserving.
+
+October 2026
+
+"""
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import importlib
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pyproj
+import rasterio
+from rasterio.transform import from_origin
+from shapely.geometry import box, LineString, MultiPolygon
+
+import preprocess
+import pop
+import grid
+import process
+import weights
+import clusters
+import validate
+import pipeline
+from instrument import get_report, reset_report, summarize_report, REPORTS
+
+BENCHMARK = os.path.join(preprocess.BASE_PATH, 'benchmark')
+GOLDEN = os.path.join(BENCHMARK, 'golden')
+
+SYNTHETIC = {
+    'iso3': 'SYN',
+    'iso2': 'SY',
+    'gid_region': 2,
+    'regional_level': 2,
+}
+
+MCC = 999
+OPERATORS = [1, 2, 3, 4]
+RADIOS = ['GSM', 'UMTS', 'LTE', 'NR', 'CDMA']
+RADIO_WEIGHTS = [0.35, 0.3, 0.3, 0.04, 0.01]
+ROAD_CLASSES = ['motorway', 'trunk', 'primary', 'secondary', 'tertiary',
+    'residential']
+
+# origin of the synthetic country in EPSG:3857 (central Mexico)
+ORIGIN_X = -11000000
+ORIGIN_Y = 2200000
+UPPER_TILE_M = 100000
+
+
+def generate_synthetic_country(folder, scale, seed=42, cells_per_km2=0.05):
+    """
+    Write synthetic raw inputs for a square country of `scale` by `scale`
+    upper (100 km) tiles.
+
+    Parameters
+    ----------
+    folder : string
+        Folder to hold the synthetic `data_raw` and `data` folders.
+    scale : int
+        Side length of the country, in upper tiles.
+    seed : int
+        Seed for the random number generator.
+    cells_per_km2 : float
+        Mean density of cells across the country.
+
+    """
+    rng = np.random.default_rng(seed)
+    data_raw = os.path.join(folder, 'data_raw')
+
+    side = scale * UPPER_TILE_M
+    xmin, ymin = ORIGIN_X, ORIGIN_Y
+    xmax, ymax = xmin + side, ymin + side
+
+    to_4326 = pyproj.Transformer.from_crs('EPSG:3857', 'EPSG:4326',
+        always_xy=True)
+
+    cities = generate_cities(rng, scale, xmin, ymin, xmax, ymax)
+
+    write_boundaries(data_raw, scale, xmin, ymin, xmax, ymax, to_4326)
+    n_cells = write_towers(data_raw, rng, cities, side, cells_per_km2, to_4326)
+    write_settlements(data_raw, rng, cities, xmin, ymin, xmax, ymax, to_4326)
+    write_coverage(data_raw, cities, xmin, ymin, xmax, ymax)
+    write_roads(data_raw, rng, cities, to_4326)
+
+    folder_raw = os.path.join(folder, 'data', 'raw')
+    if not os.path.exists(folder_raw):
+        os.makedirs(folder_raw)
+    path = os.path.join(preprocess.BASE_PATH, 'raw', 'cash_to_spend.csv')
+    shutil.copy(path, os.path.join(folder_raw, 'cash_to_spend.csv'))
+
+    return {
+        'scale': scale,
+        'area_km2': (side / 1e3) ** 2,
+        'cells': n_cells,
+        'cities': len(cities),
+    }
+
+
+def generate_cities(rng, scale, xmin, ymin, xmax, ymax):
+    """
+    Place settlements with lognormal populations across the country.
+
+    """
+    n = 4 * scale ** 2
+
+    return pd.DataFrame({
+        'x': rng.uniform(xmin, xmax, n),
+        'y': rng.uniform(ymin, ymax, n),
+        'population': np.round(rng.lognormal(10, 1.2, n)),
+        'radius': rng.uniform(3000, 20000, n),
+    })
+
+
+def write_boundaries(data_raw, scale, xmin, ymin, xmax, ymax, to_4326):
+    """
+    Write GADM style level 0, 1 and 2 boundaries and the country
+    information files.
+
+    """
+    folder = os.path.join(data_raw, 'gadm36_levels_shp')
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+    def to_geo(geom):
+        return gpd.GeoSeries([geom], crs='epsg:3857').to_crs(4326).values[0]
+
+    iso3 = SYNTHETIC['iso3']
+    side = xmax - xmin
+    island = box(xmax + 5000, ymin + 5000, xmax + 8000, ymin + 8000)
+    outline = MultiPolygon([box(xmin, ymin, xmax, ymax), island])
+
+    level_0 = [
+        {'GID_0': iso3, 'NAME_0': 'Synthetica', 'geometry': to_geo(outline)},
+        {'GID_0': 'ZZZ', 'NAME_0': 'Elsewhere', 'geometry': to_geo(
+            box(xmin - side, ymin, xmin - 1000, ymax))},
+    ]
+
+    n_1 = max(2, scale)
+    n_2 = 2
+    step_1 = side / n_1
+    step_2 = step_1 / n_2
+
+    level_1 = []
+    level_2 = []
+
+    for i in range(n_1):
+        for j in range(n_1):
+            idx_1 = i * n_1 + j + 1
+            gid_1 = '{}.{}_1'.format(iso3, idx_1)
+            x1, y1 = xmin + i * step_1, ymin + j * step_1
+            level_1.append({
+                'GID_0': iso3,
+                'NAME_0': 'Synthetica',
+                'GID_1': gid_1,
+                'NAME_1': 'Region {}'.format(idx_1),
+                'geometry': to_geo(box(x1, y1, x1 + step_1, y1 + step_1)),
+            })
+            for k in range(n_2):
+                for m in range(n_2):
+                    idx_2 = k * n_2 + m + 1
+                    x2, y2 = x1 + k * step_2, y1 + m * step_2
+                    level_2.append({
+                        'GID_0': iso3,
+                        'NAME_0': 'Synthetica',
+                        'GID_1': gid_1,
+                        'NAME_1': 'Region {}'.format(idx_1),
+                        'GID_2': '{}.{}.{}_1'.format(iso3, idx_1, idx_2),
+                        'NAME_2': 'District {}.{}'.format(idx_1, idx_2),
+                        'geometry': to_geo(
+                            box(x2, y2, x2 + step_2, y2 + step_2)),
+                    })
+
+    for level, data in enumerate([level_0, level_1, level_2]):
+        data = gpd.GeoDataFrame(data, crs='epsg:4326')
+        data.to_file(os.path.join(folder, 'gadm36_{}.shp'.format(level)))
+
+    countries = pd.DataFrame([
+        {'iso3': iso3, 'iso2': SYNTHETIC['iso2'], 'country': 'Synthetica'},
+        {'iso3': 'ZZZ', 'iso2': 'ZZ', 'country': 'Elsewhere'},
+    ])
+    countries.to_csv(os.path.join(data_raw, 'countries.csv'), index=False)
+
+    mobile_codes = pd.DataFrame([
+        {'iso3': iso3, 'mcc': MCC, 'mnc': mnc} for mnc in OPERATORS
+    ] + [{'iso3': 'ZZZ', 'mcc': MCC - 1, 'mnc': 1}])
+    mobile_codes.to_csv(os.path.join(data_raw, 'mobile_codes.csv'),
+        index=False)
+
+    return
+
+
+def write_towers(data_raw, rng, cities, side, cells_per_km2, to_4326):
+    """
+    Write an OpenCelliD style cell tower file, with cells clustered
+    around settlements and a share of cells from another country.
+
+    """
+    n = int(cells_per_km2 * (side / 1e3) ** 2)
+
+    weights = cities['population'] / cities['population'].sum()
+    idx = rng.choice(len(cities), size=n, p=weights.values)
+    x = cities['x'].values[idx] + rng.normal(0, 1, n) * cities['radius'].values[idx]
+    y = cities['y'].values[idx] + rng.normal(0, 1, n) * cities['radius'].values[idx]
+    lon, lat = to_4326.transform(x, y)
+
+    created = rng.integers(
+        pd.Timestamp('2008-01-01').value // 10 ** 9,
+        pd.Timestamp('2022-12-01').value // 10 ** 9, n)
+
+    towers = pd.DataFrame({
+        'radio': rng.choice(RADIOS, size=n, p=RADIO_WEIGHTS),
+        'mcc': np.where(rng.random(n) < 0.95, MCC, MCC - 1),
+        'net': rng.choice(OPERATORS, size=n),
+        'area': rng.integers(1, 5000, n),
+        'cell': rng.permutation(np.arange(10 ** 6, 10 ** 6 + n)),
+        'unit': 0,
+        'lon': np.round(lon, 6),
+        'lat': np.round(lat, 6),
+        'range': rng.integers(100, 10000, n),
+        'samples': rng.integers(1, 500, n),
+        'changeable': 1,
+        'created': created,
+        'updated': created + rng.integers(0, 10 ** 8, n),
+        'averageSignal': 0,
+    })
+
+    path = os.path.join(data_raw, preprocess.TOWERS_FILE)
+    towers.to_csv(path, index=False)
+
+    return n
+
+
+def write_settlements(data_raw, rng, cities, xmin, ymin, xmax, ymax, to_4326):
+    """
+    Write a 1 km WorldPop style population raster in EPSG:4326.
+
+    """
+    folder = os.path.join(data_raw, 'settlement_layer')
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+    res = 1 / 120
+    west, south = to_4326.transform(xmin - 20000, ymin - 20000)
+    east, north = to_4326.transform(xmax + 20000, ymax + 20000)
+    width = int(np.ceil((east - west) / res))
+    height = int(np.ceil((north - south) / res))
+    transform = from_origin(west, north, res, res)
+
+    lon = west + (np.arange(width) + 0.5) * res
+    lat = north - (np.arange(height) + 0.5) * res
+    lon, lat = np.meshgrid(lon, lat)
+    to_3857 = pyproj.Transformer.from_crs('EPSG:4326', 'EPSG:3857',
+        always_xy=True)
+    x, y = to_3857.transform(lon, lat)
+
+    array = rng.gamma(1, 2, size=(height, width)).astype('float32')
+    for city in cities.itertuples():
+        distance = np.hypot(x - city.x, y - city.y)
+        kernel = np.exp(-(distance / city.radius) ** 2)
+        array += (city.population * kernel / max(kernel.sum(), 1)).astype('float32')
+
+    meta = {
+        'driver': 'GTiff',
+        'dtype': 'float32',
+        'count': 1,
+        'width': width,
+        'height': height,
+        'crs': 'epsg:4326',
+        'transform': transform,
+        'nodata': -99999,
+    }
+
+    path = os.path.join(folder, 'ppp_2020_1km_Aggregated.tif')
+    with rasterio.open(path, 'w', **meta) as dest:
+        dest.write(array, 1)
+
+    return
+
+
+def write_coverage(data_raw, cities, xmin, ymin, xmax, ymax):
+    """
+    Write Mobile Coverage Explorer style rasters in EPSG:3857, with
+    coverage reaching further from settlements for older generations.
+
+    """
+    res = 1000
+    width = int((xmax - xmin) / res)
+    height = int((ymax - ymin) / res)
+    transform = from_origin(xmin, ymax, res, res)
+
+    x = xmin + (np.arange(width) + 0.5) * res
+    y = ymax - (np.arange(height) + 0.5) * res
+    x, y = np.meshgrid(x, y)
+
+    reach = {'2G': 4, '3G': 2.5, '4G': 1.5}
+
+    for tech, factor in reach.items():
+
+        array = np.zeros((height, width), dtype='uint8')
+        for city in cities.itertuples():
+            distance = np.hypot(x - city.x, y - city.y)
+            array[distance < city.radius * factor] = 1
+            array[(distance >= city.radius * factor) &
+                (distance < city.radius * factor * 1.2) & (array == 0)] = 2
+
+        folder = os.path.join(data_raw, 'Mobile Coverage Explorer v2020 - GeoTIFF',
+            'ByCountry', 'MCE_{}'.format(tech))
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+        meta = {
+            'driver': 'GTiff',
+            'dtype': 'uint8',
+            'count': 1,
+            'width': width,
+            'height': height,
+            'crs': 'epsg:3857',
+            'transform': transform,
+            'nodata': 255,
+        }
+
+        filename = 'MCE_{}{}_2020.tif'.format(SYNTHETIC['iso2'], tech)
+        with rasterio.open(os.path.join(folder, filename), 'w', **meta) as dest:
+            dest.write(array, 1)
+
+    return
+
+
+def write_roads(data_raw, rng, cities, to_4326):
+    """
+    Write an OSM style road network linking settlements.
+
+    """
+    folder = os.path.join(data_raw, 'osm')
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+    order = cities.sort_values('population', ascending=False).reset_index()
+
+    output = []
+
+    for idx, city in order.iterrows():
+
+        if idx == 0:
+            continue
+
+        target = order.iloc[rng.integers(0, idx)]
+        line = LineString([
+            to_4326.transform(city['x'], city['y']),
+            to_4326.transform(target['x'], target['y']),
+        ])
+        output.append({
+            'osm_id': str(idx),
+            'fclass': ROAD_CLASSES[min(idx // 4, len(ROAD_CLASSES) - 1)],
+            'maxspeed': int(rng.choice([0, 60, 90, 110])),
+            'geometry': line,
+        })
+
+    output = gpd.GeoDataFrame(output, crs='epsg:4326')
+    output.to_file(os.path.join(folder, 'gis_osm_roads_free_1.shp'))
+
+    return
+
+
+def configure_paths(folder):
+    """
+    Point the pipeline modules at a synthetic data folder.
+
+    """
+    data_raw = os.path.join(folder, 'data_raw')
+    data_processed = os.path.join(folder, 'data', 'processed')
+    results = os.path.join(folder, 'results')
+
+    for module in [preprocess, pop, grid, process, weights, clusters,
+            validate, pipeline]:
+        if hasattr(module, 'DATA_RAW'):
+            module.DATA_RAW = data_raw
+        module.DATA_PROCESSED = data_processed
+        if hasattr(module, 'RESULTS'):
+            module.RESULTS = results
+
+    return results
+
+
+def run_stages(country):
+    """
+    Run every pipeline stage in dependency order, timing each one.
+
+    """
+    output = []
+
+    for stage in pipeline.order_stages(pipeline.get_stages(country)):
+
+        function = getattr(importlib.import_module(stage['module']),
+            stage['function'])
+
+        reset_report()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+
+        function(*stage['args'])
+
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+
+        summary = [item for item in summarize_report(get_report())
+            if item['stage'] == stage['function']]
+
+        output.append({
+            'stage': stage['name'],
+            'wall_s': round(wall, 3),
+            'cpu_s': round(cpu, 3),
+            'peak_rss_mb': summary[0]['peak_rss_mb'] if summary else None,
+            'records': summary[0]['records'] if summary else None,
+        })
+
+    return output
+
+
+def fit_scaling(timings):
+    """
+    Fit a power law to the wall time of each stage against the number of
+    tiles, returning the scaling exponent per stage.
+
+    """
+    output = []
+
+    for stage, subset in timings.groupby('stage', sort=False):
+
+        subset = subset[subset['wall_s'] > 0]
+
+        if subset['tiles'].nunique() < 2:
+            exponent = None
+        else:
+            exponent = np.polyfit(np.log(subset['tiles']),
+                np.log(subset['wall_s']), 1)[0]
+            exponent = round(exponent, 2)
+
+        output.append({
+            'stage': stage,
+            'exponent': exponent,
+            'wall_s_smallest': subset['wall_s'].iloc[0] if len(subset) else None,
+            'wall_s_largest': subset['wall_s'].iloc[-1] if len(subset) else None,
+        })
+
+    return pd.DataFrame(output)
+
+
+def compare_results(path_results, path_golden, tolerance=1e-6):
+    """
+    Compare a results table against a golden copy.
+
+    Rows are compared irrespective of order. Returns a list of
+    differences, which is empty when the results match.
+
+    """
+    columns = process.CSV_COLUMNS
+
+    def load(path):
+        data = pd.read_csv(path, keep_default_na=True)[columns]
+        data['year'] = pd.to_numeric(data['year']).astype('Int64')
+        data['radio'] = data['radio'].fillna('')
+        return data.sort_values(['radio', 'year', 'id_lower']).reset_index(drop=True)
+
+    results = load(path_results)
+    golden = load(path_golden)
+
+    if not len(results) == len(golden):
+        return ['Row count {} does not match golden {}'.format(
+            len(results), len(golden))]
+
+    differences = []
+
+    for column in columns:
+        if column == 'attractiveness':
+            mismatch = ~np.isclose(results[column], golden[column],
+                atol=tolerance, equal_nan=True)
+        else:
+            mismatch = ~(results[column].astype(str) == golden[column].astype(str))
+        if mismatch.any():
+            differences.append('{}: {} rows differ'.format(column, int(mismatch.sum())))
+
+    return differences
+
+
+def check_golden(country, path_golden=None):
+    """
+    Rerun the backcast for a country from its processed data and compare
+    the results with the stored golden results (by default those held in
+    `results/{iso3}/results.csv`).
+
+    """
+    iso3 = country['iso3']
+    results = process.RESULTS
+
+    if path_golden is None:
+        path_golden = os.path.join(results, iso3, 'results.csv')
+
+    folder = tempfile.mkdtemp()
+    process.RESULTS = folder
+
+    try:
+        process.generate_tile_backcast(country)
+        process.aggregate_results(country)
+        differences = compare_results(
+            os.path.join(folder, iso3, 'results.csv'), path_golden)
+    finally:
+        process.RESULTS = results
+        shutil.rmtree(folder)
+
+    return differences
+
+
+def check_coverage(results, iso3):
+    """
+    Check the validation report of a synthetic run found covered tiles
+    for every radio, as the synthetic coverage rasters reach around each
+    settlement.
+
+    """
+    with open(os.path.join(results, iso3, 'validation.json'), 'r') as source:
+        report = json.load(source)
+
+    covered = set(item['radio'] for item in report['coverage']
+        if item['covered_tiles'] > 0)
+    missing = [radio for radio in validate.RADIOS if not radio in covered]
+
+    if len(missing) > 0:
+        raise AssertionError('No covered tiles found in the validation of '
+            '{} for {}'.format(iso3, ', '.join(missing)))
+
+    return
+
+
+def run_benchmarks(scales, seed=42, update_golden=False, keep=False):
+    """
+    Time each stage on synthetic countries of increasing scale.
+
+    """
+    country = SYNTHETIC
+    timings = []
+    golden = []
+
+    for scale in scales:
+
+        print('Working on synthetic country at scale {}'.format(scale))
+
+        folder = tempfile.mkdtemp(prefix='backcast_{}_'.format(scale))
+
+        try:
+            info = generate_synthetic_country(folder, scale, seed)
+            results = configure_paths(folder)
+
+            for item in run_stages(country):
+                item.update({
+                    'scale': scale,
+                    'tiles': 100 * scale ** 2,
+                    'cells': info['cells'],
+                })
+                timings.append(item)
+                print('-- {}: {}s'.format(item['stage'], item['wall_s']))
+
+            check_coverage(results, country['iso3'])
+
+            path_results = os.path.join(results, country['iso3'], 'results.csv')
+            path_golden = os.path.join(GOLDEN,
+                '{}_scale_{}_seed_{}.csv'.format(country['iso3'], scale, seed))
+
+            if update_golden:
+                if not os.path.exists(GOLDEN):
+                    os.makedirs(GOLDEN)
+                shutil.copy(path_results, path_golden)
+                print('Updated golden results: {}'.format(path_golden))
+            elif os.path.exists(path_golden):
+                differences = compare_results(path_results, path_golden)
+                golden.append({
+                    'scale': scale,
+                    'matches': len(differences) == 0,
+                    'differences': '; '.join(differences),
+                })
+                print('Golden check at scale {}: {}'.format(
+                    scale, 'pass' if len(differences) == 0 else differences))
+
+        finally:
+            if keep:
+                print('Kept synthetic data in {}'.format(folder))
+            else:
+                shutil.rmtree(folder)
+
+    timings = pd.DataFrame(timings)
+    scaling = fit_scaling(timings)
+
+    if not os.path.exists(REPORTS):
+        os.makedirs(REPORTS)
+    stamp = time.strftime('%Y%m%d_%H%M%S')
+    timings.to_csv(os.path.join(REPORTS,
+        'benchmark_{}.csv'.format(stamp)), index=False)
+    scaling.to_csv(os.path.join(REPORTS,
+        'benchmark_scaling_{}.csv'.format(stamp)), index=False)
+    if len(golden) > 0:
+        pd.DataFrame(golden).to_csv(os.path.join(REPORTS,
+            'benchmark_golden_{}.csv'.format(stamp)), index=False)
+
+    print(scaling.to_string(index=False))
+
+    return timings, scaling, golden
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--update-golden', action='store_true')
+    parser.add_argument('--keep', action='store_true')
+    parser.add_argument('--check', nargs='?', const='MEX', default=None,
+        help='check a country against its stored results instead')
+    args = parser.parse_args()
+
+    if args.check:
+        country = {'iso3': args.check, 'gid_region': 2, 'regional_level': 2}
+        differences = check_golden(country)
+        if len(differences) == 0:
+            print('Results for {} match the golden results'.format(args.check))
+        else:
+            print('Results for {} differ: {}'.format(args.check, differences))
+    else:
+        run_benchmarks(args.scales, args.seed, args.update_golden, args.keep)
@@ -0,0 +1,309 @@
+"""
+Cluster co-located cells into physical sites.
+
+OpenCelliD lists one row per cell, so the sectors and radios mounted on
+the same mast appear as several records. Cells of the same operator
+(mcc, net) lying within `cluster_radius_m` of each other (set in the
+[sites] section of script_config.ini) are linked, and each connected
+group of cells is taken as one physical site.
+
+Linking neighbours alone (single linkage) would merge a chain of cells,
+each within the radius of the next, into one arbitrarily long site along
+dense urban corridors. Clusters spanning more than twice the radius are
+therefore re-split, each resulting site holding the cells within the
+radius of a seed cell.
+
+Neighbours are found by hashing the projected coordinates into square
+buckets one radius wide, so each cell is only compared with the cells in
+its own and the adjacent buckets, and the work grows linearly with the
+number of cells.
+
+October 2026
+
+"""
+import os
+import configparser
+import numpy as np
+import pandas as pd
+import pyproj
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+
+from layers import read_layer, CHUNK_ROWS
+from instrument import timed, count_records, export_report
+from preprocess import get_sites_path, read_sites, get_site_labels_path, order_radios
+from grid import get_tile_ids
+
+CONFIG = configparser.ConfigParser()
+CONFIG.read(os.path.join(os.path.dirname(__file__), 'script_config.ini'))
+BASE_PATH = CONFIG['file_locations']['base_path']
+
+DATA_PROCESSED = os.path.join(BASE_PATH, 'processed')
+
+RADIUS = CONFIG.getfloat('sites', 'cluster_radius_m', fallback=100)
+
+# bucket offsets compared with each bucket, covering each adjacent pair once
+OFFSETS = [(0, 0), (1, -1), (1, 0), (1, 1), (0, 1)]
+
+
+def get_clusters_path(iso3):
+    """
+    Return the path of the cell to site cluster table.
+
+    """
+    return os.path.join(DATA_PROCESSED, iso3, 'sites', 'site_clusters.parquet')
+
+
+def project_sites(lon, lat):
+    """
+    Project coordinates to EPSG:3857, returning x and y with the scale
+    factor converting projected distances to ground distances.
+
+    """
+    project = pyproj.Transformer.from_crs('EPSG:4326', 'EPSG:3857',
+        always_xy=True)
+
+    lat = np.clip(lat.astype('float64'), -85, 85)
+    x, y = project.transform(lon.astype('float64'), lat)
+
+    return x, y, np.cos(np.radians(lat))
+
+
+def find_neighbours(keys, x, y, scale, width, radius):
+    """
+    Return the pairs of points lying within the radius of each other.
+
+    Points must be sorted by bucket key. Each point is compared with the
+    points in its own bucket and the adjacent buckets given by OFFSETS,
+    processing CHUNK_ROWS points at a time to bound memory.
+
+    """
+    rows = []
+    cols = []
+
+    for dx, dy in OFFSETS:
+
+        offset = dy * width + dx
+
+        for start in range(0, len(keys), CHUNK_ROWS):
+
+            src = np.arange(start, min(start + CHUNK_ROWS, len(keys)))
+            lo = np.searchsorted(keys, keys[src] + offset, side='left')
+            hi = np.searchsorted(keys, keys[src] + offset, side='right')
+
+            if offset == 0:
+                lo = np.maximum(lo, src + 1)
+
+            counts = np.maximum(hi - lo, 0)
+            if counts.sum() == 0:
+                continue
+
+            first = np.repeat(src, counts)
+            steps = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            second = np.repeat(lo, counts) + steps
+
+            # projected distances are scaled to ground distances at the
+            # mean latitude of each pair
+            factor = (scale[first] + scale[second]) / 2
+            distance = np.hypot(x[first] - x[second], y[first] - y[second]) * factor
+
+            keep = distance <= radius
+            rows.append(first[keep])
+            cols.append(second[keep])
+
+    if len(rows) == 0:
+        return np.array([], dtype='int64'), np.array([], dtype='int64')
+
+    return np.concatenate(rows), np.concatenate(cols)
+
+
+def cluster_points(x, y, scale, groups, radius=RADIUS):
+    """
+    Assign each point to a cluster of points of the same group, linking
+    points within the radius of each other.
+
+    Parameters
+    ----------
+    x, y : array
+        Projected (EPSG:3857) coordinates.
+    scale : array
+        Factor converting projected to ground distances at each point.
+    groups : array
+        Integer group codes (e.g. operators); points of different groups
+        are never clustered together.
+    radius : float
+        Linking distance in meters.
+
+    """
+    n = len(x)
+    if n == 0:
+        return np.array([], dtype='int64')
+
+    # the bucket is one radius wide on the ground at the smallest scale
+    size = radius / max(scale.min(), 0.01)
+
+    bx = np.floor(x / size).astype('int64')
+    by = np.floor(y / size).astype('int64')
+    bx = bx - bx.min() + 1
+    by = by - by.min() + 1
+    width = int(bx.max()) + 2
+    height = int(by.max()) + 2
+
+    keys = (groups.astype('int64') * height + by) * width + bx
+
+    order = np.argsort(keys, kind='stable')
+    rows, cols = find_neighbours(keys[order], x[order], y[order],
+        scale[order], width, radius)
+
+    graph = sparse.coo_matrix(
+        (np.ones(len(rows), dtype='int8'), (rows, cols)), shape=(n, n))
+    count, labels = connected_components(graph, directed=False)
+    labels = split_chains(labels, x[order], y[order], scale[order], radius)
+
+    output = np.empty(n, dtype='int64')
+    output[order] = labels
+
+    return output
+
+
+def split_chains(labels, x, y, scale, radius):
+    """
+    Re-split clusters whose bounding box spans more than twice the
+    radius on the ground, capping the extent of a site.
+
+    The points of each such cluster are taken in order as seeds, each
+    seed claiming the unclaimed points of its cluster within the radius.
+
+    """
+    points = pd.DataFrame({'label': labels, 'x': x, 'y': y, 'scale': scale})
+    extent = points.groupby('label').agg(xmin=('x', 'min'), xmax=('x', 'max'),
+        ymin=('y', 'min'), ymax=('y', 'max'), scale=('scale', 'mean'))
+    span = np.hypot(extent['xmax'] - extent['xmin'],
+        extent['ymax'] - extent['ymin']) * extent['scale']
+
+    chains = extent.index[span.values > 2 * radius]
+    if len(chains) == 0:
+        return labels
+
+    output = labels.copy()
+    next_label = int(labels.max()) + 1
+
+    for label, idx in points[points['label'].isin(chains)].groupby('label').indices.items():
+
+        claimed = np.full(len(idx), -1, dtype='int64')
+
+        for i in range(len(idx)):
+
+            if claimed[i] >= 0:
+                continue
+
+            seed = idx[i]
+            factor = (scale[idx] + scale[seed]) / 2
+            distance = np.hypot(x[idx] - x[seed], y[idx] - y[seed]) * factor
+
+            claimed[(claimed < 0) & (distance <= radius)] = next_label
+            next_label += 1
+
+        output[idx] = claimed
+
+    return output
+
+
+@timed
+def cluster_sites(country, side_length_lower=10000):
+    """
+    Cluster the national cells into physical sites and count the sites
+    by radio for each region and each grid tile.
+
+    Cells at identical coordinates are collapsed before clustering. The
+    cluster table holds the site id (cluster) for each row of the
+    national sites table. A site is counted once for each radio it
+    carries, in the region of its first cell and the tile containing its
+    mean position.
+
+    """
+    iso3 = country['iso3']
+    level = int(country['gid_region'])
+
+    folder = os.path.join(DATA_PROCESSED, iso3, 'sites')
+
+    cells = read_sites(get_sites_path(iso3), ['radio', 'mcc', 'net', 'lon', 'lat'])
+    cells = cells.reset_index(drop=True)
+    count_records(len(cells))
+
+    operators = cells.groupby(['mcc', 'net']).ngroup().values
+
+    # collapse cells of the same operator at the same coordinates
+    unique = pd.DataFrame({'group': operators, 'lon': cells['lon'].values,
+        'lat': cells['lat'].values})
+    points = unique.drop_duplicates().reset_index(drop=True)
+    position = unique.merge(points.reset_index(), on=['group', 'lon', 'lat'],
+        how='left')['index'].values
+
+    x, y, scale = project_sites(points['lon'].values, points['lat'].values)
+    labels = cluster_points(x, y, scale, points['group'].values)
+
+    clusters = pd.DataFrame({
+        'site_id': np.arange(len(cells), dtype='int64'),
+        'cluster_id': labels[position],
+    })
+    clusters.to_parquet(get_clusters_path(iso3), index=False)
+
+    print('Clustered {} cells into {} sites'.format(len(cells),
+        clusters['cluster_id'].nunique()))
+
+    cells['cluster_id'] = clusters['cluster_id'].values
+    cells['radio'] = cells['radio'].astype(str).str.lower()
+
+    sites = cells.drop_duplicates(['cluster_id', 'radio'])[['cluster_id', 'radio']]
+
+    regions = read_layer(get_site_labels_path(iso3))
+    regions['cluster_id'] = cells['cluster_id'].values[regions['site_id'].values]
+    regions = regions.sort_values('site_id').drop_duplicates('cluster_id')
+
+    for i in range(1, level + 1):
+        gid = 'GID_{}'.format(i)
+        output = count_sites(sites.merge(regions[['cluster_id', gid]],
+            on='cluster_id'), gid)
+        output = output.rename(columns={gid: 'gid_id'})
+        output.insert(1, 'gid_level', gid)
+        filename = 'sites_by_region_gid_{}.csv'.format(i)
+        output.to_csv(os.path.join(folder, filename), index=False)
+
+    x, y, scale = project_sites(cells['lon'].values, cells['lat'].values)
+    centres = pd.DataFrame({'cluster_id': cells['cluster_id'].values, 'x': x, 'y': y})
+    centres = centres.groupby('cluster_id').mean().reset_index()
+    centres['GID_id'] = get_tile_ids(iso3, centres['x'].values,
+        centres['y'].values, side_length_lower)
+    centres = centres[centres['GID_id'].notnull()]
+
+    output = count_sites(sites.merge(centres[['cluster_id', 'GID_id']],
+        on='cluster_id'), 'GID_id')
+    output.to_csv(os.path.join(folder, 'sites_by_tile.csv'), index=False)
+
+    return
+
+
+def count_sites(sites, column):
+    """
+    Count the sites carrying each radio by the given column, with the
+    total number of sites.
+
+    """
+    output = order_radios(sites.groupby([column, 'radio']).size().unstack(fill_value=0))
+    output['sites'] = sites.groupby(column)['cluster_id'].nunique()
+
+    return output.reset_index()
+
+
+if __name__ == '__main__':
+
+    country = {
+        'iso3': 'MEX',
+        'gid_region': 2,
+    }
+
+    print('Clustering cells into sites')
+    cluster_sites(country)
+
+    export_report('clusters')
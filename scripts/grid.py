@@ -12,10 +12,15 @@ import pandas as pd
 import numpy as np
 import pyproj
 import geopandas as gpd
+import fiona
 from shapely.geometry import Polygon, Point 
 from shapely.ops import transform
 from tqdm import tqdm
 
+from layers import read_layer, is_chunked, iter_features
+from instrument import timed, count_records, export_report
+from spatial_index import query_bbox
+
 CONFIG = configparser.ConfigParser()
 CONFIG.read(os.path.join(os.path.dirname(__file__),'..', 'scripts', 'script_config.ini'))
 BASE_PATH = CONFIG['file_locations']['base_path']
@@ -24,7 +29,16 @@ DATA_RAW = os.path.join(BASE_PATH, '..', '..', 'data_raw')
 DATA_PROCESSED = os.path.join(BASE_PATH, 'processed')
 RESULTS = os.path.join(BASE_PATH, '..', 'results')
 
+ROAD_CLASSES = [
+    'motorway',
+    'primary',
+    'secondary',
+    'tertiary',
+    'trunk',
+]
+
 
+@timed
 def generate_grid(iso3, side_length):
     """
     Generate a spatial grid for the chosen country.
@@ -42,7 +56,7 @@ def generate_grid(iso3, side_length):
 
     filename = 'national_outline.shp'
     path = os.path.join(DATA_PROCESSED, iso3, filename)
-    country_outline = gpd.read_file(path, crs="epsg:4326")
+    country_outline = read_layer(path, crs="epsg:4326")
 
     country_outline.crs = "epsg:4326"
     country_outline_3857 = country_outline.to_crs("epsg:3857")
@@ -53,6 +67,8 @@ def generate_grid(iso3, side_length):
         xmin, ymin, xmax, ymax, side_length, side_length
     )
 
+    count_records(len(polygons))
+
     project = pyproj.Transformer.from_crs(
         'EPSG:3857', 'EPSG:4326', always_xy=True).transform
 
@@ -99,6 +115,145 @@ def manually_create_grid(xmin, ymin, xmax, ymax, length, wide):
     return polygons
 
 
+def get_grid_origin(iso3):
+    """
+    Return the EPSG:3857 origin (xmin, ymin) of the grids generated for
+    a country, as used by manually_create_grid.
+
+    """
+    filename = 'national_outline.shp'
+    path = os.path.join(DATA_PROCESSED, iso3, filename)
+    country_outline = read_layer(path, crs="epsg:4326")
+    country_outline.crs = "epsg:4326"
+
+    xmin, ymin, xmax, ymax = country_outline.to_crs("epsg:3857").total_bounds
+
+    return int(np.floor(xmin)), int(np.floor(ymin))
+
+
+def bin_coordinates(x, y, origin, side_length):
+    """
+    Return the column and row of the grid tile holding each EPSG:3857
+    coordinate.
+
+    Tiles of manually_create_grid span [x, x + side) and (y - side, y]
+    from their corner (x, y), so rows are found by rounding up.
+
+    """
+    x0, y0 = origin
+
+    i = np.floor((np.asarray(x) - x0) / side_length)
+    k = np.ceil((np.asarray(y) - y0) / side_length)
+
+    return i, k
+
+
+def get_tile_lookup(iso3, side_length, origin=None):
+    """
+    Return the grid column and row of each tile id, binning the
+    representative point each tile id is built from.
+
+    """
+    if origin is None:
+        origin = get_grid_origin(iso3)
+
+    filename = 'grid_{}_{}_km.shp'.format(side_length, side_length)
+    path = os.path.join(DATA_PROCESSED, iso3, 'grid', filename)
+    tiles = read_layer(path, ignore_geometry=True)[['GID_id']].drop_duplicates()
+
+    coords = tiles['GID_id'].str.split('_', expand=True).astype('float64')
+
+    project = pyproj.Transformer.from_crs(
+        'EPSG:4326', 'EPSG:3857', always_xy=True)
+    x, y = project.transform(coords[0].values, coords[1].values)
+
+    i, k = bin_coordinates(x, y, origin, side_length)
+    tiles['i'] = i.astype('int64')
+    tiles['k'] = k.astype('int64')
+
+    return tiles.drop_duplicates(['i', 'k']).reset_index(drop=True)
+
+
+def get_tile_ids(iso3, x, y, side_length, lookup=None):
+    """
+    Return the id of the grid tile holding each EPSG:3857 coordinate,
+    by integer binning on the regular grid rather than polygon tests.
+    Coordinates outside the grid are given None.
+
+    """
+    if lookup is None:
+        lookup = get_tile_lookup(iso3, side_length)
+
+    i, k = bin_coordinates(x, y, get_grid_origin(iso3), side_length)
+    valid = np.isfinite(i) & np.isfinite(k)
+
+    points = pd.DataFrame({
+        'i': np.where(valid, i, -1).astype('int64'),
+        'k': np.where(valid, k, -1).astype('int64'),
+    })
+    points = points.merge(lookup, on=['i', 'k'], how='left')
+
+    return points['GID_id'].where(points['GID_id'].notnull(), None).values
+
+
+def get_tile_adjacency(iso3, ids, side_length):
+    """
+    Return the neighbours of each tile as CSR arrays (indptr, indices),
+    where the neighbours of tile j are indices[indptr[j]:indptr[j + 1]].
+
+    Tiles are given by id, and neighbours are the (up to eight) tiles
+    sharing an edge or corner on the regular grid, found from the grid
+    column and row of each tile rather than by geometry.
+
+    """
+    lookup = get_tile_lookup(iso3, side_length).set_index('GID_id')
+
+    ids = pd.Index(ids)
+    position = lookup.index.get_indexer(ids)
+    known = position >= 0
+
+    i = np.full(len(ids), -1, dtype='int64')
+    k = np.full(len(ids), -1, dtype='int64')
+    i[known] = lookup['i'].values[position[known]]
+    k[known] = lookup['k'].values[position[known]]
+
+    tiles = np.flatnonzero(known)
+    if len(tiles) == 0:
+        return np.zeros(len(ids) + 1, dtype='int64'), np.array([], dtype='int64')
+
+    i = i - i[known].min() + 1
+    k = k - k[known].min() + 1
+    height = int(k[known].max()) + 2
+
+    keys = i[tiles] * height + k[tiles]
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    tiles = tiles[order]
+
+    rows = []
+    cols = []
+
+    for di in [-1, 0, 1]:
+        for dk in [-1, 0, 1]:
+            if di == 0 and dk == 0:
+                continue
+            found = np.searchsorted(keys, keys + di * height + dk)
+            found = np.minimum(found, len(keys) - 1)
+            match = keys[found] == keys + di * height + dk
+            rows.append(tiles[match])
+            cols.append(tiles[found[match]])
+
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+
+    order = np.lexsort((cols, rows))
+    indices = cols[order]
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=len(ids)))])
+
+    return indptr.astype('int64'), indices.astype('int64')
+
+
+@timed
 def export_specific_road_network(iso3):
     """
     Export road network. 
@@ -116,19 +271,18 @@ def export_specific_road_network(iso3):
     filename = 'gis_osm_roads_free_1.shp'
     folder = os.path.join(DATA_RAW, 'osm')
     path_in = os.path.join(folder, filename)
-    data = gpd.read_file(path_in, crs='epsg:4326')
+
+    if is_chunked():
+        return stream_road_network(path_in, path_out)
+
+    data = read_layer(path_in, crs='epsg:4326')
     data = data.to_dict('records')
+    count_records(len(data))
 
     output = []
 
     for item in data:
-        if item['fclass'] in [
-            'motorway',
-            'primary',
-            'secondary',
-            'tertiary',
-            'trunk',
-        ]:
+        if item['fclass'] in ROAD_CLASSES:
             output.append({
                 'geometry': item['geometry'],
                 'properties': {
@@ -145,7 +299,51 @@ def export_specific_road_network(iso3):
     return
 
 
-def segment_lower_into_upper_grid(country, side_length_lower, side_length_upper):
+def stream_road_network(path_in, path_out):
+    """
+    Export the road network by streaming the OSM layer through fiona,
+    so only one chunk of roads is held in memory at a time.
+
+    """
+    with fiona.open(path_in) as source:
+        schema = {
+            'geometry': source.schema['geometry'],
+            'properties': {
+                'osm_id': 'str',
+                'fclass': 'str',
+                'maxspeed': 'int',
+            },
+        }
+        crs = source.crs
+
+    with fiona.open(path_out, 'w', driver='ESRI Shapefile', crs=crs,
+            schema=schema) as sink:
+
+        for chunk in iter_features(path_in):
+
+            count_records(len(chunk))
+
+            output = []
+
+            for item in chunk:
+                properties = item['properties']
+                if properties['fclass'] in ROAD_CLASSES:
+                    output.append({
+                        'geometry': item['geometry'],
+                        'properties': {
+                            'osm_id': properties['osm_id'],
+                            'fclass': properties['fclass'],
+                            'maxspeed': properties['maxspeed'],
+                        }
+                    })
+
+            sink.writerecords(output)
+
+    return
+
+
+@timed
+def segment_lower_into_upper_grid(iso3, side_length_lower, side_length_upper):
     """
     Segment the lower into the upper grid. 
 
@@ -153,14 +351,15 @@ def segment_lower_into_upper_grid(country, side_length_lower, side_length_upper)
     directory = os.path.join(DATA_PROCESSED, iso3, 'grid')
     filename = 'grid_{}_{}_km.shp'.format(side_length_upper, side_length_upper)
     path_in = os.path.join(directory, filename)
-    grid_upper = gpd.read_file(path_in, crs='epsg:4326')
+    grid_upper = read_layer(path_in, crs='epsg:4326')
     grid_upper = grid_upper.to_dict('records')#[2:3]
 
     directory = os.path.join(DATA_PROCESSED, iso3, 'grid')
     filename = 'grid_{}_{}_km.shp'.format(side_length_lower, side_length_lower)
-    path_in = os.path.join(directory, filename)
-    grid_lower = gpd.read_file(path_in, crs='epsg:4326')
+    path_lower = os.path.join(directory, filename)
+    grid_lower = read_layer(path_lower, crs='epsg:4326')
     grid_lower = grid_lower.to_dict('records')
+    count_records(len(grid_lower))
 
     for tile_upper in grid_upper:
 
@@ -177,7 +376,9 @@ def segment_lower_into_upper_grid(country, side_length_lower, side_length_upper)
 
         output = []
 
-        for tile_lower in grid_lower:
+        for idx in query_bbox(path_lower, geom_upper.bounds):
+
+            tile_lower = grid_lower[idx]
 
             if geom_upper.intersects(tile_lower['geometry'].representative_point()):
                 output.append({
@@ -194,6 +395,7 @@ def segment_lower_into_upper_grid(country, side_length_lower, side_length_upper)
     return
 
 
+@timed
 def cut_roads_with_upper_grid(iso3, side_length_upper):
     """
     Cut roads with upper grid. 
@@ -203,8 +405,9 @@ def cut_roads_with_upper_grid(iso3, side_length_upper):
     # folder = os.path.join(DATA_RAW, 'osm')
     filename = 'road_network_processed.shp'
     folder = os.path.join(DATA_PROCESSED, iso3, 'infrastructure')
-    path_in = os.path.join(folder, filename)
-    roads_all = gpd.read_file(path_in, crs='epsg:4326')
+    path_roads = os.path.join(folder, filename)
+    roads_all = read_layer(path_roads, crs='epsg:4326')
+    count_records(len(roads_all))
 
     folder = os.path.join(DATA_PROCESSED, iso3, 'grid', 'grid_lower')
     filenames = os.listdir(folder)
@@ -229,11 +432,16 @@ def cut_roads_with_upper_grid(iso3, side_length_upper):
         if not os.path.exists(path_in):
             continue
 
-        grid = gpd.read_file(path_in, crs='epsg:4326')#[:5]
+        grid = read_layer(path_in, crs='epsg:4326')#[:5]
         grid['col1'] = 0
         grid = grid.dissolve("col1")
 
-        roads = gpd.overlay(roads_all, grid, how='intersection')
+        roads = roads_all.iloc[query_bbox(path_roads, grid.total_bounds)]
+
+        if len(roads) == 0:
+            continue
+
+        roads = gpd.overlay(roads, grid, how='intersection')
 
         if len(roads) == 0:
             continue
@@ -243,6 +451,7 @@ def cut_roads_with_upper_grid(iso3, side_length_upper):
     return
 
 
+@timed
 def segment_roads_to_lower(iso3, side_length_lower, side_length_upper):
     """
     Segment road network. 
@@ -259,13 +468,14 @@ def segment_roads_to_lower(iso3, side_length_lower, side_length_upper):
         path_in = os.path.join(directory, filename)
         if not os.path.exists(path_in):
             continue
-        road_network = gpd.read_file(path_in, crs='epsg:4326')
+        road_network = read_layer(path_in, crs='epsg:4326')
+        count_records(len(road_network))
 
         directory = os.path.join(DATA_PROCESSED, iso3, 'grid', 'grid_lower')
         path_in = os.path.join(directory, filename)
         if not os.path.exists(path_in):
             continue
-        grid_lower = gpd.read_file(path_in, crs='epsg:4326')
+        grid_lower = read_layer(path_in, crs='epsg:4326')
 
         road_network = gpd.overlay(road_network, grid_lower, how='intersection', keep_geom_type=True)
 
@@ -274,17 +484,20 @@ def segment_roads_to_lower(iso3, side_length_lower, side_length_upper):
 
         output = []
 
+        # the clipped roads only exist in memory, so are indexed in memory
+        sindex = gpd.GeoSeries([road['geometry'] for road in road_network]).sindex
+
         for tile_lower in grid_lower:
-            for road_tile in road_network:
-                if tile_lower['geometry'].intersects(road_tile['geometry']):
-                    output.append({
-                        'geometry': road_tile['geometry'],
-                        'properties':{
-                            'id_upper': filename.replace('.shp',''),
-                            'id_lower': tile_lower['GID_id'],
-                            'fclass': road_tile['fclass'],
-                        }
-                    })
+            for idx in sorted(sindex.query(tile_lower['geometry'], predicate='intersects')):
+                road_tile = road_network[idx]
+                output.append({
+                    'geometry': road_tile['geometry'],
+                    'properties':{
+                        'id_upper': filename.replace('.shp',''),
+                        'id_lower': tile_lower['GID_id'],
+                        'fclass': road_tile['fclass'],
+                    }
+                })
 
         output = gpd.GeoDataFrame.from_features(output, crs='epsg:4326')
 
@@ -298,7 +511,8 @@ def segment_roads_to_lower(iso3, side_length_lower, side_length_upper):
     return
 
 
-def export_road_network_metrics(country, side_length_lower):
+@timed
+def export_road_network_metrics(iso3, side_length_lower):
     """
     Export regional metrics. 
 
@@ -318,7 +532,8 @@ def export_road_network_metrics(country, side_length_lower):
         path_in = os.path.join(folder, filename)
         if not os.path.exists(path_in):
             continue
-        road_network = gpd.read_file(path_in, crs='epsg:4326')
+        road_network = read_layer(path_in, crs='epsg:4326')
+        count_records(len(road_network))
         road_network = road_network.to_crs(3857)
         road_network['length_km'] = road_network['geometry'].length / 1e3
         
@@ -394,7 +609,7 @@ if __name__ == "__main__":
         export_specific_road_network(iso3)
 
         ##Generate grids
-        generate_grid(iso3, side_length_lower) 
+        generate_grid(iso3, side_length_upper) 
         generate_grid(iso3, side_length_lower) 
 
         segment_lower_into_upper_grid(iso3, side_length_lower, side_length_upper)
@@ -403,4 +618,6 @@ if __name__ == "__main__":
 
         segment_roads_to_lower(iso3, side_length_lower, side_length_upper)
 
-        export_road_network_metrics(iso3, side_length_lower)
\ No newline at end of file
+        export_road_network_metrics(iso3, side_length_lower)
+
+    export_report('grid')
\ No newline at end of file
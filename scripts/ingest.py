@@ -0,0 +1,361 @@
+"""
+Apply a new OpenCelliD snapshot to existing national sites tables.
+
+Rather than rebuilding a country from scratch, the cells of the new
+snapshot are diffed against the stored sites table by cell key (mcc,
+cell). Only the inserted, updated and deleted cells are applied, the
+region labels are recomputed only for new and moved cells, and only the
+regional site layers of the regions holding inserted, deleted or
+changed cells are rewritten. Updates to columns not held in those
+layers (e.g. the timestamps and samples) only change the sites table. The cell
+counts are then refreshed and the pipeline manifest updated, so a
+following pipeline run only reruns the stages downstream of the sites.
+
+Usage:
+
+    python scripts/ingest.py MEX --iso2 MX --snapshot cell_towers_2023-01-24.csv
+
+The country options must match those the pipeline was run with. Once
+applied, towers_file in the [sites] section of script_config.ini is set
+to the new snapshot, so the pipeline takes it as the input of the
+ingested sites tables.
+
+October 2026
+
+"""
+import os
+import shutil
+import argparse
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+import preprocess
+import pipeline
+import batch
+from layers import read_layer
+from instrument import timed, count_records, export_report
+
+DATA_PROCESSED = preprocess.DATA_PROCESSED
+
+KEY_COLUMNS = ['mcc', 'cell']
+
+# stages brought up to date by an ingest, so are not rerun by the pipeline
+STAGES = [
+    'create_national_sites_csv',
+    'create_national_sites_shp',
+    'label_sites',
+    'segment_regions',
+    'export_cell_counts',
+]
+
+
+def read_table(path):
+    """
+    Read a sites table without the layer cache, as it is modified.
+
+    """
+    sites = pq.read_table(path).to_pandas()
+    sites['radio'] = sites['radio'].astype(str)
+
+    return sites.reset_index(drop=True)
+
+
+def diff_sites(old, new):
+    """
+    Compare two sites tables by cell key.
+
+    Returns the row positions in the old table of deleted cells, the
+    row positions in the old and new tables of updated cells (with flags
+    for cells which moved, and for cells changing a column held in the
+    regional site layers), and the row positions in the new table of
+    inserted cells.
+
+    """
+    merged = pd.merge(
+        old[KEY_COLUMNS].assign(old_row=np.arange(len(old))),
+        new[KEY_COLUMNS].assign(new_row=np.arange(len(new))),
+        on=KEY_COLUMNS, how='outer', indicator=True
+    )
+
+    deleted = merged.loc[merged['_merge'] == 'left_only', 'old_row'].astype('int64').values
+    inserted = merged.loc[merged['_merge'] == 'right_only', 'new_row'].astype('int64').values
+
+    both = merged[merged['_merge'] == 'both']
+    old_rows = both['old_row'].astype('int64').values
+    new_rows = both['new_row'].astype('int64').values
+
+    changed = np.zeros(len(both), dtype=bool)
+    moved = np.zeros(len(both), dtype=bool)
+    regional = np.zeros(len(both), dtype=bool)
+
+    for column in old.columns:
+
+        if column in KEY_COLUMNS:
+            continue
+
+        a = old[column].iloc[old_rows].reset_index(drop=True)
+        b = new[column].iloc[new_rows].reset_index(drop=True)
+        differs = (a.ne(b).fillna(True) & ~(a.isnull() & b.isnull())).values.astype(bool)
+
+        changed |= differs
+        if column in ['lon', 'lat']:
+            moved |= differs
+        if column in preprocess.SITE_COLUMNS:
+            regional |= differs
+
+    return (np.sort(deleted), old_rows[changed], new_rows[changed],
+        moved[changed], regional[changed], np.sort(inserted))
+
+
+def get_regions(labels, rows, level):
+    """
+    Return the GID_1 and GID_2 regions holding the given sites.
+
+    """
+    labels = labels[labels['site_id'].isin(rows)]
+
+    gid_1 = set(labels['GID_1'].dropna())
+    gid_2 = set(labels['GID_2'].dropna()) if level >= 2 else set()
+
+    return gid_1, gid_2
+
+
+def refresh_regions(iso3, gid_1, gid_2):
+    """
+    Rewrite the regional site layers of the given regions.
+
+    """
+    folder = os.path.join(DATA_PROCESSED, iso3, 'sites')
+
+    for level, regions in [(1, gid_1), (2, gid_2)]:
+        for region in regions:
+            for subfolder in ['interim', '']:
+                path = os.path.join(folder, 'gid_{}'.format(level), subfolder,
+                    '{}.csv'.format(region))
+                if os.path.exists(path):
+                    os.remove(path)
+
+    for region in sorted(gid_1):
+        preprocess.segment_by_gid_1(iso3, 1, region)
+        preprocess.create_regional_sites_layer(iso3, 1, region)
+
+    for region in sorted(gid_2):
+        preprocess.segment_by_gid_2(iso3, 2, region, preprocess.get_gid_1(region))
+        preprocess.create_regional_sites_layer(iso3, 2, region)
+
+    return
+
+
+def set_towers_file(towers_file):
+    """
+    Set towers_file in the [sites] section of script_config.ini, keeping
+    the rest of the file (and its comments) as it is.
+
+    """
+    path = os.path.join(os.path.dirname(__file__), 'script_config.ini')
+    with open(path, 'r') as source:
+        lines = source.readlines()
+
+    line = 'towers_file = {}\n'.format(towers_file)
+    section = None
+    header = None
+
+    for idx, text in enumerate(lines):
+        text = text.strip()
+        if text.startswith('[') and text.endswith(']'):
+            section = text[1:-1].strip()
+            if section == 'sites':
+                header = idx
+        elif section == 'sites' and text.split('=')[0].strip() == 'towers_file':
+            lines[idx] = line
+            break
+    else:
+        if header is None:
+            lines = lines + ['\n[sites]\n\n']
+            header = len(lines) - 1
+        lines.insert(header + 1, line)
+
+    with open(path + '.tmp', 'w') as sink:
+        sink.writelines(lines)
+    os.replace(path + '.tmp', path)
+
+    preprocess.TOWERS_FILE = towers_file
+
+    return
+
+
+def apply_changes(country, old, new):
+    """
+    Apply the differences between the stored and new sites tables,
+    refreshing the site labels, the affected regional site layers and
+    the cell counts.
+
+    """
+    iso3 = country['iso3']
+    level = int(country['gid_region'])
+
+    path_sites = preprocess.get_sites_path(iso3)
+    schema = preprocess.get_sites_schema()
+
+    deleted, old_rows, new_rows, moved, regional, inserted = diff_sites(old, new)
+
+    print('{} inserts, {} updates ({} to the regional site layers) and {} '
+        'deletes'.format(len(inserted), len(old_rows), regional.sum(), len(deleted)))
+
+    if len(deleted) + len(old_rows) + len(inserted) == 0:
+        return
+
+    # updated cells keep their place, deleted cells are dropped and
+    # inserted cells are appended, so site ids change as little as possible
+    output = old.copy()
+    for column in output.columns:
+        values = output[column].to_numpy(copy=True)
+        values[old_rows] = new[column].to_numpy()[new_rows]
+        output[column] = values
+
+    keep = np.ones(len(old), dtype=bool)
+    keep[deleted] = False
+    site_ids = np.cumsum(keep) - 1
+
+    output = pd.concat([output[keep], new.iloc[inserted]], ignore_index=True)
+
+    path_labels = preprocess.get_site_labels_path(iso3)
+    labels = read_layer(path_labels)
+
+    # updates to other columns (e.g. the timestamps and samples) are only
+    # written to the sites table, leaving the regional layers untouched
+    affected = old_rows[moved]
+    gid_1, gid_2 = get_regions(labels,
+        np.concatenate([deleted, old_rows[regional]]), level)
+
+    unchanged = labels[keep[labels['site_id'].values] &
+        ~np.isin(labels['site_id'].values, affected)].copy()
+    unchanged['site_id'] = site_ids[unchanged['site_id'].values]
+
+    relabel = np.concatenate([site_ids[affected],
+        np.arange(keep.sum(), len(output), dtype='int64')])
+
+    filename = 'regions_{}_{}.shp'.format(level, iso3)
+    path_regions = os.path.join(DATA_PROCESSED, iso3, 'regions', filename)
+    gid_levels = ['GID_{}'.format(i) for i in range(1, level + 1)]
+    regions = read_layer(path_regions, crs='epsg:4326')[gid_levels + ['geometry']]
+
+    relabelled = preprocess.label_points(relabel,
+        output['lon'].values[relabel], output['lat'].values[relabel], regions)
+
+    labels = pd.concat([unchanged, relabelled], ignore_index=True)
+    labels = labels.sort_values('site_id').reset_index(drop=True)
+
+    updated = site_ids[old_rows[regional]]
+    added_1, added_2 = get_regions(labels,
+        np.concatenate([updated, relabel]), level)
+    gid_1 = gid_1 | added_1
+    gid_2 = gid_2 | added_2
+
+    path_interim = path_sites + '.{}'.format(os.getpid())
+    pq.write_table(preprocess.get_sites_table(output, schema), path_interim)
+    os.replace(path_interim, path_sites)
+    labels.to_parquet(path_labels, index=False)
+
+    print('Refreshing {} GID_1 and {} GID_2 regions'.format(len(gid_1), len(gid_2)))
+    refresh_regions(iso3, gid_1, gid_2)
+
+    if len(deleted) + regional.sum() + len(inserted) > 0:
+        path_points = os.path.join(DATA_PROCESSED, iso3, 'sites',
+            '{}.gpkg'.format(iso3))
+        if os.path.exists(path_points):
+            os.remove(path_points)
+        preprocess.create_national_sites_shp(iso3)
+
+    preprocess.export_cell_counts(country)
+
+    return
+
+
+@timed
+def ingest_snapshot(country, towers_file):
+    """
+    Apply the cells of a new tower snapshot to a country's sites table.
+
+    The snapshot is then set as towers_file in script_config.ini and
+    recorded as the input of the sites stages in the pipeline manifest,
+    so the pipeline takes the ingested tables as up to date.
+
+    Parameters
+    ----------
+    country : dict
+        Contains all desired country information, as given to the
+        pipeline.
+    towers_file : string
+        Tower csv of the new snapshot, in data_raw.
+
+    """
+    iso3 = country['iso3']
+
+    path_sites = preprocess.get_sites_path(iso3)
+    schema = preprocess.get_sites_schema()
+
+    if not pq.read_schema(path_sites).names == schema.names:
+        raise ValueError('{} does not match the configured sites schema: '
+            'rebuild it with create_national_sites_csv'.format(path_sites))
+
+    folder = os.path.join(DATA_PROCESSED, iso3, 'sites', 'staging')
+    path_staging = os.path.join(folder, '{}.parquet'.format(iso3))
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+
+    try:
+        print('Extracting {} cells from {}'.format(iso3, towers_file))
+        preprocess.extract_national_sites([country], towers_file,
+            {iso3: path_staging})
+
+        old = read_table(path_sites)
+        if os.path.exists(path_staging):
+            new = read_table(path_staging)
+        else:
+            new = old.iloc[:0]
+        count_records(len(new))
+
+        apply_changes(country, old, new)
+
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    set_towers_file(towers_file)
+
+    pipeline.mark_complete(country, STAGES)
+
+    return
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('iso3', help='country ISO3 code')
+    parser.add_argument('--snapshot', required=True,
+        help='tower csv of the new snapshot, in data_raw')
+    parser.add_argument('--iso2', default=None,
+        help='country ISO2 code (looked up in countries.csv if not given)')
+    parser.add_argument('--gid-region', type=int, default=None)
+    args = parser.parse_args()
+
+    # the country must match the one given to the pipeline, as it is
+    # hashed into the stage keys
+    if args.iso2 is None:
+        countries = batch.get_countries([args.iso3], args.gid_region)
+        if len(countries) == 0:
+            raise SystemExit('Unknown country: {}'.format(args.iso3))
+        country = countries[0]
+    else:
+        level = args.gid_region if args.gid_region is not None else 2
+        country = {
+            'iso3': args.iso3,
+            'iso2': args.iso2,
+            'gid_region': level,
+            'regional_level': level,
+        }
+
+    ingest_snapshot(country, args.snapshot)
+
+    export_report('ingest')
@@ -0,0 +1,318 @@
+"""
+Record timing, memory and throughput for each pipeline stage.
+
+Functions decorated with `timed` record their wall time, CPU time, peak
+resident memory and (where reported via `count_records`) the number of
+records processed. The collected calls can be exported as a JSON and
+CSV run report.
+
+A single stage can be profiled with cProfile or tracemalloc by setting
+`profile_stage` in script_config.ini, or the BACKCAST_PROFILE_STAGE and
+BACKCAST_PROFILE_MODE environment variables.
+
+October 2026
+
+"""
+import os
+import csv
+import json
+import time
+import pstats
+import cProfile
+import functools
+import threading
+import tracemalloc
+import configparser
+
+import psutil
+
+CONFIG = configparser.ConfigParser()
+CONFIG.read(os.path.join(os.path.dirname(__file__), 'script_config.ini'))
+BASE_PATH = CONFIG['file_locations']['base_path']
+
+REPORTS = os.path.join(BASE_PATH, '..', 'reports')
+
+SAMPLE_INTERVAL = 0.05
+
+RUN_REPORT = []
+ACTIVE = []
+LOCK = threading.Lock()
+SAMPLER = {}
+
+
+def get_setting(key, default=''):
+    """
+    Get an instrumentation setting, allowing environment overrides.
+
+    """
+    env = os.environ.get('BACKCAST_{}'.format(key.upper()))
+    if env is not None:
+        return env
+
+    if CONFIG.has_option('instrumentation', key):
+        return CONFIG['instrumentation'][key]
+
+    return default
+
+
+def get_rss():
+    """
+    Return the resident memory of the current process in bytes.
+
+    """
+    return psutil.Process(os.getpid()).memory_info().rss
+
+
+def sample_memory(stop):
+    """
+    Update the peak memory of every active stage until stopped.
+
+    """
+    while not stop.wait(SAMPLE_INTERVAL):
+        update_peak()
+
+    return
+
+
+def update_peak():
+    """
+    Record the current memory against all active stages.
+
+    """
+    rss = get_rss()
+
+    with LOCK:
+        for record in ACTIVE:
+            if rss > record['peak_rss']:
+                record['peak_rss'] = rss
+
+    return
+
+
+def start_sampler():
+    """
+    Start the background memory sampler, if not already running in
+    this process.
+
+    """
+    if SAMPLER.get('pid') == os.getpid():
+        return
+
+    stop = threading.Event()
+    thread = threading.Thread(target=sample_memory, args=(stop,), daemon=True)
+    thread.start()
+
+    SAMPLER.update({'pid': os.getpid(), 'stop': stop, 'thread': thread})
+
+    return
+
+
+def count_records(count):
+    """
+    Report the number of records processed by the innermost active stage.
+
+    """
+    with LOCK:
+        if len(ACTIVE) > 0:
+            record = ACTIVE[-1]
+            record['records'] = (record['records'] or 0) + int(count)
+
+    return
+
+
+def get_profile_mode(stage, module):
+    """
+    Return the profiler to use for a stage, if it was selected.
+
+    """
+    selected = get_setting('profile_stage')
+
+    if not selected:
+        return None
+
+    if not selected in [stage, '{}.{}'.format(module, stage)]:
+        return None
+
+    return get_setting('profile_mode', 'cprofile').lower()
+
+
+def write_profile(profiler, mode, stage):
+    """
+    Write the cProfile stats or tracemalloc snapshot for a stage.
+
+    """
+    if not os.path.exists(REPORTS):
+        os.makedirs(REPORTS)
+
+    stamp = time.strftime('%Y%m%d_%H%M%S')
+    path = os.path.join(REPORTS, '{}_{}'.format(stage, stamp))
+
+    if mode == 'tracemalloc':
+        profiler.dump(path + '.tracemalloc')
+        with open(path + '_tracemalloc.txt', 'w') as sink:
+            for stat in profiler.statistics('lineno')[:50]:
+                sink.write('{}\n'.format(stat))
+    else:
+        profiler.dump_stats(path + '.prof')
+        with open(path + '_cprofile.txt', 'w') as sink:
+            stats = pstats.Stats(profiler, stream=sink)
+            stats.sort_stats('cumulative').print_stats(50)
+
+    print('Wrote {} profile to {}'.format(mode, path))
+
+    return
+
+
+def timed(function):
+    """
+    Decorator recording the resources used by a pipeline function.
+
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+
+        start_sampler()
+
+        record = {
+            'stage': function.__name__,
+            'module': function.__module__,
+            'pid': os.getpid(),
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'records': None,
+            'peak_rss': get_rss(),
+        }
+
+        mode = get_profile_mode(record['stage'], record['module'])
+        profiler = None
+        if mode == 'tracemalloc':
+            tracemalloc.start()
+        elif mode is not None:
+            profiler = cProfile.Profile()
+
+        with LOCK:
+            ACTIVE.append(record)
+
+        wall = time.perf_counter()
+        cpu = time.process_time()
+
+        try:
+            if profiler is not None:
+                return profiler.runcall(function, *args, **kwargs)
+            return function(*args, **kwargs)
+
+        finally:
+            record['wall_s'] = time.perf_counter() - wall
+            record['cpu_s'] = time.process_time() - cpu
+
+            update_peak()
+            with LOCK:
+                ACTIVE.remove(record)
+
+            record['peak_rss_mb'] = round(record.pop('peak_rss') / 1e6, 1)
+            if record['records'] and record['wall_s'] > 0:
+                record['records_per_s'] = record['records'] / record['wall_s']
+            else:
+                record['records_per_s'] = None
+
+            RUN_REPORT.append(record)
+
+            if mode == 'tracemalloc':
+                snapshot = tracemalloc.take_snapshot()
+                tracemalloc.stop()
+                write_profile(snapshot, mode, record['stage'])
+            elif profiler is not None:
+                write_profile(profiler, mode, record['stage'])
+
+    return wrapper
+
+
+def get_report():
+    """
+    Return the calls recorded in this process.
+
+    """
+    return list(RUN_REPORT)
+
+
+def reset_report():
+    """
+    Clear the calls recorded in this process.
+
+    """
+    del RUN_REPORT[:]
+
+    return
+
+
+def summarize_report(calls):
+    """
+    Summarize recorded calls by stage.
+
+    """
+    output = {}
+
+    for call in calls:
+        key = (call['module'], call['stage'])
+        if not key in output:
+            output[key] = {
+                'module': call['module'],
+                'stage': call['stage'],
+                'calls': 0,
+                'wall_s': 0,
+                'cpu_s': 0,
+                'peak_rss_mb': 0,
+                'records': None,
+            }
+        item = output[key]
+        item['calls'] += 1
+        item['wall_s'] += call['wall_s']
+        item['cpu_s'] += call['cpu_s']
+        item['peak_rss_mb'] = max(item['peak_rss_mb'], call['peak_rss_mb'])
+        if call['records'] is not None:
+            item['records'] = (item['records'] or 0) + call['records']
+
+    output = list(output.values())
+
+    for item in output:
+        item['wall_s'] = round(item['wall_s'], 3)
+        item['cpu_s'] = round(item['cpu_s'], 3)
+        if item['records'] and item['wall_s'] > 0:
+            item['records_per_s'] = round(item['records'] / item['wall_s'], 1)
+        else:
+            item['records_per_s'] = None
+
+    return output
+
+
+def export_report(name, calls=None):
+    """
+    Export the run report as JSON (all calls plus a per stage summary)
+    and CSV (per stage summary).
+
+    """
+    if calls is None:
+        calls = get_report()
+
+    if len(calls) == 0:
+        return
+
+    if not os.path.exists(REPORTS):
+        os.makedirs(REPORTS)
+
+    summary = summarize_report(calls)
+
+    stamp = time.strftime('%Y%m%d_%H%M%S')
+    path = os.path.join(REPORTS, '{}_{}'.format(name, stamp))
+
+    with open(path + '.json', 'w') as sink:
+        json.dump({'name': name, 'summary': summary, 'calls': calls},
+            sink, indent=1)
+
+    with open(path + '.csv', 'w', newline='') as sink:
+        writer = csv.DictWriter(sink, fieldnames=list(summary[0].keys()))
+        writer.writeheader()
+        writer.writerows(summary)
+
+    print('Wrote run report to {}'.format(path + '.json'))
+
+    return path
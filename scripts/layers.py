@@ -0,0 +1,236 @@
+"""
+In-process cache for layers read by the scripts.
+
+Layers are keyed by path, read options and the file modification time,
+so a rewritten file is always reread. The cache holds up to the memory
+budget set in the [cache] section of script_config.ini, evicting the
+least recently used layers first.
+
+Layers loaded with `preload` before a process pool is forked are shared
+with the workers, which read them without copying.
+
+For countries too large to hold in memory, setting `mode = chunked` in
+the [processing] section (or BACKCAST_PROCESSING_MODE=chunked) makes the
+scripts stream layers in chunks of `chunk_rows` via `iter_chunks` and
+`iter_features`, writing partial results to disk as they go.
+
+October 2026
+
+"""
+import os
+import configparser
+from collections import OrderedDict
+import pandas as pd
+import fiona
+import geopandas as gpd
+import pyarrow.parquet as pq
+
+CONFIG = configparser.ConfigParser()
+CONFIG.read(os.path.join(os.path.dirname(__file__), 'script_config.ini'))
+
+ENABLED = CONFIG.getboolean('cache', 'enabled', fallback=True)
+MAX_MEMORY = CONFIG.getfloat('cache', 'max_memory_mb', fallback=2048) * 1e6
+
+CHUNK_ROWS = CONFIG.getint('processing', 'chunk_rows', fallback=500000)
+
+CACHE = OrderedDict()
+PINNED = set()
+STATS = {'hits': 0, 'misses': 0, 'evictions': 0, 'bytes': 0}
+
+
+def get_key(path, kwargs):
+    """
+    Return the cache key and the file version for a layer.
+
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    key = (path, tuple(sorted((k, repr(v)) for k, v in kwargs.items())))
+
+    return key, (stat.st_mtime_ns, stat.st_size)
+
+
+def load_layer(path, **kwargs):
+    """
+    Read a layer from disk: csv files and parquet tables without
+    geometry as dataframes, and anything else as geodataframes.
+
+    """
+    if path.endswith('.csv'):
+        return pd.read_csv(path, **kwargs)
+
+    if path.endswith('.parquet'):
+        metadata = pq.read_schema(path).metadata or {}
+        if not b'geo' in metadata:
+            return pq.read_table(path, **kwargs).to_pandas()
+        return gpd.read_parquet(path, **kwargs)
+
+    return gpd.read_file(path, **kwargs)
+
+
+def estimate_size(data):
+    """
+    Estimate the memory held by a layer in bytes.
+
+    """
+    size = 0
+
+    for column in data.columns:
+        if isinstance(data, gpd.GeoDataFrame) and column == data.geometry.name:
+            size += sum(len(geom.wkb) for geom in data[column] if geom is not None)
+        else:
+            size += data[column].memory_usage(index=False, deep=True)
+
+    return size + data.index.memory_usage(deep=True)
+
+
+def read_layer(path, **kwargs):
+    """
+    Read a layer, using the cached copy when the file is unchanged.
+
+    A shallow copy is returned, so callers may add or replace columns,
+    but must not modify values in place.
+
+    """
+    if not ENABLED:
+        return load_layer(path, **kwargs)
+
+    key, version = get_key(path, kwargs)
+
+    if key in CACHE and CACHE[key][0] == version:
+        CACHE.move_to_end(key)
+        STATS['hits'] += 1
+        return CACHE[key][1].copy(deep=False)
+
+    if key in CACHE:
+        STATS['bytes'] -= CACHE.pop(key)[2]
+
+    STATS['misses'] += 1
+
+    data = load_layer(path, **kwargs)
+    size = estimate_size(data)
+
+    if size <= MAX_MEMORY:
+        CACHE[key] = (version, data, size)
+        STATS['bytes'] += size
+        evict()
+
+    return data.copy(deep=False)
+
+
+def evict():
+    """
+    Evict the least recently used layers (other than pinned layers)
+    until the cache is within the memory budget.
+
+    """
+    for key in list(CACHE.keys()):
+        if STATS['bytes'] <= MAX_MEMORY:
+            break
+        if key in PINNED:
+            continue
+        STATS['bytes'] -= CACHE.pop(key)[2]
+        STATS['evictions'] += 1
+
+    return
+
+
+def preload(paths, pin=False):
+    """
+    Load layers into the cache, e.g. before forking worker processes.
+
+    Pinned layers are kept regardless of the memory budget, and are
+    never evicted.
+
+    """
+    for path in paths:
+
+        if not os.path.exists(path):
+            continue
+
+        key, version = get_key(path, {})
+
+        if pin:
+            PINNED.add(key)
+            if not (key in CACHE and CACHE[key][0] == version):
+                data = load_layer(path)
+                CACHE[key] = (version, data, estimate_size(data))
+                STATS['bytes'] += CACHE[key][2]
+                STATS['misses'] += 1
+        else:
+            read_layer(path)
+
+    return
+
+
+def clear_cache():
+    """
+    Empty the cache.
+
+    """
+    CACHE.clear()
+    PINNED.clear()
+    STATS['bytes'] = 0
+
+    return
+
+
+def is_chunked():
+    """
+    Return True when running in the out-of-core, chunked mode.
+
+    """
+    mode = os.environ.get('BACKCAST_PROCESSING_MODE',
+        CONFIG.get('processing', 'mode', fallback='memory'))
+
+    return mode.lower() == 'chunked'
+
+
+def iter_chunks(path, columns=None, chunk_rows=CHUNK_ROWS):
+    """
+    Read a layer in chunks of rows, without holding it all in memory.
+
+    Chunks of csv and parquet tables are dataframes, and chunks of
+    other layers are geodataframes.
+
+    """
+    if path.endswith('.csv'):
+        for chunk in pd.read_csv(path, usecols=columns, chunksize=chunk_rows):
+            yield chunk
+
+    elif path.endswith('.parquet'):
+        parquet = pq.ParquetFile(path)
+        for batch in parquet.iter_batches(batch_size=chunk_rows, columns=columns):
+            yield batch.to_pandas()
+
+    else:
+        with fiona.open(path) as source:
+            n = len(source)
+        for start in range(0, n, chunk_rows):
+            chunk = gpd.read_file(path, rows=slice(start, start + chunk_rows))
+            if columns is not None:
+                chunk = chunk[columns]
+            yield chunk
+
+    return
+
+
+def iter_features(path, chunk_rows=CHUNK_ROWS):
+    """
+    Stream the features of a vector layer in lists of chunk_rows.
+
+    """
+    with fiona.open(path) as source:
+
+        chunk = []
+
+        for feature in source:
+            chunk.append(feature)
+            if len(chunk) >= chunk_rows:
+                yield chunk
+                chunk = []
+
+        if len(chunk) > 0:
+            yield chunk
+
+    return
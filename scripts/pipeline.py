@@ -0,0 +1,797 @@
+"""
+Run the full backcast pipeline as a resumable stage graph.
+
+Each stage declares the files it reads and writes. A stage is only rerun
+when the content hash of its inputs, its parameters or its code (the
+source of its module and of every script module it imports, directly
+or indirectly) change, or when one of its outputs is missing. Stages without outstanding
+dependencies are run concurrently.
+
+October 2026
+
+"""
+import os
+import ast
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import importlib
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import preprocess
+import pop
+import grid
+import process
+import weights
+import clusters
+import validate
+from instrument import get_report, reset_report, export_report
+from spatial_index import INDEX_FOLDER
+
+DATA_RAW = preprocess.DATA_RAW
+DATA_PROCESSED = preprocess.DATA_PROCESSED
+RESULTS = process.RESULTS
+
+SHP_EXTENSIONS = ['.shp', '.shx', '.dbf', '.prj', '.cpg']
+
+
+def get_stages(country, side_length_upper=100000, side_length_lower=10000):
+    """
+    Declare the pipeline stages for a country.
+
+    Each stage is a dict holding the module and function to call, the
+    arguments to call it with, and the paths it reads and writes.
+    Dependencies between stages are derived from these paths.
+
+    """
+    iso3 = country['iso3']
+    level = int(country['gid_region'])
+
+    folder = os.path.join(DATA_PROCESSED, iso3)
+    gadm = os.path.join(DATA_RAW, 'gadm36_levels_shp')
+    sites_table = os.path.join(folder, 'sites', '{}.parquet'.format(iso3))
+    site_labels = os.path.join(folder, 'sites', 'site_regions.parquet')
+    tile_counts = os.path.join(folder, 'sites', 'cells_by_tile.csv')
+    operators = [
+        path for path in [os.path.join(DATA_PROCESSED, '..', 'raw', 'operators.csv')]
+        if os.path.exists(path)
+    ]
+    outline = os.path.join(folder, 'national_outline.shp')
+    regions = [
+        os.path.join(folder, 'regions', 'regions_{}_{}.shp'.format(i, iso3))
+        for i in range(1, level + 1)
+    ]
+    settlements = os.path.join(folder, 'population', 'settlements.tif')
+    grid_upper = os.path.join(folder, 'grid',
+        'grid_{}_{}_km.shp'.format(side_length_upper, side_length_upper))
+    grid_lower = os.path.join(folder, 'grid',
+        'grid_{}_{}_km.shp'.format(side_length_lower, side_length_lower))
+    grid_lower_folder = os.path.join(folder, 'grid', 'grid_lower')
+    roads = os.path.join(folder, 'infrastructure', 'road_network_processed.shp')
+    roads_upper = os.path.join(folder, 'infrastructure',
+        'grid_{}'.format(side_length_upper))
+    roads_lower = os.path.join(folder, 'infrastructure',
+        'grid_{}'.format(side_length_lower))
+    technologies = ['2G', '3G', '4G']
+    mce = os.path.join(DATA_RAW, 'Mobile Coverage Explorer v2020 - GeoTIFF',
+        'ByCountry')
+    by_radio = os.path.join(RESULTS, iso3, 'by_radio')
+
+    stages = [
+        {
+            'name': 'create_national_sites_csv',
+            'module': 'preprocess',
+            'args': [country],
+            'inputs': [
+                os.path.join(DATA_RAW, 'mobile_codes.csv'),
+                os.path.join(DATA_RAW, preprocess.TOWERS_FILE),
+            ],
+            'outputs': [sites_table],
+        },
+        {
+            'name': 'process_country_shapes',
+            'module': 'preprocess',
+            'args': [iso3],
+            'inputs': [
+                os.path.join(gadm, 'gadm36_0.shp'),
+                os.path.join(DATA_RAW, 'countries.csv'),
+            ],
+            'outputs': [outline],
+        },
+        {
+            'name': 'process_regions',
+            'module': 'preprocess',
+            'args': [iso3, level],
+            'inputs': [
+                os.path.join(gadm, 'gadm36_{}.shp'.format(i))
+                for i in range(1, level + 1)
+            ],
+            'outputs': regions,
+        },
+        {
+            'name': 'create_national_sites_shp',
+            'module': 'preprocess',
+            'args': [iso3],
+            'inputs': [sites_table],
+            'outputs': [os.path.join(folder, 'sites', '{}.gpkg'.format(iso3))],
+        },
+        {
+            'name': 'segment_regions',
+            'module': 'preprocess',
+            'args': [country],
+            'inputs': [sites_table] + regions,
+            'outputs': [
+                os.path.join(folder, 'sites', 'gid_1'),
+                os.path.join(folder, 'sites', 'gid_2'),
+            ],
+        },
+        {
+            'name': 'label_sites',
+            'module': 'preprocess',
+            'args': [country],
+            'inputs': [sites_table, regions[-1]],
+            'outputs': [site_labels],
+        },
+        {
+            'name': 'export_cell_counts',
+            'module': 'preprocess',
+            'args': [country],
+            'inputs': [sites_table, site_labels],
+            'outputs': [os.path.join(folder, 'sites', 'cells_by_region.csv')] + [
+                os.path.join(folder, 'sites',
+                    'cells_by_region_gid_{}_{}.csv'.format(i, shape))
+                for i in range(1, level + 1) for shape in ['long', 'wide']
+            ],
+        },
+        {
+            'name': 'process_regional_coverage',
+            'module': 'preprocess',
+            'args': [country],
+            'inputs': [
+                os.path.join(mce, 'MCE_{}'.format(tech),
+                    'MCE_{}{}_2020.tif'.format(country['iso2'], tech))
+                for tech in technologies
+            ] + [regions[-1]],
+            'outputs': [
+                os.path.join(folder, 'coverage', 'coverage_{}_tifs'.format(tech))
+                for tech in technologies
+            ],
+        },
+        {
+            'name': 'convert_regional_coverage_to_shapes',
+            'module': 'preprocess',
+            'args': [country],
+            'inputs': [
+                os.path.join(folder, 'coverage', 'coverage_{}_tifs'.format(tech))
+                for tech in technologies
+            ],
+            'outputs': [
+                os.path.join(folder, 'coverage', 'coverage_{}_shps'.format(tech))
+                for tech in technologies
+            ],
+        },
+        {
+            'name': 'process_settlement_layer',
+            'module': 'pop',
+            'args': [country],
+            'inputs': [
+                os.path.join(DATA_RAW, 'settlement_layer',
+                    'ppp_2020_1km_Aggregated.tif'),
+                outline,
+            ],
+            'outputs': [settlements],
+        },
+        {
+            'name': 'generate_population',
+            'module': 'pop',
+            'args': [country],
+            'inputs': [settlements, outline, regions[-1]],
+            'outputs': [os.path.join(folder, 'population', 'population.csv')],
+        },
+        {
+            'name': 'export_specific_road_network',
+            'module': 'grid',
+            'args': [iso3],
+            'inputs': [os.path.join(DATA_RAW, 'osm', 'gis_osm_roads_free_1.shp')],
+            'outputs': [roads],
+        },
+        {
+            'name': 'generate_grid_upper',
+            'module': 'grid',
+            'function': 'generate_grid',
+            'args': [iso3, side_length_upper],
+            'inputs': [outline],
+            'outputs': [grid_upper],
+        },
+        {
+            'name': 'generate_grid_lower',
+            'module': 'grid',
+            'function': 'generate_grid',
+            'args': [iso3, side_length_lower],
+            'inputs': [outline],
+            'outputs': [grid_lower],
+        },
+        {
+            'name': 'export_tile_cell_counts',
+            'module': 'preprocess',
+            'args': [country, side_length_lower],
+            'inputs': [sites_table, outline, grid_lower],
+            'outputs': [tile_counts],
+        },
+        {
+            'name': 'cluster_sites',
+            'module': 'clusters',
+            'args': [country, side_length_lower],
+            'inputs': [sites_table, site_labels, outline, grid_lower],
+            'outputs': [
+                os.path.join(folder, 'sites', 'site_clusters.parquet'),
+                os.path.join(folder, 'sites', 'sites_by_tile.csv'),
+            ] + [
+                os.path.join(folder, 'sites', 'sites_by_region_gid_{}.csv'.format(i))
+                for i in range(1, level + 1)
+            ],
+        },
+        {
+            'name': 'segment_lower_into_upper_grid',
+            'module': 'grid',
+            'args': [iso3, side_length_lower, side_length_upper],
+            'inputs': [grid_upper, grid_lower],
+            'outputs': [grid_lower_folder],
+        },
+        {
+            'name': 'generate_tile_population',
+            'module': 'pop',
+            'args': [country],
+            'inputs': [settlements, grid_lower_folder],
+            'outputs': [os.path.join(folder, 'population', 'population_tiles.shp')],
+        },
+        {
+            'name': 'cut_roads_with_upper_grid',
+            'module': 'grid',
+            'args': [iso3, side_length_upper],
+            'inputs': [roads, grid_lower_folder],
+            'outputs': [roads_upper],
+        },
+        {
+            'name': 'segment_roads_to_lower',
+            'module': 'grid',
+            'args': [iso3, side_length_lower, side_length_upper],
+            'inputs': [roads_upper, grid_lower_folder],
+            'outputs': [roads_lower],
+        },
+        {
+            'name': 'export_road_network_metrics',
+            'module': 'grid',
+            'args': [iso3, side_length_lower],
+            'inputs': [roads_lower],
+            'outputs': [os.path.join(folder, 'infrastructure',
+                'road_lengths_by_region.csv')],
+        },
+        {
+            'name': 'load_data',
+            'module': 'process',
+            'args': [country],
+            'inputs': [
+                os.path.join(folder, 'population', 'population_tiles.shp'),
+                os.path.join(folder, 'infrastructure',
+                    'road_lengths_by_region.csv'),
+            ],
+            'outputs': [os.path.join(folder, 'all_data.shp')],
+        },
+        {
+            'name': 'generate_tile_backcast',
+            'module': 'process',
+            'args': [country, process.ATTRACTIVENESS, process.SPILLOVER,
+                side_length_lower],
+            'inputs': [
+                os.path.join(folder, 'all_data.shp'),
+                os.path.join(DATA_PROCESSED, '..', 'raw', 'cash_to_spend.csv'),
+                tile_counts,
+                outline,
+                grid_lower,
+            ] + operators,
+            'outputs': [os.path.join(RESULTS, iso3, 'tiles.parquet')] + [
+                os.path.join(by_radio, '{}.parquet'.format(radio))
+                for radio in ['gsm', 'umts', 'lte']
+            ],
+        },
+        {
+            'name': 'aggregate_results',
+            'module': 'process',
+            'args': [country],
+            'inputs': [
+                os.path.join(by_radio, '{}.parquet'.format(radio))
+                for radio in ['gsm', 'umts', 'lte']
+            ],
+            'outputs': [
+                os.path.join(RESULTS, iso3, 'results.parquet'),
+                os.path.join(RESULTS, iso3, 'results.csv'),
+            ],
+        },
+        {
+            'name': 'generate_tile_region_weights',
+            'module': 'weights',
+            'args': [country, side_length_lower],
+            'inputs': [grid_lower] + regions,
+            'outputs': [os.path.join(folder, 'weights')],
+        },
+        {
+            'name': 'generate_region_backcast',
+            'module': 'weights',
+            'args': [country],
+            'inputs': [
+                os.path.join(RESULTS, iso3, 'tiles.parquet'),
+                os.path.join(RESULTS, iso3, 'results.parquet'),
+                os.path.join(folder, 'weights'),
+            ],
+            'outputs': [
+                os.path.join(RESULTS, iso3, 'regions_gid_{}.{}'.format(i, ext))
+                for i in range(1, level + 1) for ext in ['parquet', 'csv']
+            ],
+        },
+        {
+            'name': 'validate_backcast',
+            'module': 'validate',
+            'args': [country],
+            'inputs': [
+                os.path.join(RESULTS, iso3, 'results.parquet'),
+                os.path.join(RESULTS, iso3, 'tiles.parquet'),
+                os.path.join(folder, 'weights'),
+                tile_counts,
+            ] + [
+                os.path.join(folder, 'sites',
+                    'cells_by_region_gid_{}_long.csv'.format(i))
+                for i in range(1, level + 1)
+            ] + [
+                os.path.join(mce, 'MCE_{}'.format(tech),
+                    'MCE_{}{}_2020.tif'.format(country['iso2'], tech))
+                for tech in technologies
+            ],
+            'outputs': [
+                os.path.join(RESULTS, iso3, filename) for filename in [
+                    'validation.json',
+                    'validation_accuracy.csv',
+                    'validation_coverage.csv',
+                ]
+            ],
+        },
+    ]
+
+    if preprocess.TIMESTAMPS:
+        stages.append({
+            'name': 'export_first_observed',
+            'module': 'preprocess',
+            'args': [country, side_length_lower],
+            'inputs': [sites_table, site_labels, outline, grid_lower],
+            'outputs': [
+                os.path.join(folder, 'sites', 'first_observed_by_tile.csv'),
+            ] + [
+                os.path.join(folder, 'sites',
+                    'first_observed_by_region_gid_{}.csv'.format(i))
+                for i in range(1, level + 1)
+            ],
+        })
+
+    for stage in stages:
+        stage.setdefault('function', stage['name'])
+        stage['inputs'] = [os.path.normpath(p) for p in stage['inputs']]
+        stage['outputs'] = [os.path.normpath(p) for p in stage['outputs']]
+
+    return add_dependencies(stages)
+
+
+def add_dependencies(stages):
+    """
+    Link each stage to the stages which produce its inputs.
+
+    """
+    for stage in stages:
+        stage['depends'] = []
+        for other in stages:
+            if other['name'] == stage['name']:
+                continue
+            for path_in in stage['inputs']:
+                if any(is_within(path_in, path_out)
+                        for path_out in other['outputs']):
+                    stage['depends'].append(other['name'])
+                    break
+
+    return stages
+
+
+def order_stages(stages):
+    """
+    Sort stages so each follows the stages it depends on, otherwise
+    keeping the declared order.
+
+    """
+    done = set()
+    output = []
+
+    while len(output) < len(stages):
+
+        ready = [stage for stage in stages if not stage['name'] in done and
+            all(dep in done for dep in stage['depends'])]
+
+        if len(ready) == 0:
+            raise RuntimeError('Unable to resolve stage dependencies')
+
+        output.append(ready[0])
+        done.add(ready[0]['name'])
+
+    return output
+
+
+def is_within(path, folder):
+    """
+    Check whether a path is equal to, or held within, another path.
+
+    """
+    return path == folder or path.startswith(folder + os.sep)
+
+
+def expand_paths(path):
+    """
+    Expand a declared path into the files which make it up.
+
+    Folders are expanded to every file they contain, and shapefiles to
+    their sidecar files.
+
+    """
+    if os.path.isdir(path):
+        output = []
+        for root, dirs, filenames in os.walk(path):
+            dirs[:] = sorted(d for d in dirs if not d == INDEX_FOLDER)
+            for filename in sorted(filenames):
+                output.append(os.path.join(root, filename))
+        return output
+
+    if path.endswith('.shp'):
+        stem = path[:-len('.shp')]
+        return [stem + ext for ext in SHP_EXTENSIONS
+            if os.path.exists(stem + ext)]
+
+    if os.path.exists(path):
+        return [path]
+
+    return []
+
+
+def hash_file(path, files):
+    """
+    Return the sha256 of a file, reusing the cached hash when the file
+    size and modification time are unchanged.
+
+    """
+    stat = os.stat(path)
+    cached = files.get(path)
+
+    if (cached and cached['size'] == stat.st_size and
+            cached['mtime_ns'] == stat.st_mtime_ns):
+        return cached['sha256']
+
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as source:
+        for block in iter(lambda: source.read(2 ** 20), b''):
+            sha256.update(block)
+
+    files[path] = {
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'sha256': sha256.hexdigest(),
+    }
+
+    return files[path]['sha256']
+
+
+def get_code_sources(module):
+    """
+    Return the source of a script module and of every script module it
+    imports, directly or indirectly, by module name.
+
+    Imports are found anywhere in the source, including those made
+    within functions, so edits to any helper a stage reaches change the
+    stage key.
+
+    """
+    folder = os.path.dirname(os.path.abspath(__file__))
+
+    sources = {}
+    pending = [module]
+
+    while len(pending) > 0:
+
+        name = pending.pop()
+        path = os.path.join(folder, '{}.py'.format(name))
+        if name in sources or not os.path.exists(path):
+            continue
+
+        with open(path, 'r') as source:
+            sources[name] = source.read()
+
+        for node in ast.walk(ast.parse(sources[name])):
+            if isinstance(node, ast.Import):
+                pending += [alias.name.split('.')[0] for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.level == 0:
+                pending.append(node.module.split('.')[0])
+
+    return sources
+
+
+def get_stage_key(stage, files):
+    """
+    Hash the stage inputs, parameters and code into a key.
+
+    The code covers the whole module defining the stage function, and
+    the script modules it imports, rather than the function alone.
+
+    """
+    sha256 = hashlib.sha256()
+    sha256.update(stage['name'].encode())
+    sha256.update(stage['function'].encode())
+    sha256.update(json.dumps(stage['args'], sort_keys=True,
+        default=str).encode())
+
+    sources = get_code_sources(stage['module'])
+    for name in sorted(sources):
+        sha256.update(name.encode())
+        sha256.update(sources[name].encode())
+
+    for path_in in stage['inputs']:
+        paths = expand_paths(path_in)
+        if len(paths) == 0:
+            raise FileNotFoundError(
+                'Stage {} is missing input {}'.format(stage['name'], path_in))
+        for path in paths:
+            sha256.update(os.path.relpath(path, path_in).encode())
+            sha256.update(hash_file(path, files).encode())
+
+    return sha256.hexdigest()
+
+
+def is_complete(stage, key, manifest):
+    """
+    Check whether a stage has already run with the same key.
+
+    """
+    record = manifest['stages'].get(stage['name'])
+
+    if not record or not record['key'] == key:
+        return False
+
+    return all(len(expand_paths(path)) > 0 for path in stage['outputs'])
+
+
+def remove_outputs(stage):
+    """
+    Remove stale stage outputs, so that the skip checks within the stage
+    functions do not return early.
+
+    """
+    for path in stage['outputs']:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            for filename in expand_paths(path):
+                os.remove(filename)
+
+    return
+
+
+def run_stage(stage):
+    """
+    Run a single stage. Called within a worker process.
+
+    Returns the stage duration along with the instrumentation records
+    collected while it ran.
+
+    """
+    function = getattr(importlib.import_module(stage['module']),
+        stage['function'])
+
+    reset_report()
+
+    start = time.time()
+    function(*stage['args'])
+
+    return time.time() - start, get_report()
+
+
+def load_manifest(path):
+    """
+    Load the pipeline manifest, which records file hashes and stage keys.
+
+    """
+    if not os.path.exists(path):
+        return {'files': {}, 'stages': {}}
+
+    with open(path, 'r') as source:
+        return json.load(source)
+
+
+def write_manifest(manifest, path):
+    """
+    Write the pipeline manifest.
+
+    """
+    folder = os.path.dirname(path)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+    path_tmp = path + '.tmp'
+    with open(path_tmp, 'w') as sink:
+        json.dump(manifest, sink, indent=1, sort_keys=True)
+    os.replace(path_tmp, path)
+
+    return
+
+
+def mark_complete(country, names):
+    """
+    Record stages whose outputs were produced outside the pipeline
+    (e.g. by the batch runner) as complete, so they are not rerun.
+
+    """
+    path_manifest = os.path.join(DATA_PROCESSED, country['iso3'],
+        'pipeline.json')
+    manifest = load_manifest(path_manifest)
+
+    for stage in get_stages(country):
+
+        if not stage['name'] in names:
+            continue
+
+        if not all(len(expand_paths(path)) > 0 for path in stage['outputs']):
+            continue
+
+        manifest['stages'][stage['name']] = {
+            'key': get_stage_key(stage, manifest['files']),
+            'seconds': None,
+            'completed': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        }
+
+    write_manifest(manifest, path_manifest)
+
+    return
+
+
+def run_pipeline(country, jobs=None, force=None, dry_run=False):
+    """
+    Run all invalidated stages for a country, in dependency order.
+
+    Parameters
+    ----------
+    country : dict
+        Contains all desired country information.
+    jobs : int
+        Maximum number of stages to run concurrently.
+    force : list
+        Names of stages to rerun regardless of their cache state.
+    dry_run : bool
+        Only report which stages would run.
+
+    """
+    stages = get_stages(country)
+    lut = {stage['name']: stage for stage in stages}
+    force = set(force or [])
+
+    for name in force:
+        if name not in lut:
+            raise KeyError('Unknown stage: {}'.format(name))
+
+    path_manifest = os.path.join(DATA_PROCESSED, country['iso3'],
+        'pipeline.json')
+    manifest = load_manifest(path_manifest)
+
+    done = set()
+    rerun = set()
+    running = {}
+    calls = []
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+
+        while len(done) < len(stages):
+
+            progressed = False
+
+            for stage in stages:
+
+                name = stage['name']
+                if name in done or name in running.values():
+                    continue
+                if not all(dep in done for dep in stage['depends']):
+                    continue
+
+                progressed = True
+
+                if dry_run:
+                    upstream = any(dep in rerun for dep in stage['depends'])
+                    done.add(name)
+                    if upstream or name in force:
+                        print('Would run {}'.format(name))
+                        rerun.add(name)
+                        continue
+                    try:
+                        key = get_stage_key(stage, manifest['files'])
+                    except FileNotFoundError:
+                        key = None
+                    if is_complete(stage, key, manifest):
+                        print('Up to date: {}'.format(name))
+                    else:
+                        print('Would run {}'.format(name))
+                        rerun.add(name)
+                    continue
+
+                key = get_stage_key(stage, manifest['files'])
+
+                if not name in force and is_complete(stage, key, manifest):
+                    print('Up to date: {}'.format(name))
+                    done.add(name)
+                    continue
+
+                print('Working on {}'.format(name))
+                remove_outputs(stage)
+                stage['key'] = key
+                running[executor.submit(run_stage, stage)] = name
+
+            if len(running) == 0:
+                if not progressed:
+                    raise RuntimeError('Unable to resolve stage dependencies')
+                continue
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+
+            for future in finished:
+                name = running.pop(future)
+                stage = lut[name]
+
+                try:
+                    seconds, stage_calls = future.result()
+                except Exception:
+                    print('Stage {} failed'.format(name))
+                    for other in running:
+                        other.cancel()
+                    write_manifest(manifest, path_manifest)
+                    export_report('pipeline_{}'.format(country['iso3']), calls)
+                    raise
+
+                calls = calls + stage_calls
+
+                manifest['stages'][name] = {
+                    'key': stage['key'],
+                    'seconds': round(seconds, 2),
+                    'completed': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                }
+                write_manifest(manifest, path_manifest)
+
+                print('Completed {} in {}s'.format(name, round(seconds, 1)))
+                done.add(name)
+                rerun.add(name)
+
+    export_report('pipeline_{}'.format(country['iso3']), calls)
+
+    return rerun
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('iso3', nargs='?', default='MEX')
+    parser.add_argument('--iso2', default='MX')
+    parser.add_argument('--gid-region', type=int, default=2)
+    parser.add_argument('--jobs', type=int, default=None)
+    parser.add_argument('--force', nargs='*', default=[])
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    country = {
+        'iso3': args.iso3,
+        'iso2': args.iso2,
+        'gid_region': args.gid_region,
+        'regional_level': args.gid_region,
+    }
+
+    run_pipeline(country, jobs=args.jobs, force=args.force,
+        dry_run=args.dry_run)
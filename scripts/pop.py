@@ -18,6 +18,9 @@ import rasterio
 from rasterio.mask import mask
 from rasterstats import zonal_stats
 
+from layers import read_layer
+from instrument import timed, count_records, export_report
+
 
 CONFIG = configparser.ConfigParser()
 CONFIG.read(os.path.join(os.path.dirname(__file__), 'script_config.ini'))
@@ -28,6 +31,7 @@ DATA_INTERMEDIATE = os.path.join(BASE_PATH, 'intermediate')
 DATA_PROCESSED = os.path.join(BASE_PATH, 'processed')
 
 
+@timed
 def process_settlement_layer(country):
     """
     Clip the settlement layer to the chosen country boundary
@@ -45,16 +49,15 @@ def process_settlement_layer(country):
     path_settlements = os.path.join(DATA_RAW,'settlement_layer',
         'ppp_2020_1km_Aggregated.tif')
 
-    settlements = rasterio.open(path_settlements, 'r+')
-    settlements.nodata = 255
-    settlements.crs = {"init": "epsg:4326"}
+    # opened read-only, so the raw layer keeps a stable content hash
+    settlements = rasterio.open(path_settlements, 'r')
 
     iso3 = country['iso3']
     path_country = os.path.join(DATA_PROCESSED, iso3,
         'national_outline.shp')
     
     if os.path.exists(path_country):
-        country = gpd.read_file(path_country)
+        country = read_layer(path_country)
     else:
         return print('Must generate national_outline.shp first' )
 
@@ -70,14 +73,16 @@ def process_settlement_layer(country):
 
     geo = gpd.GeoDataFrame()
     geo = gpd.GeoDataFrame({'geometry': country['geometry']})
+    count_records(len(geo))
 
     coords = [json.loads(geo.to_json())['features'][0]['geometry']]
 
-    out_img, out_transform = mask(settlements, coords, crop=True)
+    out_img, out_transform = mask(settlements, coords, crop=True, nodata=255)
 
     out_meta = settlements.meta.copy()
 
     out_meta.update({"driver": "GTiff",
+                    "nodata": 255,
                     "height": out_img.shape[1],
                     "width": out_img.shape[2],
                     "transform": out_transform,
@@ -89,6 +94,7 @@ def process_settlement_layer(country):
     return print('-- Completed processing of settlement layer')
 
 
+@timed
 def generate_population(country):
     """
     Extract regional data including luminosity and population.
@@ -113,7 +119,7 @@ def generate_population(country):
     path_country = os.path.join(DATA_PROCESSED, iso3,
         'national_outline.shp')
 
-    single_country = gpd.read_file(path_country)
+    single_country = read_layer(path_country)
 
     folder_in = os.path.join(DATA_PROCESSED, iso3, 'population')
     filename = 'settlements.tif'
@@ -122,8 +128,9 @@ def generate_population(country):
     filename = 'regions_{}_{}.shp'.format(level, iso3)
     folder = os.path.join(DATA_PROCESSED, iso3, 'regions')
     path = os.path.join(folder, filename)
-    regions = gpd.read_file(path)#[:1]
+    regions = read_layer(path)#[:1]
     regions = regions.to_dict('records')
+    count_records(len(regions))
 
     results = []
 
@@ -188,6 +195,7 @@ def area_of_polygon(geom):
     return abs(poly_area)
 
 
+@timed
 def generate_tile_population(country):
     """
     Extract regional data including luminosity and population.
@@ -223,8 +231,9 @@ def generate_tile_population(country):
         if not filename.endswith('shp'):
             continue
 
-        grid = gpd.read_file(os.path.join(folder, filename), crs='epsg:4326')
+        grid = read_layer(os.path.join(folder, filename), crs='epsg:4326')
         grid = grid.to_dict('records')
+        count_records(len(grid))
 
         for tile in grid:
 
@@ -301,3 +310,5 @@ if __name__ == '__main__':
         generate_tile_population(country)
 
     print('--Completed regional population data estimation')
+
+    export_report('pop')
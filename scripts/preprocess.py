@@ -10,8 +10,13 @@ import sys
 import os
 import configparser
 import json
+import numpy as np
 import pandas as pd
+from pandas.api.types import is_datetime64_any_dtype as is_datetime
+import pyarrow as pa
+import pyarrow.parquet as pq
 import geopandas as gpd
+import fiona
 import pyproj
 from shapely.ops import transform
 from shapely.geometry import shape, Point, mapping, LineString, MultiPolygon, box
@@ -19,6 +24,11 @@ import rasterio
 from rasterio.mask import mask
 from tqdm import tqdm
 
+from layers import read_layer, is_chunked, iter_chunks
+from instrument import timed, count_records, export_report
+from spatial_index import query_bbox
+from grid import get_tile_ids, get_tile_lookup
+
 CONFIG = configparser.ConfigParser()
 CONFIG.read(os.path.join(os.path.dirname(__file__),'..', 'scripts', 'script_config.ini'))
 BASE_PATH = CONFIG['file_locations']['base_path']
@@ -26,7 +36,49 @@ BASE_PATH = CONFIG['file_locations']['base_path']
 DATA_RAW = os.path.join(BASE_PATH, '..', '..', 'data_raw')
 DATA_PROCESSED = os.path.join(BASE_PATH, 'processed')
 
-
+# row positions of each country in the GADM layers, by layer
+GADM_ROWS = {}
+
+SITE_COLUMNS = ['radio', 'mcc', 'net', 'area', 'cell', 'unit', 'lon', 'lat']
+
+# float32 coordinates keep sites to within about a meter
+SITES_SCHEMA = pa.schema([
+    ('radio', pa.dictionary(pa.int8(), pa.string())),
+    ('mcc', pa.uint16()),
+    ('net', pa.uint16()),
+    ('area', pa.int32()),
+    ('cell', pa.int64()),
+    ('unit', pa.int16()),
+    ('lon', pa.float32()),
+    ('lat', pa.float32()),
+])
+
+# OpenCelliD snapshot the national sites tables are extracted from
+TOWERS_FILE = CONFIG.get('sites', 'towers_file',
+    fallback='cell_towers_2022-12-24.csv')
+
+# optional OpenCelliD columns kept when `timestamps` is set in [sites]
+TIMESTAMPS = CONFIG.getboolean('sites', 'timestamps', fallback=False)
+
+TIMESTAMP_FIELDS = [
+    ('samples', pa.int32()),
+    ('created', pa.timestamp('s')),
+    ('updated', pa.timestamp('s')),
+]
+
+SITES_DTYPES = {
+    'radio': 'category',
+    'mcc': 'uint16',
+    'net': 'uint16',
+    'area': 'int32',
+    'cell': 'int64',
+    'unit': 'Int16',
+    'lon': 'float32',
+    'lat': 'float32',
+}
+
+
+@timed
 def run_preprocessing(country):
     """
     Meta function for running preprocessing.
@@ -47,10 +99,37 @@ def run_preprocessing(country):
     print('Working on create_national_sites_shp')
     create_national_sites_shp(iso3)
 
+    print('Working on regional disaggregation')
+    regions = segment_regions(country)
+
+    print('Labelling sites by region')
+    label_sites(country)
+
+    print('Exporting cell counts by region')
+    export_cell_counts(country, regions)
+
+    print('Working on process_regional_coverage')
+    process_regional_coverage(country)
+
+    print('Working on convert_regional_coverage_to_shapes')
+    convert_regional_coverage_to_shapes(country)
+
+    return
+
+
+@timed
+def segment_regions(country):
+    """
+    Disaggregate the national sites into gid_1 and gid_2 site layers.
+
+    """
+    iso3 = country['iso3']
+    regional_level = int(country['gid_region'])
+
     regions = get_regions(country, regional_level)
     regions = regions.to_dict('records')
+    count_records(len(regions))
 
-    print('Working on regional disaggregation')
     for region in regions:
 
         region = region['GID_{}'.format(regional_level)]
@@ -71,106 +150,233 @@ def run_preprocessing(country):
         #print('Working on create_regional_sites_layer')
         create_regional_sites_layer(iso3, 2, region)
 
-    print('Exporting cell counts by region')
-    export_cell_counts(country, regions)
+    return regions
 
-    print('Working on process_regional_coverage')
-    process_regional_coverage(country)
 
-    print('Working on convert_regional_coverage_to_shapes')
-    convert_regional_coverage_to_shapes(country)
+@timed
+def create_national_sites_csv(country):
+    """
+    Create the national sites table for a selected country.
+
+    The tower csv is scanned once for all of the country's mobile country
+    codes, and the cells written to a typed parquet table (see
+    SITES_SCHEMA).
+
+    """
+    extract_national_sites([country])
 
     return
 
 
-def create_national_sites_csv(country):
+def extract_national_sites(countries, towers_file=None, paths=None):
     """
-    Create a national sites csv layer for a selected country.
+    Write the national sites tables for a list of countries in a single
+    pass over the tower csv.
 
-    """
-    iso3 = country['iso3']#.values[0]
+    Countries which already have a sites table are skipped.
 
+    Parameters
+    ----------
+    countries : list
+        Country dicts.
+    towers_file : string
+        Tower csv in data_raw (defaults to the configured towers_file).
+    paths : dict
+        Output table for each ISO3 code (defaults to get_sites_path).
+
+    """
     filename = "mobile_codes.csv"
     path = os.path.join(DATA_RAW, filename)
-    mobile_codes = pd.read_csv(path)
+    mobile_codes = read_layer(path)
     mobile_codes = mobile_codes[['iso3', 'mcc', 'mnc']].drop_duplicates()
-    all_mobile_codes = mobile_codes[mobile_codes['iso3'] == iso3]
-    all_mobile_codes = all_mobile_codes.to_dict('records')
 
-    output = []
+    targets = {}
 
-    filename = '{}.csv'.format(iso3)
-    folder = os.path.join(DATA_PROCESSED, iso3, 'sites')
-    path_csv = os.path.join(folder, filename)
+    for country in countries:
+
+        iso3 = country['iso3']#.values[0]
+
+        path_sites = get_sites_path(iso3)
+        if paths is not None and iso3 in paths:
+            path_sites = paths[iso3]
+        folder = os.path.dirname(path_sites)
+
+        ### Produce national sites data layers
+        if os.path.exists(path_sites):
+            continue
+
+        print('-sites data does not exist')
+        print('-Subsetting site data for {}'.format(iso3))
+
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+        all_mobile_codes = mobile_codes[mobile_codes['iso3'] == iso3]
+
+        targets[iso3] = {
+            'mccs': all_mobile_codes['mcc'].unique().tolist(),
+            'path': path_sites,
+            'writer': None,
+            'seen': set(),
+        }
 
-    ### Produce national sites data layers
-    if os.path.exists(path_csv):
+    if len(targets) == 0:
         return
 
-    print('-site.csv data does not exist')
-    print('-Subsetting site data for {}'.format(iso3))
+    if towers_file is None:
+        towers_file = TOWERS_FILE
+    path = os.path.join(DATA_RAW, towers_file)
 
-    if not os.path.exists(folder):
-        os.makedirs(folder)
+    schema = get_sites_schema()
 
-    filename = "cell_towers_2022-12-24.csv"
-    path = os.path.join(DATA_RAW, filename)
+    # each mobile country code is scanned once, so cells listed under
+    # several network codes are no longer duplicated
+    chunksize = 10 ** 6
+    for idx, chunk in enumerate(pd.read_csv(path, chunksize=chunksize,
+            usecols=schema.names)):
 
-    for row in all_mobile_codes:
+        for iso3, target in targets.items():
 
-        # if not row['mnc'] in [10,2,11,33,34,20,94,30,31,32,27,15,91,89]:
-        #     continue
+            country_data = chunk.loc[chunk['mcc'].isin(target['mccs'])]#[:1]
+            country_data = country_data.drop_duplicates(['mcc', 'cell'])
 
-        mcc = row['mcc']
-        seen = set()
-        chunksize = 10 ** 6
-        for idx, chunk in enumerate(pd.read_csv(path, chunksize=chunksize)):
+            keys = list(zip(country_data['mcc'], country_data['cell']))
+            country_data = country_data[[not key in target['seen'] for key in keys]]
+            target['seen'].update(keys)
 
-            country_data = chunk.loc[chunk['mcc'] == mcc]#[:1]
+            if len(country_data) == 0:
+                continue
 
-            country_data = country_data.to_dict('records')
+            count_records(len(country_data))
 
-            for site in country_data:
+            # sites are streamed to the table, so only one chunk is in memory
+            if target['writer'] is None:
+                target['writer'] = pq.ParquetWriter(target['path'], schema)
+            target['writer'].write_table(get_sites_table(country_data, schema))
 
-                # if not -4 > site['lon'] > -6:
-                #     continue
+    for target in targets.values():
+        if target['writer'] is not None:
+            target['writer'].close()
 
-                # if not 49.8 < site['lat'] < 52:
-                #     continue
+    return
 
-                if site['cell'] in seen:
-                    continue
 
-                seen.add(site['cell'])
+def get_sites_path(iso3):
+    """
+    Return the path of the national sites table.
 
-                output.append({
-                    'radio': site['radio'],
-                    'mcc': site['mcc'],
-                    'net': site['net'],
-                    'area': site['area'],
-                    'cell': site['cell'],
-                    'unit': site['unit'],
-                    'lon': site['lon'],
-                    'lat': site['lat'],
-                    # 'range': site['range'],
-                    # 'samples': site['samples'],
-                    # 'changeable': site['changeable'],
-                    # 'created': site['created'],
-                    # 'updated': site['updated'],
-                    # 'averageSignal': site['averageSignal']
-                })
-            # if len(output) > 0:
-            #     break
+    """
+    filename = '{}.parquet'.format(iso3)
 
-    if len(output) == 0:
-        return
+    return os.path.join(DATA_PROCESSED, iso3, 'sites', filename)
+
+
+def get_sites_schema():
+    """
+    Return the schema of the national sites table, including the
+    OpenCelliD timestamp and sample columns when `timestamps` is set.
 
-    output = pd.DataFrame(output)
-    output.to_csv(path_csv, index=False)
+    """
+    if not TIMESTAMPS:
+        return SITES_SCHEMA
+
+    schema = SITES_SCHEMA
+    for name, field_type in TIMESTAMP_FIELDS:
+        schema = schema.append(pa.field(name, field_type))
+
+    return schema
+
+
+def get_sites_table(data, schema=SITES_SCHEMA):
+    """
+    Convert sites to an arrow table, enforcing the sites schema.
+
+    The created and updated columns are read as unix times in seconds.
+
+    """
+    data = data[schema.names].astype(
+        {k: v for k, v in SITES_DTYPES.items() if k in schema.names})
+
+    for name in ['created', 'updated']:
+        if name in schema.names and not is_datetime(data[name]):
+            data[name] = pd.to_datetime(data[name], unit='s')
+
+    if 'samples' in schema.names:
+        data['samples'] = data['samples'].astype('int32')
+
+    return pa.Table.from_pandas(data, schema=schema, preserve_index=False)
+
+
+def write_sites(data, path):
+    """
+    Write a sites table, enforcing SITES_SCHEMA.
+
+    """
+    pq.write_table(get_sites_table(data), path)
+
+    return
+
+
+def check_sites_schema(path):
+    """
+    Check a sites table matches SITES_SCHEMA.
+
+    """
+    schema = pq.read_schema(path)
+
+    for field in SITES_SCHEMA:
+        if not schema.field(field.name).type == field.type:
+            raise TypeError('{} has type {} in {}, expected {}'.format(
+                field.name, schema.field(field.name).type, path, field.type))
 
     return
 
 
+def read_sites(path, columns=None):
+    """
+    Read a sites table, checking it matches SITES_SCHEMA.
+
+    """
+    check_sites_schema(path)
+
+    sites = read_layer(path)
+
+    if columns is not None:
+        sites = sites[columns]
+
+    return sites
+
+
+def read_site_rows(path, ids):
+    """
+    Read the sites at the given (sorted) row positions.
+
+    In chunked mode the table is streamed, keeping only the requested
+    rows, so the full table is never held in memory.
+
+    """
+    if not is_chunked():
+        return read_sites(path).iloc[ids]
+
+    check_sites_schema(path)
+
+    ids = np.asarray(ids, dtype='int64')
+    output = []
+    offset = 0
+
+    for chunk in iter_chunks(path):
+        start, end = np.searchsorted(ids, [offset, offset + len(chunk)])
+        if end > start:
+            output.append(chunk.iloc[ids[start:end] - offset])
+        offset += len(chunk)
+
+    if len(output) == 0:
+        return pd.DataFrame(columns=SITES_SCHEMA.names)
+
+    return pd.concat(output)
+
+
+@timed
 def process_country_shapes(iso3):
     """
     Creates a single national boundary for the desired country.
@@ -195,19 +401,17 @@ def process_country_shapes(iso3):
 
     path = os.path.join(DATA_RAW, 'gadm36_levels_shp', 'gadm36_0.shp')
 
-    countries = gpd.read_file(path)
-
-    single_country = countries[countries.GID_0 == iso3].reset_index()
+    single_country = read_gadm(path, iso3).reset_index()
+    count_records(len(single_country))
 
     single_country = single_country.copy()
     single_country["geometry"] = single_country.geometry.simplify(
         tolerance=0.01, preserve_topology=True)
 
-    single_country['geometry'] = single_country.apply(
-        remove_small_shapes, axis=1)
+    single_country['geometry'] = remove_small_shapes(single_country)
 
     glob_info_path = os.path.join(DATA_RAW, 'countries.csv')
-    load_glob_info = pd.read_csv(glob_info_path, encoding = "ISO-8859-1",
+    load_glob_info = read_layer(glob_info_path, encoding = "ISO-8859-1",
         keep_default_na=False)
     single_country = single_country.merge(
         load_glob_info, left_on='GID_0', right_on='iso3')
@@ -217,49 +421,109 @@ def process_country_shapes(iso3):
     return
 
 
-def remove_small_shapes(x):
+def get_gadm_rows(path):
+    """
+    Get the row positions of each country in a GADM layer.
+
+    Only the GID_0 attribute is scanned, and the result is kept for the
+    life of the process (and shared with forked workers).
+
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns)
+
+    if key in GADM_ROWS:
+        return GADM_ROWS[key]
+
+    with fiona.open(path) as source:
+        fields = list(source.schema['properties'].keys())
+
+    ignore = [field for field in fields if not field == 'GID_0']
+
+    rows = {}
+
+    with fiona.open(path, ignore_fields=ignore, ignore_geometry=True) as source:
+        for idx, feature in enumerate(source):
+            rows.setdefault(feature['properties']['GID_0'], []).append(idx)
+
+    GADM_ROWS[key] = rows
+
+    return rows
+
+
+def read_gadm(path, iso3, bbox=None):
+    """
+    Read the features of a single country from a GADM layer.
+
+    GADM layers are ordered by country, so the country's rows are read
+    as one contiguous slice. If the rows are scattered, only features
+    within the bounding box (if given) are read.
+
+    """
+    rows = get_gadm_rows(path).get(iso3, [])
+
+    if len(rows) == 0:
+        return read_layer(path, rows=slice(0, 0))
+
+    first, last = rows[0], rows[-1]
+
+    if last - first + 1 <= 2 * len(rows):
+        data = read_layer(path, rows=slice(first, last + 1))
+    elif bbox is not None:
+        data = read_layer(path, bbox=tuple(bbox))
+    else:
+        data = read_layer(path)
+
+    return data[data.GID_0 == iso3]
+
+
+def remove_small_shapes(data):
     """
     Remove small multipolygon shapes.
 
+    The multipolygons are exploded into their parts, and parts below the
+    area threshold for their country and size are dropped.
+
     Parameters
     ---------
-    x : polygon
-        Feature to simplify.
+    data : geodataframe
+        Features to simplify, with a GID_0 column.
 
     Returns
     -------
-    MultiPolygon : MultiPolygon
-        Shapely MultiPolygon geometry without tiny shapes.
+    geometry : geoseries
+        Geometries without tiny shapes.
 
     """
-    if x.geometry.type == 'Polygon':
-        return x.geometry
+    area1 = 0.01
+    area2 = 50
 
-    elif x.geometry.type == 'MultiPolygon':
+    geometry = data.geometry
+    area = geometry.area
 
-        area1 = 0.01
-        area2 = 50
+    multi = (geometry.geom_type == 'MultiPolygon') & ~(area < area1)
 
-        if x.geometry.area < area1:
-            return x.geometry
+    if not multi.any():
+        return geometry
 
-        if x['GID_0'] in ['CHL','IDN']:
-            threshold = 0.01
-        elif x['GID_0'] in ['RUS','GRL','CAN','USA']:
-            threshold = 0.01
-        elif x.geometry.area > area2:
-            threshold = 0.1
-        else:
-            threshold = 0.001
+    threshold = pd.Series(0.001, index=data.index)
+    threshold[area > area2] = 0.1
+    threshold[data['GID_0'].isin(['CHL','IDN'])] = 0.01
+    threshold[data['GID_0'].isin(['RUS','GRL','CAN','USA'])] = 0.01
 
-        new_geom = []
-        for y in list(x['geometry'].geoms):
-            if y.area > threshold:
-                new_geom.append(y)
+    parts = geometry[multi].explode()
+    row = parts.index.get_level_values(0)
+    keep = parts.area.values > threshold.loc[row].values
 
-        return MultiPolygon(new_geom)
+    kept = {idx: list(group.values) for idx, group in parts[keep].groupby(level=0)}
 
+    output = [MultiPolygon(kept.get(idx, [])) if flag else geom
+        for idx, geom, flag in zip(data.index, geometry, multi)]
 
+    return gpd.GeoSeries(output, index=data.index, crs=geometry.crs)
+
+
+@timed
 def process_regions(iso3, level):
     """
     Function for processing the lowest desired subnational
@@ -287,17 +551,21 @@ def process_regions(iso3, level):
         if not os.path.exists(folder):
             os.mkdir(folder)
 
+        path_outline = os.path.join(DATA_PROCESSED, iso3, 'national_outline.shp')
+        bbox = None
+        if os.path.exists(path_outline):
+            bbox = read_layer(path_outline).total_bounds
+
         filename = 'gadm36_{}.shp'.format(regional_level)
         path_regions = os.path.join(DATA_RAW, 'gadm36_levels_shp', filename)
-        regions = gpd.read_file(path_regions)
-
-        regions = regions[regions.GID_0 == iso3]
+        regions = read_gadm(path_regions, iso3, bbox)
+        count_records(len(regions))
 
         regions = regions.copy()
         regions["geometry"] = regions.geometry.simplify(
             tolerance=0.005, preserve_topology=True)
 
-        regions['geometry'] = regions.apply(remove_small_shapes, axis=1)
+        regions['geometry'] = remove_small_shapes(regions)
 
         try:
             regions.to_file(path_processed, driver='ESRI Shapefile')
@@ -308,45 +576,66 @@ def process_regions(iso3, level):
     return
 
 
+@timed
 def create_national_sites_shp(iso3):
     """
-    Create a national sites csv layer for a selected country.
+    Create a national sites point layer for a selected country.
+
+    The layer is written as a GeoPackage (a single file with a spatial
+    index and no field name or size limits). Records are written through
+    fiona as each batch of the site table is read, with the points taken
+    directly from its coordinate columns.
 
     """
-    filename = '{}.csv'.format(iso3)
     folder = os.path.join(DATA_PROCESSED, iso3, 'sites')
-    path_csv = os.path.join(folder, filename)
+    path_sites = get_sites_path(iso3)
 
-    filename = '{}.shp'.format(iso3)
-    path_shp = os.path.join(folder, filename)
+    filename = '{}.gpkg'.format(iso3)
+    path_out = os.path.join(folder, filename)
+
+    if not os.path.exists(path_out):
+
+        print('-Writing site point layer for {}'.format(iso3))
 
-    if not os.path.exists(path_shp):
+        check_sites_schema(path_sites)
 
-        print('-Writing site shapefile data for {}'.format(iso3))
+        columns = ['radio', 'mcc', 'net', 'area', 'cell']
+        interim = '{}.{}.gpkg'.format(path_out[:-5], os.getpid())
+        written = False
 
-        country_data = pd.read_csv(path_csv)#[:10]
+        schema = {
+            'geometry': 'Point',
+            'properties': {
+                'radio': 'str',
+                'mcc': 'int',
+                'net': 'int',
+                'area': 'int',
+                'cell': 'int',
+            },
+        }
 
-        output = []
+        with fiona.open(interim, 'w', driver='GPKG', layer='sites',
+                schema=schema, crs='epsg:4326') as sink:
 
-        for idx, row in country_data.iterrows():
-            output.append({
-                'type': 'Feature',
-                'geometry': {
-                    'type': 'Point',
-                    'coordinates': [row['lon'],row['lat']]
-                },
-                'properties': {
-                    'radio': row['radio'],
-                    'mcc': row['mcc'],
-                    'net': row['net'],
-                    'area': row['area'],
-                    'cell': row['cell'],
-                }
-            })
+            for chunk in iter_chunks(path_sites, columns=columns + ['lon', 'lat']):
 
-        output = gpd.GeoDataFrame.from_features(output, crs='epsg:4326')
+                chunk = chunk.astype({'radio': str})
+                values = zip(*[chunk[column].tolist() for column in columns])
+                coords = zip(chunk['lon'].astype('float64').tolist(),
+                    chunk['lat'].astype('float64').tolist())
 
-        output.to_file(path_shp)
+                sink.writerecords({
+                    'geometry': {'type': 'Point', 'coordinates': point},
+                    'properties': dict(zip(columns, row)),
+                } for point, row in zip(coords, values))
+
+                count_records(len(chunk))
+                written = True
+
+        if written:
+            os.replace(interim, path_out)
+        else:
+            os.remove(interim)
 
 
 def get_regions(country, region_type):
@@ -378,7 +667,7 @@ def get_regions(country, region_type):
         print('This path did not exist/load: {}'.format(path))
         return []
 
-    regions = gpd.read_file(path, crs='epsg:4326')#[:1]
+    regions = read_layer(path, crs='epsg:4326')#[:1]
 
     return regions
 
@@ -399,6 +688,7 @@ def get_gid_1(region):
     return gid_2
 
 
+@timed
 def segment_by_gid_1(iso3, level, region):
     """
     Segment sites by gid_1 bounding box.
@@ -406,16 +696,13 @@ def segment_by_gid_1(iso3, level, region):
     """
     gid_level = 'GID_1'#.format(level)
 
-    filename = '{}.csv'.format(iso3)
-    folder = os.path.join(DATA_PROCESSED, iso3, 'sites')
-    path = os.path.join(folder, filename)
-    sites = pd.read_csv(path)#[:100]
+    path_sites = get_sites_path(iso3)
     
     filename = 'regions_{}_{}.shp'.format(1, iso3)
 
     folder = os.path.join(DATA_PROCESSED, iso3, 'regions')
     path_regions = os.path.join(folder, filename)
-    regions = gpd.read_file(path_regions, crs='epsg:4326')#[:1]
+    regions = read_layer(path_regions, crs='epsg:4326')#[:1]
     region_df = regions[regions[gid_level] == region]['geometry'].values[0]
 
     filename = '{}.csv'.format(region)
@@ -426,39 +713,11 @@ def segment_by_gid_1(iso3, level, region):
     if os.path.exists(path_out):
         return
 
-    xmin, ymin, xmax, ymax = region_df.bounds
-
-    output = []
-
-    for idx, site in sites.iterrows():
-
-        x, y = site['lon'], site['lat']
-
-        if not xmin <= x <= xmax:
-            continue
-
-        if not ymin <= y <= ymax:
-            continue
-
-        output.append({
-            'radio': site['radio'],
-            'mcc': site['mcc'],
-            'net': site['net'],
-            'area': site['area'],
-            'cell': site['cell'],
-            'unit': site['unit'],
-            'lon': site['lon'],
-            'lat': site['lat'],
-            # 'range': site['range'],
-            # 'samples': site['samples'],
-            # 'changeable': site['changeable'],
-            # 'created': site['created'],
-            # 'updated': site['updated'],
-            # 'averageSignal': site['averageSignal']
-        })
+    ids = query_bbox(path_sites, region_df.bounds)
+    count_records(len(ids))
 
-    if len(output) > 0:
-        output = pd.DataFrame(output)
+    if len(ids) > 0:
+        output = read_site_rows(path_sites, ids)[SITE_COLUMNS]
         output.to_csv(path_out, index=False)
     else:
         return
@@ -466,6 +725,7 @@ def segment_by_gid_1(iso3, level, region):
     return
 
 
+@timed
 def segment_by_gid_2(iso3, level, region, gid_1):
     """
     Segment sites by gid_2 bounding box.
@@ -476,18 +736,14 @@ def segment_by_gid_2(iso3, level, region, gid_1):
     filename = 'regions_{}_{}.shp'.format(level, iso3)
     folder = os.path.join(DATA_PROCESSED, iso3, 'regions')
     path = os.path.join(folder, filename)
-    regions = gpd.read_file(path, crs='epsg:4326')#[:1]
+    regions = read_layer(path, crs='epsg:4326')#[:1]
 
     region_df = regions[regions[gid_level] == region]
     region_df = region_df['geometry'].values[0]
 
-    # filename = '{}.shp'.format(region['GID_1'])
     folder_out = os.path.join(DATA_PROCESSED, iso3, 'sites', 'gid_2', 'interim')
     if not os.path.exists(folder_out):
         os.makedirs(folder_out)
-    # path = os.path.join(folder_out, filename)
-    if os.path.exists(path):
-       return
 
     filename = '{}.csv'.format(region)
     path_out = os.path.join(folder_out, filename)
@@ -506,40 +762,16 @@ def segment_by_gid_2(iso3, level, region, gid_1):
 
     if not os.path.exists(path):
         return
-    sites = pd.read_csv(path)
-
-    output = []
-
-    for idx, site in sites.iterrows():
-
-        x, y = site['lon'], site['lat']
-
-        if not xmin < x < xmax:
-            continue
 
-        if not ymin < y < ymax:
-            continue
-
-        output.append({
-            'radio': site['radio'],
-            'mcc': site['mcc'],
-            'net': site['net'],
-            'area': site['area'],
-            'cell': site['cell'],
-            'unit': site['unit'],
-            'lon': site['lon'],
-            'lat': site['lat'],
-            # 'range': site['range'],
-            # 'samples': site['samples'],
-            # 'changeable': site['changeable'],
-            # 'created': site['created'],
-            # 'updated': site['updated'],
-            # 'averageSignal': site['averageSignal']
-        })
+    # the gid_2 bounds lie within the gid_1 bounds, so the national
+    # site index gives the same sites as a scan of the gid_1 subset
+    path_sites = get_sites_path(iso3)
+    ids = query_bbox(path_sites, (xmin, ymin, xmax, ymax))
+    count_records(len(ids))
 
-    if len(output) > 0:
+    if len(ids) > 0:
 
-        output = pd.DataFrame(output)
+        output = read_site_rows(path_sites, ids)[SITE_COLUMNS]
 
         filename = '{}.csv'.format(region)
         folder = os.path.join(DATA_PROCESSED, iso3, 'sites', 'gid_2', 'interim')
@@ -552,6 +784,7 @@ def segment_by_gid_2(iso3, level, region, gid_1):
     return
 
 
+@timed
 def create_regional_sites_layer(iso3, level, region):
     """
     Create regional site layers.
@@ -566,7 +799,7 @@ def create_regional_sites_layer(iso3, level, region):
     filename = 'regions_{}_{}.shp'.format(level, iso3)
     folder = os.path.join(DATA_PROCESSED, iso3, 'regions')
     path = os.path.join(folder, filename)
-    regions = gpd.read_file(path, crs='epsg:4326')#[:1]
+    regions = read_layer(path, crs='epsg:4326')#[:1]
     region_df = regions[regions[gid_level] == region]
     region_df = region_df['geometry'].values[0]
 
@@ -585,18 +818,18 @@ def create_regional_sites_layer(iso3, level, region):
 
     if not os.path.exists(path):
         return
-    sites = pd.read_csv(path)
+
+    path_sites = get_sites_path(iso3)
+    sites = read_site_rows(path_sites, query_bbox(path_sites, region_df.bounds))
+    points = gpd.GeoSeries(gpd.points_from_xy(sites['lon'], sites['lat']))
+    sites = sites[points.intersects(region_df).values]
+    count_records(len(sites))
 
     output = []
 
     for idx, site in sites.iterrows():
 
-        geom = Point(site['lon'], site['lat'])
-
-        if not geom.intersects(region_df):
-            continue
-
-        geom_4326 = geom
+        geom_4326 = Point(site['lon'], site['lat'])
 
         geom_3857 = transform(project.transform, geom_4326)
 
@@ -629,57 +862,312 @@ def create_regional_sites_layer(iso3, level, region):
     return
 
 
-def export_cell_counts(country, regions):
+def order_radios(counts):
     """
-    Aggregate cell counts.
+    Order the radio columns of a count table, with the gsm, umts and lte
+    columns first (zero if absent) followed by any other radios.
 
     """
-    gid_level = "GID_{}".format(country['gid_region'])
+    for radio in ['gsm', 'umts', 'lte']:
+        if not radio in counts.columns:
+            counts[radio] = 0
+
+    radios = ['gsm', 'umts', 'lte'] + sorted(
+        [radio for radio in counts.columns if not radio in ['gsm', 'umts', 'lte']])
+
+    counts = counts[radios]
+    counts.columns.name = None
+
+    return counts
+
+
+def get_site_labels_path(iso3):
+    """
+    Return the path of the site to region labels table.
+
+    """
+    return os.path.join(DATA_PROCESSED, iso3, 'sites', 'site_regions.parquet')
+
+
+@timed
+def label_sites(country):
+    """
+    Label each site in the national sites table with the GADM regions
+    it lies within, down to the country's regional level.
+
+    The labels table holds the row position of each site in the national
+    sites table (site_id) and a GID column per level. Sites outside all
+    regions are left out.
+
+    """
+    iso3 = country['iso3']
+    level = int(country['gid_region'])
+
+    path_sites = get_sites_path(iso3)
+    path_out = get_site_labels_path(iso3)
+
+    filename = 'regions_{}_{}.shp'.format(level, iso3)
+    path_regions = os.path.join(DATA_PROCESSED, iso3, 'regions', filename)
+
+    gid_levels = ['GID_{}'.format(i) for i in range(1, level + 1)]
+    regions = read_layer(path_regions, crs='epsg:4326')[gid_levels + ['geometry']]
+
+    if is_chunked():
+        check_sites_schema(path_sites)
+        chunks = iter_chunks(path_sites, columns=['lon', 'lat'])
+    else:
+        chunks = [read_sites(path_sites, ['lon', 'lat'])]
 
     output = []
+    offset = 0
 
-    for region in regions:#[:1]:
+    for sites in chunks:
 
-        filename = '{}.csv'.format(region[gid_level])
-        folder = os.path.join(DATA_PROCESSED, country['iso3'], 'sites', gid_level.lower())
-        path = os.path.join(folder, filename)
-        if not os.path.exists(path):
-            continue
-        cells = pd.read_csv(path)
-        cells = cells.to_dict('records')
-        
-        # for radio in ['GSM','UMTS','LTE']:
-        #     count = 0
-        gsm = 0
-        umts = 0
-        lte = 0
-
-        for cell in cells: 
-            if cell['radio'] == 'GSM':
-                gsm +=1
-            elif cell['radio'] == 'UMTS':
-                umts +=1
-            elif cell['radio'] == 'LTE':
-                lte +=1
+        ids = np.arange(offset, offset + len(sites), dtype='int64')
+        output.append(label_points(ids, sites['lon'], sites['lat'], regions))
+        offset += len(sites)
 
-        output.append({
-            'gid_id': region[gid_level],
-            'gid_level': gid_level,
-            'gsm': gsm,
-            'umts': umts,
-            'lte': lte,
-        })
+    count_records(offset)
+
+    if len(output) > 0:
+        output = pd.concat(output, ignore_index=True)
+    else:
+        output = pd.DataFrame(columns=['site_id'] + gid_levels)
+
+    output = output.sort_values('site_id').reset_index(drop=True)
+    output.to_parquet(path_out, index=False)
+
+    return
+
+
+def label_points(ids, lon, lat, regions):
+    """
+    Return the GID columns of the regions holding each point, for the
+    points lying within a region.
 
-    output = pd.DataFrame(output)
+    """
+    gid_levels = [column for column in regions.columns if column.startswith('GID_')]
+
+    points = gpd.GeoDataFrame(
+        {'site_id': ids},
+        geometry=gpd.points_from_xy(np.asarray(lon, dtype='float64'),
+            np.asarray(lat, dtype='float64')),
+        crs='epsg:4326'
+    )
+
+    joined = gpd.sjoin(points, regions, how='inner', op='intersects')
+    joined = joined.drop_duplicates('site_id')
+
+    return pd.DataFrame(joined[['site_id'] + gid_levels])
+
+
+def read_site_labels(iso3, columns=SITE_COLUMNS):
+    """
+    Read the national sites joined to their region labels.
+
+    """
+    labels = read_layer(get_site_labels_path(iso3))
+    sites = read_site_rows(get_sites_path(iso3), labels['site_id'].values)
+
+    sites = sites[columns].reset_index(drop=True)
+    for column in labels.columns:
+        sites[column] = labels[column].values
+
+    return sites
+
+
+@timed
+def export_cell_counts(country, regions=None):
+    """
+    Aggregate cell counts by region, radio and operator.
+
+    Counts are produced in one grouped aggregation over the labelled
+    sites, for each GADM level down to the country's regional level:
+
+    - cells_by_region_gid_{level}_long.csv: one row per region, radio
+      and operator (mcc, net).
+    - cells_by_region_gid_{level}_wide.csv: one row per region and
+      operator, with a column per radio.
+
+    The cells_by_region.csv summary holds a column per radio for each
+    region at the regional level.
+
+    """
+    iso3 = country['iso3']
+    level = int(country['gid_region'])
+    gid_level = 'GID_{}'.format(level)
+
+    folder = os.path.join(DATA_PROCESSED, iso3, 'sites')
+
+    sites = read_site_labels(iso3, ['radio', 'mcc', 'net'])
+    sites['radio'] = sites['radio'].astype(str).str.lower()
+    count_records(len(sites))
+
+    if regions is not None:
+        keep = [region[gid_level] for region in regions]
+        sites = sites[sites[gid_level].isin(keep)]
+
+    for i in range(1, level + 1):
+
+        gid = 'GID_{}'.format(i)
+
+        counts = sites.groupby([gid, 'radio', 'mcc', 'net'], observed=True).size()
+        counts = counts.rename('cells').reset_index()
+        counts = counts.rename(columns={gid: 'gid_id'})
+        counts.insert(1, 'gid_level', gid)
+
+        filename = 'cells_by_region_gid_{}_long.csv'.format(i)
+        counts.to_csv(os.path.join(folder, filename), index=False)
+
+        wide = counts.pivot_table(index=['gid_id', 'gid_level', 'mcc', 'net'],
+            columns='radio', values='cells', aggfunc='sum', fill_value=0)
+        wide.columns.name = None
+
+        filename = 'cells_by_region_gid_{}_wide.csv'.format(i)
+        wide.reset_index().to_csv(os.path.join(folder, filename), index=False)
+
+    output = order_radios(sites.groupby([gid_level, 'radio']).size().unstack(fill_value=0))
+    output = output.reset_index().rename(columns={gid_level: 'gid_id'})
+    output.insert(1, 'gid_level', gid_level)
 
     filename = 'cells_by_region.csv'
-    folder = os.path.join(DATA_PROCESSED, country['iso3'], 'sites')
     path_out = os.path.join(folder, filename)
     output.to_csv(path_out, index=False)
 
     return
 
 
+def get_tile_counts_path(iso3):
+    """
+    Return the path of the observed cells by tile table.
+
+    """
+    return os.path.join(DATA_PROCESSED, iso3, 'sites', 'cells_by_tile.csv')
+
+
+@timed
+def export_tile_cell_counts(country, side_length_lower=10000):
+    """
+    Count the observed cells by radio in each lower grid tile.
+
+    Sites are projected to EPSG:3857 and assigned to tiles by binning
+    their coordinates on the regular grid (see grid.get_tile_ids), so
+    no polygon tests are needed. Counts are written as one observed_{radio}
+    column per radio, keyed by tile id.
+
+    """
+    iso3 = country['iso3']
+
+    path_sites = get_sites_path(iso3)
+
+    if is_chunked():
+        check_sites_schema(path_sites)
+        chunks = iter_chunks(path_sites, columns=['radio', 'lon', 'lat'])
+    else:
+        chunks = [read_sites(path_sites, ['radio', 'lon', 'lat'])]
+
+    project = pyproj.Transformer.from_crs('EPSG:4326', 'EPSG:3857',
+        always_xy=True)
+    lookup = get_tile_lookup(iso3, side_length_lower)
+
+    output = []
+
+    for sites in chunks:
+
+        x, y = project.transform(sites['lon'].values.astype('float64'),
+            np.clip(sites['lat'].values.astype('float64'), -85, 85))
+
+        counts = pd.DataFrame({
+            'id_lower': get_tile_ids(iso3, x, y, side_length_lower, lookup),
+            'radio': sites['radio'].astype(str).str.lower().values,
+        })
+        count_records(len(counts))
+        counts = counts[counts['id_lower'].notnull()]
+        output.append(counts.groupby(['id_lower', 'radio']).size())
+
+    if len(output) > 0:
+        output = pd.concat(output).groupby(level=[0, 1]).sum()
+    else:
+        output = pd.Series([], dtype='int64', index=pd.MultiIndex.from_arrays(
+            [[], []], names=['id_lower', 'radio']))
+
+    output = order_radios(output.unstack(fill_value=0))
+    output.columns = ['observed_{}'.format(radio) for radio in output.columns]
+
+    output.reset_index().to_csv(get_tile_counts_path(iso3), index=False)
+
+    return
+
+
+@timed
+def export_first_observed(country, side_length_lower=10000):
+    """
+    Count the cells by the year they were first observed (the OpenCelliD
+    created timestamp), for each radio in each lower grid tile and each
+    region, for comparison with the backcast deployment years.
+
+    Requires a sites table written with `timestamps` set in the [sites]
+    section of script_config.ini.
+
+    """
+    iso3 = country['iso3']
+    level = int(country['gid_region'])
+
+    path_sites = get_sites_path(iso3)
+    folder = os.path.join(DATA_PROCESSED, iso3, 'sites')
+
+    if not 'created' in pq.read_schema(path_sites).names:
+        raise ValueError('{} has no created timestamps: set timestamps = True '
+            'in the [sites] section and rebuild the sites table'.format(path_sites))
+
+    sites = read_sites(path_sites, ['radio', 'lon', 'lat', 'created'])
+    sites = sites.reset_index(drop=True)
+    count_records(len(sites))
+
+    # cells without a created timestamp are not counted
+    dated = sites['created'].notnull().values
+
+    radio = sites['radio'].astype(str).str.lower().values
+    year = sites['created'].values.astype('datetime64[Y]').astype('int64') + 1970
+
+    project = pyproj.Transformer.from_crs('EPSG:4326', 'EPSG:3857',
+        always_xy=True)
+    x, y = project.transform(sites['lon'].values.astype('float64'),
+        np.clip(sites['lat'].values.astype('float64'), -85, 85))
+
+    observed = pd.DataFrame({
+        'id_lower': get_tile_ids(iso3, x, y, side_length_lower),
+        'radio': radio,
+        'year': year,
+    })
+    observed = observed[observed['id_lower'].notnull() & dated]
+    output = observed.groupby(['id_lower', 'radio', 'year']).size()
+    output = output.rename('cells').reset_index()
+    output.to_csv(os.path.join(folder, 'first_observed_by_tile.csv'), index=False)
+
+    labels = read_layer(get_site_labels_path(iso3))
+
+    for i in range(1, level + 1):
+
+        gid = 'GID_{}'.format(i)
+
+        observed = pd.DataFrame({
+            'gid_id': labels[gid].values,
+            'radio': radio[labels['site_id'].values],
+            'year': year[labels['site_id'].values],
+        })
+        observed = observed[dated[labels['site_id'].values]]
+        output = observed.groupby(['gid_id', 'radio', 'year']).size()
+        output = output.rename('cells').reset_index()
+        output.insert(1, 'gid_level', gid)
+
+        filename = 'first_observed_by_region_gid_{}.csv'.format(i)
+        output.to_csv(os.path.join(folder, filename), index=False)
+
+    return
+
+
+@timed
 def process_regional_coverage(country):
     """
     Cut coverage by region. 
@@ -692,7 +1180,7 @@ def process_regional_coverage(country):
     filename = 'regions_{}_{}.shp'.format(level, iso3)
     folder = os.path.join(DATA_PROCESSED, iso3, 'regions')
     path = os.path.join(folder, filename)
-    regions = gpd.read_file(path)
+    regions = read_layer(path)
     regions = regions.to_crs(3857)
     regions = regions.to_dict('records')#[:1]
 
@@ -708,11 +1196,10 @@ def process_regional_coverage(country):
 
         folder_name = 'MCE_{}'.format(tech)
         folder = os.path.join(DATA_RAW, 'Mobile Coverage Explorer v2020 - GeoTIFF', 'ByCountry', folder_name)
-        path =  os.path.join(folder, 'MCE_MX{}_2020.tif'.format(tech))
+        path =  os.path.join(folder, 'MCE_{}{}_2020.tif'.format(country['iso2'], tech))
 
-        data = rasterio.open(path, 'r+')
-        data.nodata = 255
-        data.crs = {"init": "epsg:3857"}
+        # opened read-only, so the raw layer keeps a stable content hash
+        data = rasterio.open(path, 'r')
 
         for region in regions:
 
@@ -724,6 +1211,8 @@ def process_regional_coverage(country):
             if os.path.exists(path_out):
                 continue
 
+            count_records(1)
+
             list_of_dicts = [{
                     'geometry': region['geometry'], 
                     'properties': {
@@ -734,11 +1223,12 @@ def process_regional_coverage(country):
 
             coords = [json.loads(geo.to_json())['features'][0]['geometry']]
 
-            out_img, out_transform = mask(data, coords, crop=True)
+            out_img, out_transform = mask(data, coords, crop=True, nodata=255)
 
             out_meta = data.meta.copy()
 
             out_meta.update({"driver": "GTiff",
+                            "nodata": 255,
                             "height": out_img.shape[1],
                             "width": out_img.shape[2],
                             "transform": out_transform,
@@ -750,6 +1240,7 @@ def process_regional_coverage(country):
     return output
 
 
+@timed
 def convert_regional_coverage_to_shapes(country):
     """
     Convert to shapes. 
@@ -788,6 +1279,8 @@ def convert_regional_coverage_to_shapes(country):
             # if os.path.exists(path_out):
             #     continue
 
+            count_records(1)
+
             with rasterio.open(os.path.join(folder, tif_file)) as src:
 
                 affine = src.transform
@@ -834,6 +1327,9 @@ if __name__ == "__main__":
 
     MEX = {
         'iso3': 'MEX',
+        'iso2': 'MX',
         'gid_region': 2,
     }
     run_preprocessing(MEX)
+
+    export_report('preprocess')
@@ -10,103 +10,201 @@ import sys
 import os
 import configparser
 import json
-import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
 import geopandas as gpd
-import matplotlib.pyplot as plt
-import contextily as ctx
-import seaborn as sns
+import pyarrow as pa
+import pyarrow.parquet as pq
+import fiona
+
+from layers import read_layer, is_chunked, iter_chunks, iter_features, CHUNK_ROWS
+from instrument import timed, count_records, export_report
+from expression import compile_expression, evaluate
 
 CONFIG = configparser.ConfigParser()
 CONFIG.read(os.path.join(os.path.dirname(__file__),'..', 'scripts', 'script_config.ini'))
 BASE_PATH = CONFIG['file_locations']['base_path']
 
-# # caution: path[0] is reserved for script path (or '' in REPL)
-# sys.path.insert(1, os.path.join(BASE_PATH, '..', 'vis'))
-# from vis import multiplot_tile_deployment
-
 DATA_RAW = os.path.join(BASE_PATH, '..', '..', 'data_raw')
 DATA_PROCESSED = os.path.join(BASE_PATH, 'processed')
 RESULTS = os.path.join(BASE_PATH, '..', 'results')
 VIS = os.path.join(BASE_PATH, '..', 'vis', 'figures')
 
+TILE_COLUMNS = [
+    'id_lower', 'id_upper', 'population', 'area_km2', 'pop_km2',
+    'motorway', 'primary', 'secondary', 'tertiary', 'trunk', 'total',
+    'attractiveness',
+]
+
+RESULTS_SCHEMA = pa.schema([
+    ('id_lower', pa.string()),
+    ('operator', pa.dictionary(pa.int8(), pa.string())),
+    ('year', pa.int16()),
+    ('radio', pa.dictionary(pa.int8(), pa.string())),
+    ('population', pa.int64()),
+    ('users', pa.int64()),
+    ('attractiveness', pa.float64()),
+    ('cells_to_build', pa.int32()),
+    ('cost', pa.int64()),
+    ('population_served', pa.int64()),
+])
+
+ROAD_COLUMNS = ['motorway', 'primary', 'secondary', 'tertiary', 'trunk', 'total']
+
+CSV_COLUMNS = [
+    'id_lower', 'year', 'radio', 'population', 'users',
+    'attractiveness', 'cells_to_build'
+]
+
+# tile attractiveness, as an expression over the tile columns (see expression.py)
+ATTRACTIVENESS = os.environ.get('BACKCAST_ATTRACTIVENESS',
+    CONFIG.get('backcast', 'attractiveness', fallback='pop_km2 + motorway * 10000'))
+
+# boost to the attractiveness of tiles with built neighbours (0 to disable)
+SPILLOVER = CONFIG.getfloat('backcast', 'spillover', fallback=0)
 
+# tile attributes used by the backcast engine
+ENGINE_COLUMNS = ['id_lower', 'population', 'pop_km2', 'motorway', 'attractiveness']
+
+OPERATOR_COLUMNS = ['operator', 'mcc', 'mnc', 'market_share', 'budget_share']
+
+COST_PER_SITE = 150000
+POP_PER_SITE = 5000
+
+# tile arrays shared with the forked operator workers
+TILES = {}
+
+
+@timed
 def load_data(country):
     """
     Loads data. 
 
+    Tiles with roads are listed first, followed by the tiles without,
+    each in population layer order.
+
     """
     filename = 'population_tiles.shp'
     folder_in = os.path.join(DATA_PROCESSED, country['iso3'], 'population')
-    path_in = os.path.join(folder_in, filename)
-    population_data = gpd.read_file(path_in, crs='epsg:4326')
-    population_data = population_data.to_dict('records')
+    path_population = os.path.join(folder_in, filename)
 
     filename = 'road_lengths_by_region.csv'
     folder_in = os.path.join(DATA_PROCESSED, country['iso3'], 'infrastructure')
     path_in = os.path.join(folder_in, filename)
-    road_data = pd.read_csv(path_in)
+    road_data = read_layer(path_in)
     road_data = road_data.to_dict('records')#[:3]
 
+    roads = {}
+    for road_item in road_data:
+        roads.setdefault(road_item['id_lower'], []).append(road_item)
+
+    filename = 'all_data.shp'
+    folder = os.path.join(DATA_PROCESSED, country['iso3'])
+    path_out = os.path.join(folder, filename)
+
+    if is_chunked():
+        return stream_tile_data(path_population, roads, path_out)
+
+    population_data = read_layer(path_population, crs='epsg:4326')
+    population_data = population_data.to_dict('records')
+    count_records(len(population_data))
+
     output = []
-    seen = set()
 
     for pop_item in population_data:
         # if not pop_item['id_lower'] == '-100.01100364962068_16.910656703520466':
         #     continue
-        for road_item in road_data:
-            if pop_item['id_lower'] == road_item['id_lower']:
-                output.append({
-                    'geometry': pop_item['geometry'],
-                    'properties': {
-                        'iso3': pop_item['iso3'],
-                        'id_upper': pop_item['id_upper'],
-                        'id_lower': pop_item['id_lower'],
-                        'population': pop_item['population'],
-                        'area_km2': pop_item['area_km2'],
-                        'pop_km2': pop_item['pop_km2'],
-                        'motorway': road_item['motorway'], 
-                        'primary': road_item['primary'], 
-                        'secondary': road_item['secondary'], 
-                        'tertiary': road_item['tertiary'], 
-                        'trunk': road_item['trunk'], 
-                        'total': road_item['total'], 
-                    }
-                })
-                seen.add(pop_item['id_lower'])
+        for road_item in roads.get(pop_item['id_lower'], []):
+            output.append(get_tile_record(pop_item['geometry'], pop_item, road_item))
 
     for pop_item in population_data:
         # if not pop_item['id_lower'] == '-100.01100364962068_16.910656703520466':
         #     continue
-        if pop_item['id_lower'] not in list(seen):
-            output.append({
-                'geometry': pop_item['geometry'],
-                'properties': {
-                    'iso3': pop_item['iso3'],
-                    'id_upper': pop_item['id_upper'],
-                    'id_lower': pop_item['id_lower'],
-                    'population': pop_item['population'],
-                    'area_km2': pop_item['area_km2'],
-                    'pop_km2': pop_item['pop_km2'],
-                    'motorway': 0, 
-                    'primary': 0, 
-                    'secondary': 0, 
-                    'tertiary': 0, 
-                    'trunk': 0, 
-                    'total': 0, 
-                }
-            })
+        if pop_item['id_lower'] not in roads:
+            output.append(get_tile_record(pop_item['geometry'], pop_item, None))
 
     output = gpd.GeoDataFrame.from_features(output)
     
-    filename = 'all_data.shp'
-    folder = os.path.join(DATA_PROCESSED, country['iso3'])
-    path_out = os.path.join(folder, filename)
     output.to_file(path_out, crs='epsg:4326')
 
     return output
 
 
+def get_tile_record(geometry, pop_item, road_item):
+    """
+    Combine the population and road lengths of a tile into a feature.
+
+    Tiles without roads are given zero road lengths.
+
+    """
+    properties = {
+        'iso3': pop_item['iso3'],
+        'id_upper': pop_item['id_upper'],
+        'id_lower': pop_item['id_lower'],
+        'population': pop_item['population'],
+        'area_km2': pop_item['area_km2'],
+        'pop_km2': pop_item['pop_km2'],
+    }
+
+    for road_class in ROAD_COLUMNS:
+        properties[road_class] = road_item[road_class] if road_item else 0
+
+    return {
+        'geometry': geometry,
+        'properties': properties,
+    }
+
+
+def stream_tile_data(path_population, roads, path_out):
+    """
+    Write the combined tile data while streaming the population tiles,
+    in two passes (tiles with roads, then tiles without) to keep the
+    order of the in-memory run.
+
+    """
+    with fiona.open(path_population) as source:
+        properties = dict(source.schema['properties'])
+        schema = {
+            'geometry': source.schema['geometry'],
+            'properties': properties,
+        }
+    for road_class in ROAD_COLUMNS:
+        properties[road_class] = 'float'
+
+    with fiona.open(path_out, 'w', driver='ESRI Shapefile', crs='epsg:4326',
+            schema=schema) as sink:
+
+        for with_roads in [True, False]:
+            for chunk in iter_features(path_population):
+
+                if with_roads:
+                    count_records(len(chunk))
+
+                output = []
+
+                for feature in chunk:
+                    pop_item = feature['properties']
+                    road_items = roads.get(pop_item['id_lower'], [])
+                    if with_roads:
+                        for road_item in road_items:
+                            output.append(get_tile_record(
+                                feature['geometry'], pop_item, road_item))
+                    elif len(road_items) == 0:
+                        output.append(get_tile_record(
+                            feature['geometry'], pop_item, None))
+
+                for item in output:
+                    item['properties'] = {key: float(value)
+                        if key in ROAD_COLUMNS else value
+                        for key, value in item['properties'].items()}
+
+                sink.writerecords(output)
+
+    return
+
+
 def get_total_cells(cells):
     """
     Get the total number of cells. 
@@ -174,30 +272,69 @@ def spending_proportion(year):
     return lut[year]
     
 
-def generate_tile_backcast(country):
+@timed
+def generate_tile_backcast(country, attractiveness=None, spillover=None,
+    side_length_lower=10000):
     """
     Generate tile backcast data.
 
+    Tile geometry and static tile attributes are written once to
+    `tiles.parquet`, while the deployment results for each radio are
+    written as a typed columnar table to `by_radio/{radio}.parquet`,
+    keyed by operator, radio and tile.
+
+    Each operator (see load_operators) is scheduled with its own market
+    share and budget, with the operators run concurrently. Tiles are
+    ranked by the attractiveness expression (the configured one unless
+    given).
+
+    With a spillover above zero (see schedule_radio), tiles next to built
+    tiles are boosted year by year, using the grid adjacency of the
+    lower tiles of side_length_lower.
+
     """
+    if attractiveness is None:
+        attractiveness = ATTRACTIVENESS
+    if spillover is None:
+        spillover = SPILLOVER
+
     filename = 'all_data.shp'
     folder_in = os.path.join(DATA_PROCESSED, country['iso3'])
     path_in = os.path.join(folder_in, filename)
-    pop_lut = gpd.read_file(path_in, crs='epsg:4326')#[:5]
-    # pop_lut = pop_lut.sort_values(by=['population'], ascending=False)[:1]
-
-    pop_lut['attractiveness'] =  round(
-        pop_lut['pop_km2'] + 
-        (pop_lut['motorway'] * 10000) #+
-        #(pop_lut['primary'] * 10000)  
-        # (pop_lut['secondary'] * 2) + 
-        # (pop_lut['tertiary']), 2
-        )
-    pop_lut = pop_lut.to_dict('records')
 
-    pop_lut = sorted(pop_lut, key=lambda d: d['attractiveness'], reverse=True)#[:1] 
+    folder_out = os.path.join(RESULTS, country['iso3'])
+    if not os.path.exists(folder_out):
+        os.makedirs(folder_out)
+    path_output = os.path.join(folder_out, 'tiles.parquet')
+
+    observed = get_observed(country['iso3'])
+
+    if is_chunked():
+        pop_lut = read_layer(path_in, ignore_geometry=True)
+        pop_lut = add_tile_inputs(pop_lut, country, observed, attractiveness)
+        check_tile_inputs(pop_lut, attractiveness)
+        pop_lut['attractiveness'] = get_attractiveness(pop_lut, attractiveness)
+        stream_tiles(path_in, path_output, country, observed, attractiveness)
+    else:
+        pop_lut = read_layer(path_in, crs='epsg:4326')#[:5]
+        # pop_lut = pop_lut.sort_values(by=['population'], ascending=False)[:1]
+        pop_lut = add_tile_inputs(pop_lut, country, observed, attractiveness)
+        check_tile_inputs(pop_lut, attractiveness)
+        pop_lut['attractiveness'] = get_attractiveness(pop_lut, attractiveness)
+        pop_lut[get_tile_columns(pop_lut) + ['geometry']].to_parquet(
+            path_output, index=False)
+        pop_lut = pop_lut.drop(columns=['geometry'])
+
+    tiles = {column: pop_lut[column].values for column in ENGINE_COLUMNS}
+    count_records(len(pop_lut))
+
+    if spillover > 0:
+        from grid import get_tile_adjacency
+        tiles['indptr'], tiles['indices'] = get_tile_adjacency(country['iso3'],
+            tiles['id_lower'], side_length_lower)
 
     path_in = os.path.join(DATA_PROCESSED, '..', 'raw','cash_to_spend.csv')
-    cash_to_spend_data = pd.read_csv(path_in)#[:5]
+    cash_to_spend_data = read_layer(path_in)#[:5]
     cash_to_spend_data = cash_to_spend_data.to_dict('records')
 
     cash_to_spend = {}
@@ -205,230 +342,454 @@ def generate_tile_backcast(country):
     for item in cash_to_spend_data:
         cash_to_spend[item['year']] = item['cash_to_spend']
 
-    cost_per_site = 150000
-    pop_per_site = 5000
-    market_share = 0.25
+    operators = load_operators(country['iso3'])
+    results = run_operators(tiles, operators, cash_to_spend, spillover)
+
+    folder_out = os.path.join(RESULTS, country['iso3'], 'by_radio')
+    if not os.path.exists(folder_out):
+        os.makedirs(folder_out)
+
+    for radio in ['gsm','umts','lte']:
+
+        filename = '{}.parquet'.format(radio)
+        writer = pq.ParquetWriter(os.path.join(folder_out, filename), RESULTS_SCHEMA)
+
+        for operator in operators:
+            writer.write_table(results[operator['operator']][radio],
+                row_group_size=CHUNK_ROWS)
+
+        writer.close()
+
+    return
+
+
+def load_operators(iso3):
+    """
+    Load the operators to model for a country.
+
+    Operators are listed in raw/operators.csv, with their market share
+    and share of the annual cash to spend (budget_share). Without any
+    operators listed for the country, a single notional operator with a
+    quarter of the market and the full budget is modelled.
+
+    """
+    path = os.path.join(DATA_PROCESSED, '..', 'raw', 'operators.csv')
+
+    if os.path.exists(path):
+        operators = read_layer(path)
+        operators = operators[operators['iso3'] == iso3].copy()
+        if len(operators) > 0:
+            operators['operator'] = operators['operator'].astype(str)
+            return operators[OPERATOR_COLUMNS].to_dict('records')
+
+    return [{
+        'operator': 'all',
+        'mcc': None,
+        'mnc': None,
+        'market_share': 0.25,
+        'budget_share': 1,
+    }]
+
+
+def run_operators(tiles, operators, cash_to_spend, spillover=0):
+    """
+    Run the backcast for each operator, returning the results tables
+    by operator and radio.
+
+    Operators are run concurrently in forked worker processes, which
+    share the read-only tile arrays with the parent rather than copying
+    them.
+
+    """
+    TILES.clear()
+    TILES.update(tiles)
+
+    if len(operators) == 1:
+        return {operators[0]['operator']:
+            run_operator(operators[0], cash_to_spend, spillover)}
+
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing.get_context()
+
+    workers = min(len(operators), os.cpu_count() or 1)
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        futures = {operator['operator']: executor.submit(run_operator,
+            operator, cash_to_spend, spillover) for operator in operators}
+        output = {name: future.result() for name, future in futures.items()}
+
+    return output
+
+
+def run_operator(operator, cash_to_spend, spillover=0):
+    """
+    Run the backcast for one operator over the shared tile arrays.
+
+    """
+    output = {}
 
     for radio in ['gsm','umts','lte']:
 
-        output = []
-        built = set()
-        start, end = start_year(radio)
-
-        for year in range(start, end+5):
-
-            if year == 2021:
-                break 
-
-            spent = 0
-            spending_factor = spending_proportion(year)
-
-            to_spend = cash_to_spend[year] * (spending_factor/100)
-
-            for tile in pop_lut:
-
-                users = math.floor(tile['population'] * market_share)
-
-                if tile['attractiveness'] == 0 and not tile['id_lower'] in built:
-                    output.append({
-                        'geometry': tile['geometry'],
-                        'properties': {
-                            'year': 'NA',
-                            'id_lower': tile['id_lower'],
-                            'id_upper': tile['id_upper'],
-                            'population': tile['population'],
-                            'area_km2': tile['area_km2'],
-                            'pop_km2': tile['pop_km2'],
-                            'users': users,
-                            'cells_to_build': 0,
-                            'radio': 'NA',
-                            'cost': 0,
-                            'population_served': 0,
-                            'motorway': tile['motorway'], 
-                            'primary': tile['primary'], 
-                            'secondary': tile['secondary'], 
-                            'tertiary': tile['tertiary'], 
-                            'trunk': tile['trunk'], 
-                            'total': tile['total'], 
-                            'attractiveness': tile['attractiveness'],
-                        }
-                    })
-                    built.add(tile['id_lower'])
-                    continue
-        
-                if not tile['id_lower'] in built:
-                    if spent < to_spend:
-                        if tile['pop_km2'] < 50 and tile['motorway'] == 0 or tile['attractiveness'] == 0:
-                            output.append({
-                                'geometry': tile['geometry'],
-                                'properties': {
-                                    'year': 'NA',
-                                    'id_lower': tile['id_lower'],
-                                    'id_upper': tile['id_upper'],
-                                    'population': tile['population'],
-                                    'area_km2': tile['area_km2'],
-                                    'pop_km2': tile['pop_km2'],
-                                    'users': users,
-                                    'cells_to_build': 0,
-                                    'radio': 'NA',
-                                    'cost': 0,
-                                    'population_served': 0,
-                                    'motorway': tile['motorway'], 
-                                    'primary': tile['primary'], 
-                                    'secondary': tile['secondary'], 
-                                    'tertiary': tile['tertiary'], 
-                                    'trunk': tile['trunk'], 
-                                    'total': tile['total'], 
-                                    'attractiveness': tile['attractiveness'],
-                                }
-                            })
-                            built.add(tile['id_lower'])
-                            continue
-
-                        cells_to_build = math.ceil(users / pop_per_site)
-                        cost = cells_to_build * cost_per_site
-
-                        output.append({
-                            'geometry': tile['geometry'],
-                            'properties': {
-                                'year': year,
-                                'id_lower': tile['id_lower'],
-                                'id_upper': tile['id_upper'],
-                                'population': tile['population'],
-                                'area_km2': tile['area_km2'],
-                                'pop_km2': tile['pop_km2'],
-                                'users': users,
-                                'cells_to_build': cells_to_build,
-                                'radio': radio,
-                                'cost': cost,
-                                'population_served': round(tile['population']),
-                                'motorway': tile['motorway'], 
-                                'primary': tile['primary'], 
-                                'secondary': tile['secondary'], 
-                                'tertiary': tile['tertiary'], 
-                                'trunk': tile['trunk'], 
-                                'total': tile['total'], 
-                                'attractiveness': tile['attractiveness'],
-                            }
-                        })
-
-                        built.add(tile['id_lower'])
-                        spent += cost
-
-        output = gpd.GeoDataFrame.from_features(output, crs='epsg:4326')
-
-        filename = '{}_tiles.shp'.format(radio)
-        folder_out = os.path.join(RESULTS, country['iso3'], 'by_radio')
-        if not os.path.exists(folder_out):
-            os.makedirs(folder_out)
-        path_output = os.path.join(folder_out, filename)
-        output.to_file(path_output, crs='epsg:4326')
-
-        filename = '{}.csv'.format(radio)
-        folder_out = os.path.join(RESULTS, country['iso3'], 'by_radio')
-        path_output = os.path.join(folder_out, filename)
-        # output = output[output['year'] != 'NA']
-        # output['gid_id'] = 'MEX'
-        output = output[['id_lower','year','radio','population','users', 'attractiveness','cells_to_build']]
-        output.to_csv(path_output, index=False)
+        positions, years = schedule_radio(TILES, radio, cash_to_spend,
+            operator['market_share'], operator['budget_share'], spillover)
+
+        output[radio] = get_results_table(TILES, positions, years, radio,
+            operator['operator'], operator['market_share'])
+
+    return output
+
+
+def schedule_radio(tiles, radio, cash_to_spend, market_share, budget_share=1,
+    spillover=0):
+    """
+    Schedule the deployment of a radio generation across the tiles.
+
+    Tiles are taken in descending order of attractiveness. Each year the
+    tiles not yet reached are built in turn while the year's spending is
+    below its budget, so the tiles reached are those whose exclusive
+    cumulative cost is below the budget. Low density tiles without a
+    motorway, and tiles with zero attractiveness, are recorded as not
+    built (at no cost) when reached, with zero attractiveness tiles all
+    reached in the first year.
+
+    With spillover, the attractiveness of each tile is raised each year
+    by spillover times the share of its neighbours (from the `indptr`
+    and `indices` adjacency arrays in tiles) already built, and the
+    tiles re-ranked.
+
+    Returns the positions of the tiles reached, in the order reached, and
+    the year each was built (-1 where not built).
+
+    """
+    attractiveness = tiles['attractiveness']
+    order = np.argsort(-attractiveness, kind='stable')
+
+    zero = attractiveness == 0
+    excluded = ((tiles['pop_km2'] < 50) & (tiles['motorway'] == 0)) | zero
+
+    users = np.floor(tiles['population'] * market_share)
+    cost = np.where(excluded, 0, np.ceil(users / POP_PER_SITE) * COST_PER_SITE)
+
+    remaining = np.ones(len(order), dtype=bool)
+    positions = []
+    years = []
+
+    if spillover > 0:
+        indptr = tiles['indptr']
+        indices = tiles['indices']
+        degree = np.maximum(np.diff(indptr), 1)
+        built_neighbours = np.zeros(len(order), dtype='int64')
+
+    start, end = start_year(radio)
+
+    for year in range(start, end+5):
+
+        if year == 2021:
+            break
+
+        if spillover > 0 and year > start:
+            boost = 1 + spillover * (built_neighbours / degree)
+            order = np.argsort(-(attractiveness * boost), kind='stable')
+
+        to_spend = (cash_to_spend[year] * budget_share *
+            (spending_proportion(year) / 100))
+
+        idx = order[remaining[order]]
+        spent = np.cumsum(cost[idx]) - cost[idx]
+
+        reached = spent < to_spend
+        if year == start:
+            reached |= zero[idx]
+        idx = idx[reached]
+
+        remaining[idx] = False
+        positions.append(idx)
+        years.append(np.where(excluded[idx], -1, year))
+
+        if spillover > 0:
+            built = idx[~excluded[idx]]
+            starts = indptr[built]
+            counts = indptr[built + 1] - starts
+            steps = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            neighbours = indices[np.repeat(starts, counts) + steps]
+            built_neighbours += np.bincount(neighbours, minlength=len(order))
+
+    if len(positions) == 0:
+        return np.array([], dtype='int64'), np.array([], dtype='int64')
+
+    return np.concatenate(positions), np.concatenate(years)
+
+
+def get_results_table(tiles, positions, years, radio, operator, market_share):
+    """
+    Build the results table for the scheduled tiles of a radio.
+
+    Tiles which are not built are recorded with a missing year and radio.
+
+    """
+    built = years >= 0
+    population = tiles['population'][positions]
+    users = np.floor(population * market_share)
+    cells_to_build = np.where(built, np.ceil(users / POP_PER_SITE), 0)
+
+    data = {
+        'id_lower': pa.array(tiles['id_lower'][positions], pa.string()),
+        'operator': pa.DictionaryArray.from_arrays(
+            np.zeros(len(positions), dtype='int8'), pa.array([operator])),
+        'year': pa.array(years, pa.int16(), mask=~built),
+        'radio': pa.DictionaryArray.from_arrays(
+            pa.array(np.zeros(len(positions), dtype='int8'), mask=~built),
+            pa.array([radio])),
+        'population': pa.array(population, pa.int64()),
+        'users': pa.array(users, pa.int64()),
+        'attractiveness': pa.array(tiles['attractiveness'][positions], pa.float64()),
+        'cells_to_build': pa.array(cells_to_build, pa.int32()),
+        'cost': pa.array(cells_to_build * COST_PER_SITE, pa.int64()),
+        'population_served': pa.array(np.where(built, np.round(population), 0),
+            pa.int64()),
+    }
+
+    return pa.Table.from_pydict(data, schema=RESULTS_SCHEMA)
+
+
+def get_attractiveness(pop_lut, expression=None):
+    """
+    Get the investment attractiveness of each tile, by evaluating the
+    configured expression over the tile columns (rounded to whole
+    numbers).
+
+    """
+    if expression is None:
+        expression = ATTRACTIVENESS
+
+    return np.round(evaluate(compile_expression(expression), pop_lut))
+
+
+def add_tile_inputs(tiles, country, observed, expression=None):
+    """
+    Add the observed cells by radio, and any coverage_{radio} columns
+    used by the attractiveness expression, to the tile attributes.
+
+    The coverage layers are read through validate (and so rasterio) only
+    when the expression uses them, keeping the import of this module
+    light for scenario workers.
+
+    """
+    if expression is None:
+        expression = ATTRACTIVENESS
+
+    tiles = add_observed(tiles, observed)
+
+    for name in compile_expression(expression)['names']:
+
+        if not name.startswith('coverage_') or name in tiles.columns:
+            continue
+
+        from validate import get_tile_coverage, TECHNOLOGIES
+
+        radio = name[len('coverage_'):]
+        covered = None
+        if radio in TECHNOLOGIES:
+            covered = get_tile_coverage(country, tiles, radio)
+        if covered is None:
+            raise ValueError('No coverage layer for {} in the attractiveness '
+                'expression'.format(name))
+
+        tiles[name] = covered.astype('int8')
+
+    return tiles
+
+
+def check_tile_inputs(tiles, expression=None):
+    """
+    Check the columns used by the attractiveness expression vary across
+    the tiles, as a constant column cannot change the ranking.
+
+    A constant coverage_{radio} column raises an error, as it points to a
+    coverage layer which does not line up with the tiles. Other constant
+    columns (e.g. no motorways in a small country) are reported.
+
+    """
+    if expression is None:
+        expression = ATTRACTIVENESS
+
+    for name in compile_expression(expression)['names']:
+
+        if not name in tiles.columns or len(tiles) < 2:
+            continue
+
+        if tiles[name].nunique(dropna=False) > 1:
+            continue
+
+        if name.startswith('coverage_'):
+            raise ValueError('{} is {} for every tile: check the coverage '
+                'layer covers the country'.format(name, tiles[name].iloc[0]))
+
+        print('Warning: {} is {} for every tile, so does not affect the '
+            'attractiveness ranking'.format(name, tiles[name].iloc[0]))
 
     return
 
 
+def get_tile_columns(tiles):
+    """
+    Return the columns written to the tile table.
+
+    """
+    return TILE_COLUMNS + [column for column in tiles.columns
+        if column.startswith('observed_') or column.startswith('coverage_')]
+
+
+def get_observed(iso3):
+    """
+    Load the observed cells by tile (written by
+    preprocess.export_tile_cell_counts), if available.
+
+    """
+    path = os.path.join(DATA_PROCESSED, iso3, 'sites', 'cells_by_tile.csv')
+
+    if not os.path.exists(path):
+        return None
+
+    return read_layer(path)
+
+
+def add_observed(tiles, observed):
+    """
+    Add the observed cells by radio as columns of the tile table, with
+    zero for tiles without observed cells.
+
+    """
+    if observed is None:
+        return tiles
+
+    columns = [column for column in observed.columns if column != 'id_lower']
+    tiles = tiles.merge(observed, on='id_lower', how='left')
+    tiles[columns] = tiles[columns].fillna(0).astype('int64')
+
+    return tiles
+
+
+def stream_tiles(path_in, path_output, country, observed=None, expression=None):
+    """
+    Write the tile geometry and attributes to geoparquet one chunk of
+    tiles at a time.
+
+    """
+    writer = None
+
+    for chunk in iter_chunks(path_in):
+
+        chunk = add_tile_inputs(chunk, country, observed, expression)
+        chunk['attractiveness'] = get_attractiveness(chunk, expression)
+
+        data = pd.DataFrame(chunk[get_tile_columns(chunk)])
+        data['geometry'] = [geom.wkb if geom is not None else None
+            for geom in chunk['geometry']]
+
+        if writer is None:
+            crs = chunk.crs.to_wkt() if chunk.crs is not None else None
+            metadata = {
+                'primary_column': 'geometry',
+                'columns': {'geometry': {'crs': crs, 'encoding': 'WKB'}},
+                'schema_version': '0.1.0',
+                'creator': {'library': 'geopandas', 'version': gpd.__version__},
+            }
+            table = pa.Table.from_pandas(data, preserve_index=False)
+            schema = table.schema.with_metadata(
+                {b'geo': json.dumps(metadata).encode('utf-8')})
+            writer = pq.ParquetWriter(path_output, schema)
+
+        writer.write_table(pa.Table.from_pandas(data, schema=schema,
+            preserve_index=False))
+
+    if writer is not None:
+        writer.close()
+
+    return
+
+
+@timed
 def aggregate_results(country):
     """
     Aggregate the radio generation results to the region level.
 
+    The per radio tables share a schema, so the combined results are
+    produced by concatenating their columns rather than their rows.
+
     """
-    output = []
+    tables = []
 
     for radio in ['gsm','umts','lte']:
 
-        filename = '{}.csv'.format(radio)
+        filename = '{}.parquet'.format(radio)
         folder_in = os.path.join(RESULTS, country['iso3'], 'by_radio')
         path_in = os.path.join(folder_in, filename)
-        data = pd.read_csv(path_in)
-        data = data.to_dict('records')
-        output = output + data
+        tables.append(pq.read_table(path_in))
 
-    output = pd.DataFrame(output)
+    output = pa.concat_tables(tables)
+    count_records(output.num_rows)
 
-    filename = 'results.csv'
     folder_out = os.path.join(RESULTS, country['iso3'])
-    path_output = os.path.join(folder_out, filename)
-    output.to_csv(path_output, index=False)
+    pq.write_table(output, os.path.join(folder_out, 'results.parquet'))
+
+    path_output = os.path.join(folder_out, 'results.csv')
+    write_results_csv(output, path_output)
 
     return
 
 
-def plot_map(country):
+def write_results_csv(table, path_output):
     """
-    Plot map. 
+    Write a results table to csv, keeping the integer column types.
 
     """
-    for radio in [
-        ('gsm', '2G'), 
-        ('umts', '3G'), 
-        ('lte', '4G')
-        ]:
+    output = table.to_pandas(types_mapper={
+        pa.int16(): pd.Int16Dtype(),
+        pa.int32(): pd.Int32Dtype(),
+        pa.int64(): pd.Int64Dtype(),
+    }.get)
 
-        filename = '{}_tiles.shp'.format(radio[0])
-        folder = os.path.join(BASE_PATH, '..', 'results', country['iso3'], 'by_radio')
-        path = os.path.join(folder, filename)
-        shapes = gpd.read_file(path, crs='epsg:4326')
-        shapes = shapes[shapes['year'] != 'NA']
-        shapes['year'] = pd.to_numeric(shapes['year'])
+    output = output[['operator'] + CSV_COLUMNS]
+    output.to_csv(path_output, index=False)
 
-        bins = [1999,2002,2004,2006,2008,2010,2012, 2014, 2016, 2018,2021]
-        labels = ['2000-02','2002-04','2004-06','2006-08','2008-10','2010-12','2012-14','2014-16','2016-18','2018-20']
+    return
 
-        shapes['bin'] = pd.cut(
-            shapes['year'],
-            bins=bins,
-            labels=labels
-        )
 
-        sns.set(font_scale=1, font="Times New Roman")
-        sns.set_style("ticks")
-        fig, ax = plt.subplots(1, 1, figsize=(8,5.85))
-        fig.set_facecolor('gainsboro')
+def load_results(iso3, radio):
+    """
+    Load the results for a single radio joined to the tile geometry.
 
-        minx, miny, maxx, maxy = shapes.total_bounds
-        ax.set_xlim(minx-1, maxx+1)
-        ax.set_ylim(miny-1.5, maxy+1.5)
+    """
+    path = os.path.join(RESULTS, iso3, 'tiles.parquet')
+    tiles = read_layer(path, columns=['id_lower', 'geometry'])
 
-        plt.figure()
+    path = os.path.join(RESULTS, iso3, 'by_radio', '{}.parquet'.format(radio))
+    results = pq.read_table(path).to_pandas()
 
-        base = shapes.plot(
-            column='bin', 
-            ax=ax, 
-            cmap='viridis_r', 
-            linewidth=0.1,
-            legend=True, 
-            edgecolor='grey'
-            )
-        # country_shapes.plot(ax=base, facecolor="none", edgecolor='black', linewidth=0.75)
+    output = tiles.merge(results, on='id_lower', how='inner')
 
-        handles, labels = ax.get_legend_handles_labels()
+    return output
 
-        fig.legend(handles[::-1], labels[::-1])
 
-        ctx.add_basemap(ax, crs=shapes.crs, source=ctx.providers.CartoDB.Voyager)
-        
-        start, end = start_year(radio[0])
-        fig.suptitle('Backcast of {} mobile infrastructure deployment {}-{}'.format(radio[1], start, end), 
-                     fontsize=18, 
-                     fontname='Times New Roman')
+def plot_map(country):
+    """
+    Plot map. 
 
-        fig.tight_layout()
-        filename = '{}_deployment_schedule.png'.format(radio[1])
-        folder = os.path.join(VIS)
-        if not os.path.exists(folder):
-            os.mkdir(folder)
-        fig.savefig(os.path.join(folder, filename), dpi=600)
+    The plotting libraries are only imported when a map is requested, via
+    the rendering functions in vis/vis.py.
 
-        plt.close(fig)
+    """
+    folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'vis')
+    if not folder in sys.path:
+        # caution: path[0] is reserved for script path (or '' in REPL)
+        sys.path.insert(1, folder)
+    from vis import render_all
 
+    return render_all(country['iso3'],
+        ['deployment_gsm', 'deployment_umts', 'deployment_lte'])
 
 
 if __name__ == "__main__":
@@ -450,3 +811,5 @@ if __name__ == "__main__":
     print("Working on plot_map")
     plot_map(country)
 
+    export_report('process')
+
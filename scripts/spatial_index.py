@@ -0,0 +1,212 @@
+"""
+Persisted R-tree indexes for processed layers.
+
+An index is built the first time a layer is queried and written to a
+`.index` folder next to the layer. Later queries (in this or any other
+process) load it from disk, and it is rebuilt whenever the layer is
+rewritten. Index ids are the row positions of the features in the layer,
+so query results can be used directly with `.iloc`.
+
+Shapefiles are indexed by feature bounds, and site csv and parquet
+tables by their lon and lat columns.
+
+October 2026
+
+"""
+import os
+import json
+import itertools
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from rtree import index
+
+from layers import is_chunked, iter_chunks
+
+INDEX_FOLDER = '.index'
+
+INDEXES = {}
+
+
+def get_index_paths(path):
+    """
+    Return the basename of the index for a layer and the path of its
+    metadata file.
+
+    """
+    folder, filename = os.path.split(os.path.abspath(path))
+    basename = os.path.join(folder, INDEX_FOLDER, filename)
+
+    return basename, basename + '.json'
+
+
+def get_layer_stamp(path):
+    """
+    Return the modification time and size identifying a layer version.
+
+    """
+    stat = os.stat(path)
+
+    return {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+
+
+def iter_bounds(path):
+    """
+    Read the bounds of the features in a layer, as arrays of
+    (xmin, ymin, xmax, ymax) rows. In chunked mode the layer is
+    streamed rather than read whole.
+
+    """
+    if path.endswith('.csv') or path.endswith('.parquet'):
+        if is_chunked():
+            chunks = iter_chunks(path, columns=['lon', 'lat'])
+        elif path.endswith('.csv'):
+            chunks = [pd.read_csv(path, usecols=['lon', 'lat'])]
+        else:
+            chunks = [pd.read_parquet(path, columns=['lon', 'lat'])]
+        for points in chunks:
+            x = points['lon'].values.astype('float64')
+            y = points['lat'].values.astype('float64')
+            yield np.column_stack([x, y, x, y])
+        return
+
+    if is_chunked():
+        chunks = iter_chunks(path)
+    else:
+        chunks = [gpd.read_file(path)]
+
+    for layer in chunks:
+        yield layer['geometry'].bounds.values
+
+    return
+
+
+def build_index(path):
+    """
+    Build and persist the R-tree index for a layer.
+
+    The index is written under a temporary name and then moved into
+    place, so concurrent stages never load a partial index.
+
+    """
+    basename, path_meta = get_index_paths(path)
+
+    folder = os.path.dirname(basename)
+    if not os.path.exists(folder):
+        os.makedirs(folder, exist_ok=True)
+
+    stamp = get_layer_stamp(path)
+    count = {'features': 0}
+
+    def stream():
+        for bounds in iter_bounds(path):
+            offset = count['features']
+            count['features'] += len(bounds)
+            for idx in np.flatnonzero(np.isfinite(bounds).all(axis=1)):
+                xmin, ymin, xmax, ymax = bounds[idx]
+                yield (int(offset + idx), (xmin, ymin, xmax, ymax), None)
+
+    interim = '{}.{}'.format(basename, os.getpid())
+
+    properties = index.Property()
+    properties.overwrite = True
+
+    items = stream()
+    first = next(items, None)
+    if first is not None:
+        rtree = index.Index(interim, itertools.chain([first], items),
+            properties=properties)
+    else:
+        rtree = index.Index(interim, properties=properties)
+    rtree.close()
+
+    for ext in ['.idx', '.dat']:
+        os.replace(interim + ext, basename + ext)
+
+    stamp['features'] = count['features']
+    with open(path_meta + '.tmp{}'.format(os.getpid()), 'w') as sink:
+        json.dump(stamp, sink)
+    os.replace(path_meta + '.tmp{}'.format(os.getpid()), path_meta)
+
+    return
+
+
+def is_current(path):
+    """
+    Check whether the persisted index for a layer matches the layer.
+
+    """
+    basename, path_meta = get_index_paths(path)
+
+    if not os.path.exists(path_meta):
+        return False
+
+    with open(path_meta, 'r') as source:
+        meta = json.load(source)
+
+    stamp = get_layer_stamp(path)
+
+    return (meta['mtime_ns'] == stamp['mtime_ns'] and
+        meta['size'] == stamp['size'])
+
+
+def get_index(path):
+    """
+    Return the index for a layer, building it on first use.
+
+    """
+    key = os.path.abspath(path)
+    stamp = get_layer_stamp(path)
+
+    if key in INDEXES and INDEXES[key][0] == stamp:
+        return INDEXES[key][1]
+
+    if not is_current(path):
+        print('Building spatial index for {}'.format(path))
+        build_index(path)
+
+    basename, path_meta = get_index_paths(path)
+    rtree = index.Index(basename)
+
+    INDEXES[key] = (stamp, rtree)
+
+    return rtree
+
+
+def query_bbox(path, bounds):
+    """
+    Return the ids of the features in a layer whose bounds intersect
+    the given (xmin, ymin, xmax, ymax) bounds.
+
+    """
+    rtree = get_index(path)
+
+    return sorted(rtree.intersection(tuple(bounds)))
+
+
+def query_geometry(path, geometry, layer=None, predicate='intersects'):
+    """
+    Return the ids of the features in a layer which meet the predicate
+    with a geometry.
+
+    Candidates are found by bounds using the index. When the loaded
+    layer is given, the candidates are tested exactly against the
+    geometry, otherwise all candidates are returned.
+
+    """
+    ids = query_bbox(path, geometry.bounds)
+
+    if layer is None or len(ids) == 0:
+        return ids
+
+    candidates = layer.iloc[ids]
+
+    if isinstance(candidates, gpd.GeoDataFrame):
+        geoms = candidates['geometry']
+    else:
+        geoms = gpd.GeoSeries(gpd.points_from_xy(
+            candidates['lon'], candidates['lat']), crs='epsg:4326')
+
+    keep = getattr(geoms, predicate)(geometry).values
+
+    return [idx for idx, flag in zip(ids, keep) if flag]
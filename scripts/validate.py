@@ -0,0 +1,270 @@
+"""
+Score a backcast run against the observed infrastructure.
+
+The cells built by the backcast (up to the final year) are compared with
+the observed OpenCelliD cells for each radio, by 10 km tile and by
+region, giving the mean absolute error and Spearman rank correlation.
+The tiles reached by each year are also compared with the 2020 Mobile
+Coverage Explorer coverage of the matching technology, giving the share
+of covered tiles the backcast has reached (hit rate) and the share of
+reached tiles which are covered (precision).
+
+All comparisons are vectorised joins on the tile and region ids, so the
+report can be run after every scenario of a sweep:
+
+    python scripts/validate.py MEX MX --gid-region 2
+
+October 2026
+
+"""
+import os
+import json
+import argparse
+import configparser
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import pyproj
+import rasterio
+from scipy import stats
+
+from layers import read_layer
+from instrument import timed, count_records, export_report
+from weights import aggregate_to_regions
+
+CONFIG = configparser.ConfigParser()
+CONFIG.read(os.path.join(os.path.dirname(__file__), 'script_config.ini'))
+BASE_PATH = CONFIG['file_locations']['base_path']
+
+DATA_RAW = os.path.join(BASE_PATH, '..', '..', 'data_raw')
+DATA_PROCESSED = os.path.join(BASE_PATH, 'processed')
+RESULTS = os.path.join(BASE_PATH, '..', 'results')
+
+RADIOS = ['gsm', 'umts', 'lte']
+
+TECHNOLOGIES = {'gsm': '2G', 'umts': '3G', 'lte': '4G'}
+
+
+def load_backcast(path):
+    """
+    Load the backcast results, keeping the tiles built in each year.
+
+    """
+    results = pq.read_table(path, columns=['id_lower', 'year', 'radio',
+        'cells_to_build']).to_pandas()
+    results = results[results['year'].notnull()]
+    results['radio'] = results['radio'].astype(str)
+    results['year'] = results['year'].astype(int)
+
+    return results
+
+
+def score(observed, modelled):
+    """
+    Return the error metrics comparing observed and modelled counts.
+
+    """
+    observed = np.asarray(observed, dtype='float64')
+    modelled = np.asarray(modelled, dtype='float64')
+
+    if len(observed) > 1 and observed.std() > 0 and modelled.std() > 0:
+        spearman = stats.spearmanr(observed, modelled)[0]
+    else:
+        spearman = np.nan
+
+    return {
+        'n': int(len(observed)),
+        'observed': float(observed.sum()),
+        'modelled': float(modelled.sum()),
+        'mae': float(np.abs(observed - modelled).mean()) if len(observed) else np.nan,
+        'spearman': float(spearman),
+    }
+
+
+def get_tile_coverage(country, tiles, radio):
+    """
+    Return whether the centre of each tile is covered in the Mobile
+    Coverage Explorer layer for a radio, or None if the layer is
+    missing.
+
+    Tile ids hold the EPSG:4326 representative point of each tile, which
+    is projected to the raster crs (EPSG:3857) before looking up its
+    pixel. Nodata pixels are taken as not covered.
+
+    """
+    tech = TECHNOLOGIES[radio]
+    folder = os.path.join(DATA_RAW, 'Mobile Coverage Explorer v2020 - GeoTIFF',
+        'ByCountry', 'MCE_{}'.format(tech))
+    path = os.path.join(folder, 'MCE_{}{}_2020.tif'.format(country['iso2'], tech))
+
+    if not os.path.exists(path):
+        return None
+
+    coords = tiles['id_lower'].str.split('_', expand=True).astype('float64')
+
+    with rasterio.open(path) as src:
+        array = src.read(1)
+        nodata = src.nodata
+        project = pyproj.Transformer.from_crs('EPSG:4326', src.crs.to_wkt(),
+            always_xy=True)
+        x, y = project.transform(coords[0].values, coords[1].values)
+        cols, rows = ~src.transform * (x, y)
+
+    cols = np.floor(cols).astype('int64')
+    rows = np.floor(rows).astype('int64')
+    inside = ((rows >= 0) & (rows < array.shape[0]) &
+        (cols >= 0) & (cols < array.shape[1]))
+
+    covered = np.zeros(len(tiles), dtype=bool)
+    values = array[rows[inside], cols[inside]]
+    covered[inside] = ((values == 1) | (values == 2)) & ~(values == nodata)
+
+    return covered
+
+
+@timed
+def validate_backcast(country, path_results=None, folder_out=None):
+    """
+    Validate a backcast run, writing the report to validation.json with
+    the accuracy and coverage tables as csv files.
+
+    Parameters
+    ----------
+    country : dict
+        Contains all desired country information.
+    path_results : string
+        Backcast results table (defaults to results/{iso3}/results.parquet).
+    folder_out : string
+        Folder for the report (defaults to the folder of the results).
+
+    """
+    iso3 = country['iso3']
+
+    if path_results is None:
+        path_results = os.path.join(RESULTS, iso3, 'results.parquet')
+    if folder_out is None:
+        folder_out = os.path.dirname(path_results)
+
+    results = load_backcast(path_results)
+    count_records(len(results))
+
+    path = os.path.join(RESULTS, iso3, 'tiles.parquet')
+    tiles = pq.read_table(path, columns=['id_lower']).to_pandas()
+    tiles = tiles.drop_duplicates('id_lower').reset_index(drop=True)
+
+    path = os.path.join(DATA_PROCESSED, iso3, 'sites', 'cells_by_tile.csv')
+    observed = read_layer(path).set_index('id_lower')
+    observed = observed.reindex(tiles['id_lower']).fillna(0)
+
+    modelled = results.pivot_table(index='id_lower', columns='radio',
+        values='cells_to_build', aggfunc='sum', fill_value=0)
+    modelled = modelled.reindex(index=tiles['id_lower'], columns=RADIOS).fillna(0)
+
+    accuracy = []
+
+    for radio in RADIOS:
+        column = 'observed_{}'.format(radio)
+        if not column in observed.columns:
+            continue
+        metrics = score(observed[column].values, modelled[radio].values)
+        accuracy.append(dict(scale='tile', radio=radio, **metrics))
+
+    tile_data = modelled.reset_index()
+
+    for level in range(1, int(country['gid_region']) + 1):
+
+        filename = 'cells_by_region_gid_{}_long.csv'.format(level)
+        path = os.path.join(DATA_PROCESSED, iso3, 'sites', filename)
+        if not os.path.exists(path):
+            continue
+
+        counts = read_layer(path)
+        counts = counts.pivot_table(index='gid_id', columns='radio',
+            values='cells', aggfunc='sum', fill_value=0)
+
+        regions = aggregate_to_regions(iso3, level, tile_data, RADIOS)
+        regions = regions.set_index('GID_id')
+        counts = counts.reindex(regions.index).fillna(0)
+
+        for radio in RADIOS:
+            if not radio in counts.columns:
+                continue
+            metrics = score(counts[radio].values, regions[radio].values)
+            accuracy.append(dict(scale='GID_{}'.format(level), radio=radio,
+                **metrics))
+
+    coverage = []
+
+    years = sorted(results['year'].unique())
+    first_year = results.groupby(['id_lower', 'radio'])['year'].min()
+    first_year = first_year.unstack().reindex(index=tiles['id_lower'], columns=RADIOS)
+
+    for radio in RADIOS:
+
+        covered = get_tile_coverage(country, tiles, radio)
+        if covered is None:
+            continue
+
+        built = first_year[radio].values
+
+        for year in years:
+            reached = built <= year
+            hits = int((reached & covered).sum())
+            coverage.append({
+                'radio': radio,
+                'year': int(year),
+                'covered_tiles': int(covered.sum()),
+                'reached_tiles': int(reached.sum()),
+                'hits': hits,
+                'hit_rate': hits / covered.sum() if covered.sum() else np.nan,
+                'precision': hits / reached.sum() if reached.sum() else np.nan,
+            })
+
+    accuracy = pd.DataFrame(accuracy)
+    coverage = pd.DataFrame(coverage)
+
+    if not os.path.exists(folder_out):
+        os.makedirs(folder_out)
+
+    accuracy.to_csv(os.path.join(folder_out, 'validation_accuracy.csv'), index=False)
+    coverage.to_csv(os.path.join(folder_out, 'validation_coverage.csv'), index=False)
+
+    report = {
+        'iso3': iso3,
+        'results': path_results,
+        'accuracy': accuracy.replace({np.nan: None}).to_dict('records'),
+        'coverage': coverage.replace({np.nan: None}).to_dict('records'),
+    }
+
+    with open(os.path.join(folder_out, 'validation.json'), 'w') as sink:
+        json.dump(report, sink, indent=2)
+
+    for item in report['accuracy']:
+        print('{} {}: MAE {}, Spearman {}'.format(item['scale'], item['radio'],
+            round(item['mae'], 2) if item['mae'] is not None else None,
+            round(item['spearman'], 3) if item['spearman'] is not None else None))
+
+    return report
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('iso3', help='country ISO3 code')
+    parser.add_argument('iso2', help='country ISO2 code (for the coverage layers)')
+    parser.add_argument('--gid-region', type=int, default=2)
+    parser.add_argument('--results', default=None,
+        help='backcast results table to score')
+    parser.add_argument('--output', default=None,
+        help='folder for the report')
+    args = parser.parse_args()
+
+    country = {
+        'iso3': args.iso3,
+        'iso2': args.iso2,
+        'gid_region': args.gid_region,
+    }
+
+    validate_backcast(country, args.results, args.output)
+
+    export_report('validate')
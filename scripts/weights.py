@@ -0,0 +1,240 @@
+"""
+Link grid tiles to GADM regions with sparse overlap weights.
+
+For each regional level, the weight of a tile in a region is the share
+of the tile area lying within that region. Any tile level column can
+then be rolled up to the regions with a single sparse matrix product.
+
+October 2026
+
+"""
+import os
+import json
+import configparser
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from scipy import sparse
+
+from layers import read_layer
+from instrument import timed, count_records, export_report
+
+CONFIG = configparser.ConfigParser()
+CONFIG.read(os.path.join(os.path.dirname(__file__), 'script_config.ini'))
+BASE_PATH = CONFIG['file_locations']['base_path']
+
+DATA_PROCESSED = os.path.join(BASE_PATH, 'processed')
+RESULTS = os.path.join(BASE_PATH, '..', 'results')
+
+METRICS = ['cells_to_build', 'cost', 'population_served']
+
+REGION_SCHEMA = pa.schema([
+    ('GID_id', pa.string()),
+    ('radio', pa.dictionary(pa.int8(), pa.string())),
+    ('year', pa.int16()),
+    ('population', pa.float64()),
+    ('cells_to_build', pa.float64()),
+    ('cost', pa.float64()),
+    ('population_served', pa.float64()),
+])
+
+
+def get_weights_path(iso3, level):
+    """
+    Return the paths of the weight matrix and its tile and region ids.
+
+    """
+    folder = os.path.join(DATA_PROCESSED, iso3, 'weights')
+    filename = 'tile_weights_gid_{}'.format(level)
+
+    return (os.path.join(folder, filename + '.npz'),
+        os.path.join(folder, filename + '_ids.json'))
+
+
+@timed
+def generate_tile_region_weights(country, side_length_lower=10000):
+    """
+    Compute the tile to region overlap weights for each regional level.
+
+    Parameters
+    ----------
+    country : dict
+        Contains all desired country information.
+    side_length_lower : int
+        Side length of the lower grid tiles in meters.
+
+    """
+    iso3 = country['iso3']
+
+    folder = os.path.join(DATA_PROCESSED, iso3, 'weights')
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+    filename = 'grid_{}_{}_km.shp'.format(side_length_lower, side_length_lower)
+    path = os.path.join(DATA_PROCESSED, iso3, 'grid', filename)
+    tiles = read_layer(path, crs='epsg:4326')[['GID_id', 'geometry']]
+    tiles = tiles.drop_duplicates('GID_id').to_crs('epsg:3857')
+    tiles = tiles.reset_index(drop=True)
+    tiles['tile_area'] = tiles['geometry'].area
+    tiles['tile_index'] = np.arange(len(tiles))
+    count_records(len(tiles))
+
+    for level in range(1, int(country['gid_region']) + 1):
+
+        gid_level = 'GID_{}'.format(level)
+
+        filename = 'regions_{}_{}.shp'.format(level, iso3)
+        path = os.path.join(DATA_PROCESSED, iso3, 'regions', filename)
+        regions = read_layer(path, crs='epsg:4326')[[gid_level, 'geometry']]
+        regions = regions.dissolve(gid_level).reset_index()
+        regions = regions.to_crs('epsg:3857')
+        regions['region_index'] = np.arange(len(regions))
+
+        overlap = gpd.overlay(tiles, regions, how='intersection',
+            keep_geom_type=True)
+
+        values = (overlap['geometry'].area / overlap['tile_area']).values
+        values = np.clip(values, 0, 1)
+
+        matrix = sparse.coo_matrix(
+            (values, (overlap['region_index'].values, overlap['tile_index'].values)),
+            shape=(len(regions), len(tiles))
+        ).tocsr()
+        matrix.sum_duplicates()
+
+        path_matrix, path_ids = get_weights_path(iso3, level)
+        sparse.save_npz(path_matrix, matrix)
+        with open(path_ids, 'w') as sink:
+            json.dump({
+                'tiles': tiles['GID_id'].tolist(),
+                'regions': regions[gid_level].tolist(),
+            }, sink)
+
+        print('Wrote {} tile weights for {} regions'.format(matrix.nnz, len(regions)))
+
+    return
+
+
+def load_weights(iso3, level):
+    """
+    Load the weight matrix (regions by tiles) with the tile and
+    region ids for its columns and rows.
+
+    """
+    path_matrix, path_ids = get_weights_path(iso3, level)
+
+    matrix = sparse.load_npz(path_matrix).tocsr()
+    with open(path_ids, 'r') as source:
+        ids = json.load(source)
+
+    return matrix, ids['tiles'], ids['regions']
+
+
+def aggregate_to_regions(iso3, level, data, columns, id_column='id_lower'):
+    """
+    Roll up tile level columns to the regions of a given level.
+
+    Columns are treated as totals (e.g. population or cells), with tiles
+    split between regions by their share of area. Tiles missing from the
+    data contribute zero.
+
+    Parameters
+    ----------
+    iso3 : string
+        Country ISO3 code.
+    level : int
+        GADM regional level.
+    data : dataframe
+        Tile level data. Tiles listed more than once (e.g. once per road
+        class) are taken from their first row.
+    columns : list
+        Columns to roll up.
+    id_column : string
+        Column holding the tile ids.
+
+    """
+    matrix, tiles, regions = load_weights(iso3, level)
+
+    data = data.drop_duplicates(id_column)
+    values = data.set_index(id_column)[columns].reindex(tiles)
+    values = values.fillna(0).values.astype('float64')
+
+    output = pd.DataFrame(matrix @ values, columns=columns)
+    output.insert(0, 'GID_id', regions)
+
+    return output
+
+
+@timed
+def generate_region_backcast(country):
+    """
+    Roll up the tile backcast results to each regional level.
+
+    All radio and year combinations are aggregated in one sparse
+    product, by pivoting the results to one column per combination.
+
+    """
+    iso3 = country['iso3']
+
+    path = os.path.join(RESULTS, iso3, 'tiles.parquet')
+    tiles = pq.read_table(path, columns=['id_lower', 'population']).to_pandas()
+    tiles = tiles.drop_duplicates('id_lower').reset_index(drop=True)
+
+    path = os.path.join(RESULTS, iso3, 'results.parquet')
+    results = pq.read_table(path, columns=['id_lower', 'year', 'radio'] + METRICS)
+    results = results.to_pandas()
+    results = results[results['year'].notnull()]
+    results['radio'] = results['radio'].astype(str)
+    results['year'] = results['year'].astype(int)
+    count_records(len(results))
+
+    wide = results.pivot_table(index='id_lower', columns=['radio', 'year'],
+        values=METRICS, aggfunc='sum', fill_value=0)
+    keys = list(wide.columns)
+    wide.columns = range(len(keys))
+    wide = wide.reset_index()
+
+    for level in range(1, int(country['gid_region']) + 1):
+
+        population = aggregate_to_regions(iso3, level, tiles, ['population'])
+        rolled = aggregate_to_regions(iso3, level, wide, list(range(len(keys))))
+
+        rolled = rolled.set_index('GID_id')
+        rolled.columns = pd.MultiIndex.from_tuples(keys,
+            names=['metric', 'radio', 'year'])
+        output = rolled.stack(['radio', 'year']).reset_index()
+        output = output.merge(population, on='GID_id', how='left')
+
+        for metric in METRICS:
+            if not metric in output.columns:
+                output[metric] = 0.0
+
+        output = output[REGION_SCHEMA.names].sort_values(['GID_id', 'radio', 'year'])
+        output['radio'] = output['radio'].astype('category')
+
+        folder_out = os.path.join(RESULTS, iso3)
+        filename = 'regions_gid_{}'.format(level)
+        table = pa.Table.from_pandas(output, schema=REGION_SCHEMA,
+            preserve_index=False)
+        pq.write_table(table, os.path.join(folder_out, filename + '.parquet'))
+        output.to_csv(os.path.join(folder_out, filename + '.csv'), index=False)
+
+    return
+
+
+if __name__ == '__main__':
+
+    country = {
+        'iso3': 'MEX',
+        'gid_region': 2,
+    }
+
+    print('Generating tile to region weights')
+    generate_tile_region_weights(country)
+
+    print('Generating region backcast results')
+    generate_region_backcast(country)
+
+    export_report('weights')
@@ -0,0 +1,63 @@
+"""
+Tests for the attractiveness expression whitelist.
+
+"""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'scripts'))
+
+from expression import compile_expression, evaluate
+
+
+@pytest.mark.parametrize('expression', [
+    'tiles.population',
+    'population.__class__',
+    'population[0]',
+    'clip(population, a_min=0)',
+    "population + 'a'",
+    'population * True',
+    'population + None',
+    'lambda: population',
+    '__import__("os")',
+    'open("file")',
+    '[population]',
+    'population if motorway else 0',
+])
+def test_rejects_syntax(expression):
+    with pytest.raises(ValueError):
+        compile_expression(expression)
+
+
+@pytest.mark.parametrize('expression', [
+    '10 ** 10 ** 10',
+    'population ** 100',
+    'population ** (10 ** 10)',
+    'population ** -11',
+])
+def test_rejects_large_exponents(expression):
+    with pytest.raises(ValueError):
+        compile_expression(expression)
+
+
+def test_evaluates_columns():
+    tiles = pd.DataFrame({
+        'pop_km2': [1, 2, 3],
+        'motorway': [0, 1, 0],
+    })
+
+    compiled = compile_expression('pop_km2 + motorway * 10000 + pop_km2 ** 2')
+
+    assert compiled['names'] == ['motorway', 'pop_km2']
+    np.testing.assert_allclose(evaluate(compiled, tiles), [2, 10006, 12])
+
+
+def test_rejects_unknown_columns():
+    tiles = pd.DataFrame({'pop_km2': [1, 2, 3]})
+
+    with pytest.raises(ValueError):
+        evaluate(compile_expression('pop_km2 + roads'), tiles)
@@ -0,0 +1,158 @@
+"""
+Local basemap tile store.
+
+The basemap for a country is seeded once, for the national extent (plus
+the plotting margin) at each requested zoom level, and written as a
+GeoTIFF. When `offline` is set in the [basemap] section of
+script_config.ini, figures are drawn from these files rather than
+fetching tiles over the network.
+
+Seed a country with:
+
+    python vis/basemap.py MEX --zooms 5 6 7
+
+October 2026
+
+"""
+import os
+import sys
+import argparse
+import configparser
+import geopandas as gpd
+import contextily as ctx
+
+CONFIG = configparser.ConfigParser()
+CONFIG.read(os.path.join(os.path.dirname(__file__), '..', 'scripts', 'script_config.ini'))
+BASE_PATH = CONFIG['file_locations']['base_path']
+
+DATA_PROCESSED = os.path.join(BASE_PATH, 'processed')
+
+# margin (in degrees) used by the figures around the national outline
+MARGIN = 2
+
+SOURCE = ctx.providers.CartoDB.Voyager
+
+
+def get_setting(key, default=''):
+    """
+    Get a basemap setting from the config file.
+
+    """
+    if CONFIG.has_option('basemap', key):
+        return CONFIG['basemap'][key]
+
+    return default
+
+
+def get_cache_folder():
+    """
+    Return the folder holding the seeded basemaps and tile cache.
+
+    """
+    folder = get_setting('cache_folder', 'basemaps')
+
+    return os.path.join(BASE_PATH, folder)
+
+
+def get_basemap_path(iso3, zoom):
+    """
+    Return the path of the seeded basemap for a country and zoom level.
+
+    """
+    filename = '{}_z{}.tif'.format(iso3, zoom)
+
+    return os.path.join(get_cache_folder(), filename)
+
+
+def seed_basemap(iso3, zooms):
+    """
+    Fetch and store the basemap for the national extent at each
+    zoom level.
+
+    Parameters
+    ----------
+    iso3 : string
+        Country ISO3 code.
+    zooms : list
+        Tile zoom levels to seed.
+
+    """
+    folder = get_cache_folder()
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+    path = os.path.join(DATA_PROCESSED, iso3, 'national_outline.shp')
+    country = gpd.read_file(path, crs='epsg:4326')
+    minx, miny, maxx, maxy = country.total_bounds
+
+    west = max(minx - MARGIN, -180)
+    east = min(maxx + MARGIN, 180)
+    south = max(miny - MARGIN, -85)
+    north = min(maxy + MARGIN, 85)
+
+    for zoom in zooms:
+
+        path_out = get_basemap_path(iso3, zoom)
+
+        if os.path.exists(path_out):
+            print('Basemap already seeded: {}'.format(path_out))
+            continue
+
+        print('Seeding {} basemap at zoom {}'.format(iso3, zoom))
+        ctx.bounds2raster(west, south, east, north, path_out,
+            zoom=int(zoom), source=SOURCE, ll=True)
+
+    return
+
+
+def get_basemap_source(iso3):
+    """
+    Return the basemap source to draw for a country.
+
+    In offline mode this is the seeded GeoTIFF for the configured zoom
+    level (or the most detailed one seeded). Otherwise the tile provider
+    is returned, with fetched tiles kept in the local cache folder.
+
+    """
+    if not CONFIG.getboolean('basemap', 'offline', fallback=False):
+        folder = os.path.join(get_cache_folder(), 'tiles')
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        ctx.set_cache_dir(folder)
+        return SOURCE
+
+    zoom = get_setting('zoom')
+    if zoom:
+        path = get_basemap_path(iso3, zoom)
+        if os.path.exists(path):
+            return path
+
+    folder = get_cache_folder()
+    prefix = '{}_z'.format(iso3)
+    zooms = []
+    if os.path.exists(folder):
+        for filename in os.listdir(folder):
+            if filename.startswith(prefix) and filename.endswith('.tif'):
+                zooms.append(int(filename[len(prefix):-4]))
+
+    if len(zooms) == 0:
+        raise FileNotFoundError(
+            'No basemap seeded for {} in {}: run vis/basemap.py {}'.format(
+                iso3, folder, iso3))
+
+    return get_basemap_path(iso3, max(zooms))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Seed the local basemap store.')
+    parser.add_argument('iso3', help='country ISO3 code')
+    parser.add_argument('--zooms', nargs='+', type=int, default=None,
+        help='zoom levels to seed (defaults to the configured zoom)')
+    args = parser.parse_args()
+
+    zooms = args.zooms
+    if zooms is None:
+        zooms = [int(get_setting('zoom', 6))]
+
+    seed_basemap(args.iso3, zooms)
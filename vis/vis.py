@@ -7,86 +7,222 @@ September 2023
 
 """
 import os
+import sys
 import configparser
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
 import geopandas as gpd
+import matplotlib
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
-# import seaborn as sns
+from matplotlib.colors import ListedColormap
+import rasterio
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.warp import calculate_default_transform, reproject
 import contextily as ctx
-from pylab import * #is this needed
-# import imageio
 import seaborn as sns
 
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), '..', 'scripts'))
+from instrument import timed, count_records, export_report, get_report, reset_report
+from process import load_results, start_year
+from basemap import get_basemap_source
+
 CONFIG = configparser.ConfigParser()
 CONFIG.read(os.path.join(os.path.dirname(__file__), '..', 'scripts', 'script_config.ini'))
 BASE_PATH = CONFIG['file_locations']['base_path']
 
+DATA_RAW = os.path.join(BASE_PATH, '..', '..', 'data_raw')
 DATA_PROCESSED = os.path.join(BASE_PATH, 'processed')
 VIS = os.path.join(BASE_PATH, '..', 'vis', 'figures')
 
+# longest side (in pixels) of the downsampled coverage rasters
+COVERAGE_PIXELS = 2000
+
+# layers preloaded by render_all, inherited by forked rendering workers
+LAYERS = {}
 
-def plot_coverage(iso3):
+
+def get_iso2(iso3):
     """
-    Plot regions by geotype.
+    Get the ISO2 code for a country from its national outline.
 
     """
-    for radio in [
-        ('gsm', '2G'),
-        ('umts', '3G'),
-        ('lte', '4G')
-        ]:
+    path = os.path.join(DATA_PROCESSED, iso3, 'national_outline.shp')
+    outline = gpd.read_file(path, ignore_geometry=True)
+
+    return outline['iso2'].values[0]
+
+
+def load_coverage(iso3, tech, pixels=COVERAGE_PIXELS):
+    """
+    Load the national coverage for a technology as a downsampled
+    raster in WGS84, caching the array for later figures.
+
+    The Mobile Coverage Explorer raster is read decimated to the figure
+    resolution (using the raster overviews where present), so memory
+    is bounded by the output size rather than the raster size. Values of
+    1 and 2 are treated as covered.
+
+    """
+    folder = os.path.join(DATA_PROCESSED, iso3, 'coverage')
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    path_out = os.path.join(folder, 'coverage_{}_{}.npz'.format(tech, pixels))
+
+    if os.path.exists(path_out):
+        cached = np.load(path_out)
+        return {'array': cached['array'], 'extent': tuple(cached['extent'])}
+
+    folder_name = 'MCE_{}'.format(tech)
+    folder = os.path.join(DATA_RAW, 'Mobile Coverage Explorer v2020 - GeoTIFF', 'ByCountry', folder_name)
+    path = os.path.join(folder, 'MCE_{}{}_2020.tif'.format(get_iso2(iso3), tech))
+
+    with rasterio.open(path, 'r') as src:
+
+        scale = max(src.width, src.height) / pixels
+        width = max(int(src.width / scale), 1) if scale > 1 else src.width
+        height = max(int(src.height / scale), 1) if scale > 1 else src.height
+        count_records(width * height)
+
+        array = src.read(1, out_shape=(height, width), resampling=Resampling.nearest)
+        array = ((array == 1) | (array == 2)).astype('uint8')
+
+        transform = src.transform * src.transform.scale(
+            src.width / width, src.height / height)
+
+        if src.crs != CRS.from_epsg(4326):
+
+            dst_transform, dst_width, dst_height = calculate_default_transform(
+                src.crs, 'epsg:4326', width, height, *src.bounds)
+            destination = np.zeros((dst_height, dst_width), dtype='uint8')
+
+            reproject(
+                array,
+                destination,
+                src_transform=transform,
+                src_crs=src.crs,
+                dst_transform=dst_transform,
+                dst_crs='epsg:4326',
+                resampling=Resampling.nearest
+            )
+
+            array, transform = destination, dst_transform
+
+    height, width = array.shape
+    extent = (transform.c, transform.c + transform.a * width,
+        transform.f + transform.e * height, transform.f)
+
+    np.savez_compressed(path_out, array=array, extent=np.array(extent))
+
+    return {'array': array, 'extent': extent}
 
-        shapes = []
-
-        folder_in = os.path.join(DATA_PROCESSED, iso3, 'coverage', 'coverage_{}_shps'.format(radio[1]))
-        path = os.path.join(folder_in, '..', 'coverage_{}.shp'.format(radio[1]))
-                            
-        if not os.path.exists(path):
-            filenames = os.listdir(folder_in)#[:10]
-            for filename in filenames:
-                if not filename.endswith('.shp'):
-                    continue
-                path_in = os.path.join(folder_in, filename)
-                data = gpd.read_file(path_in, crs='epsg:4326')
-                data = data.to_dict('records')
-                for item in data:
-
-                    value = item['value']
-                    if item['value'] == 2:
-                        value = 1
-                    elif item['value'] == 3:
-                        value = 0
-
-                    shapes.append({
-                        'geometry': item['geometry'],
-                        'properties': {
-                            'coverage': value
-                        }
-                    })
-
-            shapes = gpd.GeoDataFrame.from_features(shapes, crs='epsg:4326')
-            shapes.to_file(path, crs='epsg:4326')  
-
-    path_in = os.path.join(DATA_PROCESSED, iso3, 'coverage', 'coverage_2G.shp')
-    coverage_2G = gpd.read_file(path_in, crs='epsg:4326')
-
-    path_in = os.path.join(DATA_PROCESSED, iso3, 'coverage', 'coverage_3G.shp')
-    coverage_3G = gpd.read_file(path_in, crs='epsg:4326')
-
-    path_in = os.path.join(DATA_PROCESSED, iso3, 'coverage', 'coverage_4G.shp')
-    coverage_4G = gpd.read_file(path_in, crs='epsg:4326')
-
-    coverage_2G = coverage_2G[coverage_2G['coverage'] == 1] 
-    coverage_3G = coverage_3G[coverage_3G['coverage'] == 1] 
-    coverage_4G = coverage_4G[coverage_4G['coverage'] == 1] 
+
+def plot_coverage_raster(ax, coverage, color, zorder):
+    """
+    Draw a coverage raster on a set of axes, leaving uncovered areas
+    transparent.
+
+    """
+    array = np.ma.masked_equal(coverage['array'], 0)
+
+    ax.imshow(array, extent=coverage['extent'], cmap=ListedColormap([color]),
+        interpolation='nearest', zorder=zorder)
+
+    return
+
+
+def load_layer(iso3, name):
+    """
+    Load a single named layer used by the figures.
+
+    """
+    if name == 'outline':
+        path = os.path.join(DATA_PROCESSED, iso3, 'national_outline.shp')
+        return gpd.read_file(path, crs='epsg:4326')
+    elif name == 'tiles':
+        path = os.path.join(DATA_PROCESSED, iso3, 'all_data.shp')
+        return gpd.read_file(path, crs='epsg:4326')
+    elif name == 'roads':
+        path = os.path.join(DATA_PROCESSED, iso3, 'infrastructure', 'road_network_processed.shp')
+        return gpd.read_file(path, crs='epsg:4326')
+    elif name == 'attractiveness':
+        path = os.path.join(BASE_PATH, '..', 'results', iso3, 'tiles.parquet')
+        return gpd.read_parquet(path)
+    elif name.startswith('coverage_'):
+        return load_coverage(iso3, name.split('_')[1])
+    elif name.startswith('results_'):
+        return load_results(iso3, name.split('_')[1])
+
+    raise KeyError('Unknown layer: {}'.format(name))
+
+
+def get_layer(iso3, name, layers=None):
+    """
+    Get a layer from the preloaded layers, or load it from disk.
+
+    Preloaded layers are shared between figures, so they are copied
+    before being returned.
+
+    """
+    if layers and name in layers:
+        return layers[name].copy()
+
+    return load_layer(iso3, name)
+
+
+def add_basemap(ax, crs, iso3):
+    """
+    Add the basemap to a set of axes, from the local store when offline.
+
+    """
+    ctx.add_basemap(ax, crs=crs, source=get_basemap_source(iso3))
+
+    return
+
+
+def add_shared_basemap(axes, crs, iso3):
+    """
+    Fetch the basemap once and draw it on several axes covering the
+    same extent.
+
+    """
+    limits = np.array([ax.axis() for ax in axes])
+    extent = (limits[:, 0].min(), limits[:, 1].max(),
+        limits[:, 2].min(), limits[:, 3].max())
+
+    for ax in axes:
+        ax.axis(extent)
+
+    add_basemap(axes[0], crs, iso3)
+    image = axes[0].images[-1]
+
+    for ax in axes[1:]:
+        ax.imshow(image.get_array(), extent=image.get_extent(),
+            interpolation=image.get_interpolation(), zorder=image.get_zorder())
+        ax.axis(extent)
+
+    return
+
+
+@timed
+def plot_coverage(iso3, layers=None):
+    """
+    Plot regions by geotype.
+
+    """
+    coverage_2G = get_layer(iso3, 'coverage_2G', layers)
+    coverage_3G = get_layer(iso3, 'coverage_3G', layers)
+    coverage_4G = get_layer(iso3, 'coverage_4G', layers)
 
     plt.rcParams["font.family"] = "Times New Roman"
     fig, (ax1, ax2) = plt.subplots(2, 2, figsize=(11,8))
     fig.subplots_adjust(hspace=.3, wspace=.1)
     fig.set_facecolor('gainsboro')
 
-    country = gpd.read_file(os.path.join(DATA_PROCESSED, iso3, 'national_outline.shp'), crs='epsg:4326')
+    country = get_layer(iso3, 'outline', layers)
     minx, miny, maxx, maxy = country.total_bounds
        
     country.plot(ax=ax1[0], color='whitesmoke', linewidth=0.1, alpha=.2, edgecolor='grey', zorder=1)
@@ -94,14 +230,11 @@ def plot_coverage(iso3):
     country.plot(ax=ax2[0], color='whitesmoke', linewidth=0.1, alpha=.2, edgecolor='grey', zorder=1)
     country.plot(ax=ax2[1], color='whitesmoke', linewidth=0.1, alpha=.2, edgecolor='grey', zorder=1)
 
-    coverage_2G.plot(color='red', lw=.6, ax=ax1[0], zorder=20)
-    coverage_3G.plot(color='orange', lw=.4, ax=ax1[1], zorder=15)
-    coverage_4G.plot(color='blue', lw=.2, ax=ax2[0], zorder=10)
+    plot_coverage_raster(ax1[0], coverage_2G, 'red', 20)
+    plot_coverage_raster(ax1[1], coverage_3G, 'orange', 15)
+    plot_coverage_raster(ax2[0], coverage_4G, 'blue', 10)
 
-    ctx.add_basemap(ax1[0], crs=country.crs, source=ctx.providers.CartoDB.Voyager)    
-    ctx.add_basemap(ax1[1], crs=country.crs, source=ctx.providers.CartoDB.Voyager)    
-    ctx.add_basemap(ax2[0], crs=country.crs, source=ctx.providers.CartoDB.Voyager)    
-    ctx.add_basemap(ax2[1], crs=country.crs, source=ctx.providers.CartoDB.Voyager)   
+    add_shared_basemap([ax1[0], ax1[1], ax2[0], ax2[1]], country.crs, iso3)
 
     ax1[0].set_title('2G GSM', fontname='Times New Roman')
     ax1[1].set_title('3G UMTS', fontname='Times New Roman')
@@ -119,16 +252,15 @@ def plot_coverage(iso3):
     plt.close(fig)
 
 
-def plot_regions_by_geotype(iso3):
+@timed
+def plot_regions_by_geotype(iso3, layers=None):
     """
     Plot regions by geotype.
 
     """
-    filename = 'all_data.shp'
-    folder_in = os.path.join(DATA_PROCESSED, iso3)
-    path_in = os.path.join(folder_in, filename)
-    regions = gpd.read_file(path_in, crs='epsg:4326')#[:5]
+    regions = get_layer(iso3, 'tiles', layers)
     n = len(regions)
+    count_records(n)
 
     metric = 'pop_km2'
 
@@ -168,7 +300,7 @@ def plot_regions_by_geotype(iso3):
 
     fig.legend(handles[::-1], labels[::-1])
 
-    ctx.add_basemap(ax, crs=regions.crs, source=ctx.providers.CartoDB.Voyager)    
+    add_basemap(ax, regions.crs, iso3)
 
     name = 'Population Density by Grid Tile (n={})'.format(n)
     fig.suptitle(name, fontsize=16, y=.97, fontname='Times New Roman')
@@ -180,20 +312,15 @@ def plot_regions_by_geotype(iso3):
     plt.close(fig)
 
 
-def plot_road_network(iso3):
+@timed
+def plot_road_network(iso3, layers=None):
     """
     Plot road network. 
 
     """
-    filename = 'national_outline.shp'
-    folder_in = os.path.join(DATA_PROCESSED, iso3)
-    path_in = os.path.join(folder_in, filename)
-    regions = gpd.read_file(path_in, crs='epsg:4326')#[:5]
-
-    filename = 'road_network_processed.shp'
-    folder_in = os.path.join(DATA_PROCESSED, iso3, 'infrastructure')
-    path_in = os.path.join(folder_in, filename)
-    roads = gpd.read_file(path_in, crs='epsg:4326')#[:5]
+    regions = get_layer(iso3, 'outline', layers)
+    roads = get_layer(iso3, 'roads', layers)
+    count_records(len(roads))
 
     motorway = roads[roads['fclass'] == 'motorway'] 
     primary = roads[roads['fclass'] == 'primary'] 
@@ -219,7 +346,7 @@ def plot_road_network(iso3):
 
     fig.legend(handles[::-1], labels[::-1])
 
-    ctx.add_basemap(ax, crs=regions.crs, source=ctx.providers.CartoDB.Voyager)    
+    add_basemap(ax, regions.crs, iso3)
 
     name = 'Key Segments of the Mexican Road Network'
     fig.suptitle(name, fontsize=16, y=.97, fontname='Times New Roman')
@@ -233,15 +360,14 @@ def plot_road_network(iso3):
     plt.close(fig)
 
 
-def plot_regions_by_investment_attractiveness(iso3):
+@timed
+def plot_regions_by_investment_attractiveness(iso3, layers=None):
     """
     Plot map. 
 
     """
-    filename = 'gsm_tiles.shp'
-    folder = os.path.join(BASE_PATH, '..', 'results', iso3, 'by_radio')
-    path = os.path.join(folder, filename)
-    shapes = gpd.read_file(path, crs='epsg:4326')
+    shapes = get_layer(iso3, 'attractiveness', layers)
+    count_records(len(shapes))
 
     bins = [-1, 10, 50, 100, 250, 500, 750, 1000, 2000, 5000, 1e8]
     labels = [
@@ -258,7 +384,7 @@ def plot_regions_by_investment_attractiveness(iso3):
     ]
 
     shapes['bin'] = pd.cut(
-        shapes['attractive'], 
+        shapes['attractiveness'], 
         bins=bins,
         labels=labels
     )
@@ -272,8 +398,6 @@ def plot_regions_by_investment_attractiveness(iso3):
     ax.set_xlim(minx-1, maxx+1)
     ax.set_ylim(miny-1.5, maxy+1.5)
 
-    plt.figure()
-
     base = shapes.plot(
         column='bin', 
         ax=ax, 
@@ -288,7 +412,7 @@ def plot_regions_by_investment_attractiveness(iso3):
 
     fig.legend(handles[::-1], labels[::-1])
 
-    ctx.add_basemap(ax, crs=shapes.crs, source=ctx.providers.CartoDB.Voyager)
+    add_basemap(ax, shapes.crs, iso3)
     
     fig.suptitle('Investment attractiveness for mobile infrastructure deployment', 
                     fontsize=18, 
@@ -304,16 +428,175 @@ def plot_regions_by_investment_attractiveness(iso3):
     plt.close(fig)
 
 
+@timed
+def plot_map(country, radios=None, layers=None):
+    """
+    Plot the backcast deployment schedule for each radio generation.
+
+    """
+    for radio in [
+        ('gsm', '2G'), 
+        ('umts', '3G'), 
+        ('lte', '4G')
+        ]:
+
+        if radios is not None and not radio[0] in radios:
+            continue
+
+        shapes = get_layer(country['iso3'], 'results_{}'.format(radio[0]), layers)
+        shapes = shapes[shapes['year'].notna()]
+        # with several operators, map the first year each tile was built
+        shapes = shapes.sort_values('year', kind='stable').drop_duplicates('id_lower')
+        count_records(len(shapes))
+        shapes['year'] = shapes['year'].astype(int)
+
+        bins = [1999,2002,2004,2006,2008,2010,2012, 2014, 2016, 2018,2021]
+        labels = ['2000-02','2002-04','2004-06','2006-08','2008-10','2010-12','2012-14','2014-16','2016-18','2018-20']
+
+        shapes['bin'] = pd.cut(
+            shapes['year'],
+            bins=bins,
+            labels=labels
+        )
+
+        sns.set(font_scale=1, font="Times New Roman")
+        sns.set_style("ticks")
+        fig, ax = plt.subplots(1, 1, figsize=(8,5.85))
+        fig.set_facecolor('gainsboro')
+
+        minx, miny, maxx, maxy = shapes.total_bounds
+        ax.set_xlim(minx-1, maxx+1)
+        ax.set_ylim(miny-1.5, maxy+1.5)
+
+        base = shapes.plot(
+            column='bin', 
+            ax=ax, 
+            cmap='viridis_r', 
+            linewidth=0.1,
+            legend=True, 
+            edgecolor='grey'
+            )
+        # country_shapes.plot(ax=base, facecolor="none", edgecolor='black', linewidth=0.75)
+
+        handles, labels = ax.get_legend_handles_labels()
+
+        fig.legend(handles[::-1], labels[::-1])
+
+        add_basemap(ax, shapes.crs, country['iso3'])
+        
+        start, end = start_year(radio[0])
+        fig.suptitle('Backcast of {} mobile infrastructure deployment {}-{}'.format(radio[1], start, end), 
+                     fontsize=18, 
+                     fontname='Times New Roman')
+
+        fig.tight_layout()
+        filename = '{}_deployment_schedule.png'.format(radio[1])
+        folder = os.path.join(VIS)
+        if not os.path.exists(folder):
+            os.mkdir(folder)
+        fig.savefig(os.path.join(folder, filename), dpi=600)
+
+        plt.close(fig)
+
+
+FIGURES = {
+    'coverage': ['coverage_2G', 'coverage_3G', 'coverage_4G', 'outline'],
+    'geotype': ['tiles'],
+    'road_network': ['outline', 'roads'],
+    'attractiveness': ['attractiveness'],
+    'deployment_gsm': ['results_gsm'],
+    'deployment_umts': ['results_umts'],
+    'deployment_lte': ['results_lte'],
+}
+
+
+def render_figure(iso3, figure):
+    """
+    Render a single figure using the preloaded layers. Called within a
+    rendering worker.
+
+    """
+    reset_report()
+
+    if figure == 'coverage':
+        plot_coverage(iso3, LAYERS)
+    elif figure == 'geotype':
+        plot_regions_by_geotype(iso3, LAYERS)
+    elif figure == 'road_network':
+        plot_road_network(iso3, LAYERS)
+    elif figure == 'attractiveness':
+        plot_regions_by_investment_attractiveness(iso3, LAYERS)
+    elif figure.startswith('deployment_'):
+        plot_map({'iso3': iso3}, [figure.split('_')[1]], LAYERS)
+
+    return get_report()
+
+
+def set_layers(layers):
+    """
+    Set the preloaded layers within a rendering worker.
+
+    """
+    LAYERS.update(layers)
+
+    return
+
+
+def render_all(iso3, figures=None, processes=None):
+    """
+    Render the figures in parallel, loading each layer only once.
+
+    Layers are loaded in the parent process and shared with the workers,
+    by fork where available, or otherwise by passing them once to each
+    worker.
+
+    """
+    if figures is None:
+        figures = list(FIGURES.keys())
+
+    names = []
+    for figure in figures:
+        for name in FIGURES[figure]:
+            if not name in names:
+                names.append(name)
+
+    LAYERS.clear()
+    for name in names:
+        print('Loading {}'.format(name))
+        LAYERS[name] = load_layer(iso3, name)
+
+    if not os.path.exists(VIS):
+        os.mkdir(VIS)
+
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+        initializer, initargs = None, ()
+    else:
+        context = multiprocessing.get_context()
+        initializer, initargs = set_layers, (dict(LAYERS),)
+
+    calls = []
+
+    with ProcessPoolExecutor(max_workers=processes or len(figures),
+            mp_context=context, initializer=initializer,
+            initargs=initargs) as executor:
+
+        futures = {executor.submit(render_figure, iso3, figure): figure
+            for figure in figures}
+
+        for future, figure in futures.items():
+            calls = calls + future.result()
+            print('Rendered {}'.format(figure))
+
+    return calls
+
+
 if __name__ == '__main__':
 
     iso3 = 'MEX'
 
-    plot_coverage(iso3)
-    
-    plot_regions_by_geotype(iso3)
-
-    plot_road_network(iso3)
+    calls = render_all(iso3)
 
-    plot_regions_by_investment_attractiveness(iso3)
+    export_report('vis', calls)
 
     print('Complete')